@@ -2,11 +2,11 @@
 
 Persistent, server-keyed sessions backed by a folder under AI_DIR. Each session
 carries a reference to a volume and (optionally) an annotation mask and a result
-mask. A RAM cache with a TTL keeps the preprocessed volume tensor and last
-inference logits available across rapid successive calls; the manifest on disk
-is the source of truth.
+mask. A memory-bounded LRU cache with a TTL keeps the preprocessed volume tensor
+and last inference logits available across rapid successive calls; the
+manifest on disk is the source of truth, indexed by an SQLite catalog (see
+session_catalog.py) so lookups do not scan AI_DIR.
 """
-import json
 import logging
 import os
 import re
@@ -14,21 +14,53 @@ import shutil
 import threading
 import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any
 
-import yaml
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException, Query, Response
 from pydantic import BaseModel
 
+from batching import MicroBatcher
+from metrics import (
+    AI_CACHE_BYTES,
+    AI_CACHE_ENTRIES,
+    AI_CACHE_EVICTIONS,
+    AI_CACHE_LOOKUPS,
+    BYTES_WRITTEN,
+    INFERENCE_SECONDS,
+    REGISTRY,
+)
+from model_registry import ModelRegistry
+from preproc_cache import PreprocCache
+from scheduler import InferenceScheduler, Job
+from session_catalog import SessionCatalog
+from session_clicks import (
+    CLICKS_FILENAME,
+    LABELS,
+    VolumeGrid,
+    is_clicks,
+    load_clicks,
+    materialize,
+    save_clicks,
+    strokes_from_labels,
+    to_ras_voxels,
+    volume_grid,
+)
+from session_state import SharedSessionState
+from timing import StageTimer
+from volume_meta import read_header_meta
+
 logger = logging.getLogger(__name__)
 
 _SESSION_NAME_RE = re.compile(r"^[A-Za-z0-9_-]+$")
-_MANIFEST_FILENAME = "session.json"
 _VOLUME_ROOT_DATA = "data"
 _VOLUME_ROOT_SESSION = "session"
+_RESULT_FILENAME = "result.nii.gz"
 
 
 class NewSessionRequest(BaseModel):
@@ -43,6 +75,18 @@ class SetAnnotsRequest(BaseModel):
     annotation_path: str
 
 
+class ClickStroke(BaseModel):
+    label: int
+    points: list[list[float]]
+    connect: bool = False
+
+
+class ClicksRequest(BaseModel):
+    strokes: list[ClickStroke]
+    space: str = "ras"
+    replace: bool = False
+
+
 class InferRequest(BaseModel):
     label_value: int = 1
 
@@ -51,10 +95,30 @@ class InferRequest(BaseModel):
 class _SessionCacheEntry:
     last_touched: float = field(default_factory=time.monotonic)
     volume_tensor: Any = None
+    volume_mapped: bool = False
     affine_ras: Any = None
     ras_dims: tuple[int, int, int] | None = None
     shape_before_pad: tuple[int, int, int] | None = None
     previous_logits: Any = None
+    # (volume_epoch, logits_epoch) last seen in the shared session state
+    epochs: tuple[int, int] | None = None
+    # Bit-packed foreground of the last result (mask_codec.mask_bits) and its
+    # version token, the base for delta-encoded responses.
+    last_mask: Any = None
+    result_version: str | None = None
+
+    def nbytes(self) -> int:
+        """Bytes held by the entry's arrays (tensors and numpy arrays alike).
+
+        A memory-mapped volume from the preprocessed cache is shared,
+        reclaimable page cache rather than memory owned by this entry, so it
+        is not counted.
+        """
+        volume = None if self.volume_mapped else self.volume_tensor
+        return sum(
+            int(getattr(value, "nbytes", 0) or 0)
+            for value in (volume, self.affine_ras, self.previous_logits, self.last_mask)
+        )
 
 
 def _now_iso() -> str:
@@ -62,10 +126,18 @@ def _now_iso() -> str:
 
 
 class SessionManager:
-    """Owns session manifests on disk and the RAM cache with lazy TTL eviction.
+    """Owns session manifests on disk and the RAM cache.
 
     Filesystem is authoritative. The RAM cache exists only to avoid repeated
-    disk I/O and preprocessing inside an active editing session.
+    disk I/O and preprocessing inside an active editing session. Entries are
+    kept in LRU order and evicted when idle for `ttl_seconds` (by a
+    background sweeper as well as on access) or, least recently used first,
+    when their combined size exceeds `max_cache_bytes`.
+
+    With `shared_state`, the cache is kept coherent across worker processes:
+    inference runs under a per-session lease, entries are revalidated against
+    the shared epochs on access, and previous logits are handed between
+    workers through the state directory.
     """
 
     def __init__(
@@ -74,36 +146,173 @@ class SessionManager:
         data_dir: Path,
         ttl_seconds: int,
         enable_history: bool = False,
+        history_deltas: bool = False,
+        max_cache_bytes: int | None = None,
+        sweep_seconds: float = 60.0,
+        shared_state: SharedSessionState | None = None,
+        catalog_path: Path | None = None,
     ):
         self.ai_dir = ai_dir
         self.data_dir = data_dir
         self.ttl_seconds = ttl_seconds
         self.enable_history = enable_history
-        self._cache: dict[str, _SessionCacheEntry] = {}
+        self.history_deltas = history_deltas
+        self.max_cache_bytes = max_cache_bytes
+        self.sweep_seconds = sweep_seconds
+        self.shared_state = shared_state
+        self.catalog = SessionCatalog(ai_dir, catalog_path)
+        counts = self.catalog.sync()
+        if counts["updated"] or counts["removed"]:
+            logger.info(f"AI session catalog synced: {counts}")
+        self._cache: OrderedDict[str, _SessionCacheEntry] = OrderedDict()
         self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions_ttl": 0, "evictions_lru": 0}
+        self._stop = threading.Event()
+        self._sweeper: threading.Thread | None = None
 
     # ----- cache -----
+    def start(self) -> None:
+        """Start the background TTL sweeper."""
+        if self._sweeper is not None:
+            return
+        self._sweeper = threading.Thread(
+            target=self._run_sweeper, name="ai-session-cache-sweeper", daemon=True,
+        )
+        self._sweeper.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run_sweeper(self) -> None:
+        while not self._stop.wait(self.sweep_seconds):
+            with self._lock:
+                self._sweep_expired()
+            if self.shared_state is not None:
+                try:
+                    self.shared_state.sweep(self.ttl_seconds)
+                except OSError as exc:
+                    logger.warning(f"Shared session state sweep failed: {exc}")
+
+    def _evict(self, session_id: str, reason: str) -> None:
+        entry = self._cache.pop(session_id, None)
+        if entry is None:
+            return
+        self._stats[f"evictions_{reason}"] += 1
+        AI_CACHE_EVICTIONS.inc(reason=reason)
+        logger.info(
+            f"AI session cache: evicted {session_id} "
+            f"({reason.upper()}, {entry.nbytes() / 2**20:.1f} MiB)"
+        )
+
     def _sweep_expired(self) -> None:
         now = time.monotonic()
         stale = [sid for sid, e in self._cache.items()
                  if now - e.last_touched > self.ttl_seconds]
         for sid in stale:
-            self._cache.pop(sid, None)
-            logger.info(f"AI session cache: evicted {sid} (TTL)")
+            self._evict(sid, "ttl")
+
+    def _enforce_budget(self, keep: str | None = None) -> None:
+        """Evict least recently used entries (never `keep`) until under budget."""
+        if self.max_cache_bytes is None:
+            return
+        sizes = {sid: e.nbytes() for sid, e in self._cache.items()}
+        total = sum(sizes.values())
+        for sid in list(self._cache):
+            if total <= self.max_cache_bytes:
+                break
+            if sid == keep:
+                continue
+            self._evict(sid, "lru")
+            total -= sizes[sid]
+        if total > self.max_cache_bytes:
+            logger.warning(
+                f"AI session cache: {total / 2**20:.1f} MiB in use exceeds the "
+                f"{self.max_cache_bytes / 2**20:.1f} MiB budget"
+            )
 
     def touch(self, session_id: str) -> _SessionCacheEntry:
         with self._lock:
             self._sweep_expired()
             entry = self._cache.get(session_id)
+            AI_CACHE_LOOKUPS.inc(result="miss" if entry is None else "hit")
+            self._stats["misses" if entry is None else "hits"] += 1
             if entry is None:
                 entry = _SessionCacheEntry()
                 self._cache[session_id] = entry
+            self._cache.move_to_end(session_id)
             entry.last_touched = time.monotonic()
-            return entry
+        if self.shared_state is not None:
+            self._sync_shared(session_id, entry)
+        return entry
+
+    def lease(self, session_id: str):
+        """Context manager serializing work on a session across workers."""
+        if self.shared_state is None:
+            return nullcontext()
+        return self.shared_state.lease(session_id)
+
+    def _sync_shared(self, session_id: str, entry: _SessionCacheEntry) -> None:
+        """Bring `entry` up to date with changes made by other workers."""
+        volume_epoch, logits_epoch = self.shared_state.epochs(session_id)
+        seen = entry.epochs
+        if seen is None or seen[0] != volume_epoch:
+            entry.volume_tensor = None
+            entry.volume_mapped = False
+            entry.affine_ras = None
+            entry.ras_dims = None
+            entry.shape_before_pad = None
+            entry.last_mask = None
+            entry.result_version = None
+        if seen is None or seen[1] != logits_epoch:
+            entry.previous_logits = self.shared_state.load_logits(session_id)
+        entry.epochs = (volume_epoch, logits_epoch)
+
+    def publish(self, session_id: str, entry: _SessionCacheEntry) -> None:
+        """Share the entry's new logits with other workers (call under `lease`)."""
+        if self.shared_state is None or entry.previous_logits is None or entry.epochs is None:
+            return
+        epoch = self.shared_state.store_logits(
+            session_id, entry.previous_logits, expected_epoch=entry.epochs[1],
+        )
+        if epoch is None:
+            # Annotations or volume changed while inferring; don't reuse these.
+            entry.previous_logits = None
+        else:
+            entry.epochs = (entry.epochs[0], epoch)
+
+    def settle(self, session_id: str) -> None:
+        """Re-account a session's entry after it was filled, evicting others if needed."""
+        with self._lock:
+            self._enforce_budget(keep=session_id)
+
+    def cache_stats(self) -> dict[str, Any]:
+        with self._lock:
+            entries = [
+                {
+                    "session_id": sid,
+                    "bytes": e.nbytes(),
+                    "idle_seconds": round(time.monotonic() - e.last_touched, 1),
+                    "has_volume": e.volume_tensor is not None,
+                    "volume_mapped": e.volume_mapped,
+                    "has_logits": e.previous_logits is not None,
+                }
+                for sid, e in reversed(self._cache.items())
+            ]
+            stats = dict(self._stats)
+        return {
+            **stats,
+            "entries": len(entries),
+            "bytes": sum(e["bytes"] for e in entries),
+            "max_bytes": self.max_cache_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "sessions": entries,
+        }
 
     def invalidate_all(self, session_id: str) -> None:
         with self._lock:
             self._cache.pop(session_id, None)
+        if self.shared_state is not None:
+            self.shared_state.invalidate(session_id, volume=True)
 
     def invalidate_logits(self, session_id: str) -> None:
         with self._lock:
@@ -111,44 +320,28 @@ class SessionManager:
             if entry is not None:
                 entry.previous_logits = None
                 entry.last_touched = time.monotonic()
+        if self.shared_state is not None:
+            self.shared_state.invalidate(session_id, volume=False)
 
     # ----- manifest I/O -----
     def _session_dir_by_name(self, session_name: str) -> Path:
         return self.ai_dir / session_name
 
-    def _read_manifest(self, manifest_path: Path) -> dict[str, Any]:
-        with open(manifest_path, "r") as f:
-            return json.load(f)
-
-    def _write_manifest(self, manifest_path: Path, manifest: dict[str, Any]) -> None:
-        tmp = manifest_path.with_suffix(manifest_path.suffix + ".tmp")
-        with open(tmp, "w") as f:
-            json.dump(manifest, f, indent=2)
-        os.replace(tmp, manifest_path)
-
-    def _iter_session_manifests(self):
-        if not self.ai_dir.exists():
-            return
-        for entry in sorted(self.ai_dir.iterdir()):
-            if not entry.is_dir():
-                continue
-            manifest = entry / _MANIFEST_FILENAME
-            if not manifest.exists():
-                continue
-            try:
-                yield entry, self._read_manifest(manifest)
-            except (OSError, json.JSONDecodeError) as exc:
-                logger.warning(f"Skipping unreadable session {entry.name}: {exc}")
-
-    def list_sessions(self) -> list[dict[str, Any]]:
-        sessions = [m for _dir, m in self._iter_session_manifests()]
-        return sorted(sessions, key=lambda m: m.get("created_at", ""))
+    def list_sessions(self, offset: int = 0, limit: int | None = None) -> list[dict[str, Any]]:
+        return self.catalog.list(offset=offset, limit=limit)
 
     def find_by_id(self, session_id: str) -> tuple[Path, dict[str, Any]]:
-        for session_dir, manifest in self._iter_session_manifests():
-            if manifest.get("session_id") == session_id:
-                return session_dir, manifest
-        raise HTTPException(status_code=404, detail=f"Session not found: {session_id}")
+        found = self.catalog.get(session_id)
+        if found is None:
+            raise HTTPException(status_code=404, detail=f"Session not found: {session_id}")
+        return found
+
+    def _update(self, session_id: str, mutate) -> dict[str, Any]:
+        """Apply `mutate(session_dir, manifest)` to the manifest in one transaction."""
+        updated = self.catalog.update(session_id, mutate)
+        if updated is None:
+            raise HTTPException(status_code=404, detail=f"Session not found: {session_id}")
+        return updated[1]
 
     def create(self, session_name: str) -> dict[str, Any]:
         if not _SESSION_NAME_RE.match(session_name):
@@ -178,14 +371,17 @@ class SessionManager:
         if self.enable_history:
             manifest["iteration_count"] = 0
             manifest["iterations"] = []
-        self._write_manifest(session_dir / _MANIFEST_FILENAME, manifest)
+        self.catalog.add(session_dir, manifest)
         logger.info(f"AI session created: {session_name} ({manifest['session_id']})")
         return manifest
 
     def delete(self, session_id: str) -> None:
         session_dir, _manifest = self.find_by_id(session_id)
         shutil.rmtree(session_dir)
+        self.catalog.remove(session_id)
         self.invalidate_all(session_id)
+        if self.shared_state is not None:
+            self.shared_state.discard(session_id)
         logger.info(f"AI session deleted: {session_id}")
 
     # ----- path resolution -----
@@ -223,38 +419,160 @@ class SessionManager:
 
     # ----- mutations -----
     def set_volume(self, session_id: str, rel: str) -> dict[str, Any]:
-        session_dir, manifest = self.find_by_id(session_id)
+        session_dir, _manifest = self.find_by_id(session_id)
         _abs, root_tag = self.resolve_path_for_session(
             rel=rel, session_dir=session_dir, allow_data_root=True,
         )
-        manifest["volume_path"] = rel
-        manifest["volume_path_root"] = root_tag
-        self._write_manifest(session_dir / _MANIFEST_FILENAME, manifest)
+
+        def mutate(_dir: Path, manifest: dict[str, Any]) -> None:
+            manifest["volume_path"] = rel
+            manifest["volume_path_root"] = root_tag
+
+        manifest = self._update(session_id, mutate)
         self.invalidate_all(session_id)
         return manifest
 
+    def _volume_abs(self, session_dir: Path, manifest: dict[str, Any]) -> Path | None:
+        if not manifest.get("volume_path"):
+            return None
+        root = self.data_dir if manifest.get("volume_path_root") == _VOLUME_ROOT_DATA else session_dir
+        return self._resolve_under(root, manifest["volume_path"])
+
+    def _volume_grid(self, session_dir: Path, manifest: dict[str, Any]) -> VolumeGrid:
+        volume_abs = self._volume_abs(session_dir, manifest)
+        if volume_abs is None:
+            raise HTTPException(status_code=400, detail="Session has no volume set")
+        return volume_grid(volume_abs)
+
+    def _check_annotation_shape(
+        self,
+        annot_abs: Path,
+        session_dir: Path,
+        manifest: dict[str, Any],
+    ) -> None:
+        """Reject annotations whose RAS dims differ from the volume's.
+
+        Only the two image headers are read. Files nibabel cannot parse are
+        left for inference to report.
+        """
+        volume_abs = self._volume_abs(session_dir, manifest)
+        if volume_abs is None:
+            return
+        try:
+            annot_dims = read_header_meta(annot_abs)["ras_dims"]
+            volume_dims = read_header_meta(volume_abs)["ras_dims"]
+        except Exception as exc:
+            logger.debug(f"Skipping annotation shape check: {exc}")
+            return
+        if annot_dims != volume_dims:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Annotation RAS dims {tuple(annot_dims)} != volume RAS dims {tuple(volume_dims)}",
+            )
+
     def set_annots(self, session_id: str, rel: str) -> dict[str, Any]:
         session_dir, manifest = self.find_by_id(session_id)
-        self.resolve_path_for_session(
+        annot_abs, _root = self.resolve_path_for_session(
             rel=rel, session_dir=session_dir, allow_data_root=False,
         )
-        manifest["annotation_path"] = rel
-        self._write_manifest(session_dir / _MANIFEST_FILENAME, manifest)
+        self._check_annotation_shape(annot_abs, session_dir, manifest)
+
+        def mutate(_dir: Path, manifest: dict[str, Any]) -> None:
+            manifest["annotation_path"] = rel
+
+        manifest = self._update(session_id, mutate)
         self.invalidate_logits(session_id)
         return manifest
 
+    def _current_clicks(
+        self, session_dir: Path, manifest: dict[str, Any], grid: VolumeGrid,
+    ) -> dict[str, Any] | None:
+        """The session's click state, seeded from its annotation NIfTI if it has one."""
+        import nibabel as nib
+        import numpy as np
+
+        rel = manifest.get("annotation_path")
+        if is_clicks(rel):
+            return load_clicks(session_dir)
+        annot_abs = self._resolve_under(session_dir, rel) if rel else None
+        if annot_abs is None:
+            return None
+        labels = np.asarray(nib.as_closest_canonical(nib.load(str(annot_abs))).dataobj)
+        if labels.shape != grid.ras_dims:
+            return None
+        return {
+            "ras_dims": list(grid.ras_dims),
+            "strokes": strokes_from_labels(np.rint(labels).astype(np.uint8)),
+        }
+
+    def add_clicks(
+        self,
+        session_id: str,
+        strokes: list[dict[str, Any]],
+        space: str = "ras",
+        replace: bool = False,
+    ) -> dict[str, Any]:
+        """Add click/stroke prompts (see session_clicks.py) to the session's annotations.
+
+        Unless `replace` is set, the prompts extend the current annotations,
+        including ones uploaded earlier as a NIfTI. Returns the click state.
+        """
+        session_dir, manifest = self.find_by_id(session_id)
+        grid = self._volume_grid(session_dir, manifest)
+        added = []
+        for stroke in strokes:
+            if stroke["label"] not in LABELS:
+                raise HTTPException(
+                    status_code=400, detail=f"Stroke label must be one of {LABELS}",
+                )
+            try:
+                points = to_ras_voxels(stroke["points"], space, grid).tolist()
+            except ValueError as exc:
+                raise HTTPException(status_code=400, detail=str(exc)) from None
+            added.append({
+                "label": stroke["label"],
+                "points": points,
+                "connect": bool(stroke.get("connect")),
+            })
+        state: dict[str, Any] = {}
+
+        def mutate(session_dir: Path, manifest: dict[str, Any]) -> None:
+            current = None if replace else self._current_clicks(session_dir, manifest, grid)
+            if current is None or tuple(current["ras_dims"]) != grid.ras_dims:
+                current = {"ras_dims": list(grid.ras_dims), "strokes": []}
+            current["strokes"].extend(added)
+            save_clicks(session_dir, current)
+            manifest["annotation_path"] = CLICKS_FILENAME
+            state.update(current)
+
+        self._update(session_id, mutate)
+        self.invalidate_logits(session_id)
+        return state
+
+    def materialize_annotations(self, session_id: str) -> str | None:
+        """Path of an annotation NIfTI for the session, writing one from its clicks."""
+        session_dir, manifest = self.find_by_id(session_id)
+        rel = manifest.get("annotation_path")
+        if not is_clicks(rel):
+            return rel
+        state = load_clicks(session_dir)
+        if state is None:
+            return None
+        grid = self._volume_grid(session_dir, manifest)
+        return materialize(session_dir, state, grid).name
+
     def record_inference(
         self,
         session_id: str,
         ml_id: str,
         result_rel_path: str,
     ) -> dict[str, Any]:
-        session_dir, manifest = self.find_by_id(session_id)
-        manifest["result_path"] = result_rel_path
-        manifest["last_inference_ml_id"] = ml_id
-        manifest["last_inference_at"] = _now_iso()
-        self._write_manifest(session_dir / _MANIFEST_FILENAME, manifest)
-        return manifest
+        def mutate(_dir: Path, manifest: dict[str, Any]) -> None:
+            manifest["result_path"] = result_rel_path
+            manifest["last_inference_ml_id"] = ml_id
+            manifest["last_inference_at"] = _now_iso()
+
+        return self._update(session_id, mutate)
 
     def record_iteration(
         self,
@@ -262,53 +580,31 @@ class SessionManager:
         ml_id: str,
         result_rel_path: str,
         iteration_entry: dict[str, Any],
+        staged: dict[str, tuple[Path, str, str]],
     ) -> dict[str, Any]:
-        session_dir, manifest = self.find_by_id(session_id)
-        manifest["result_path"] = result_rel_path
-        manifest["last_inference_ml_id"] = ml_id
-        manifest["last_inference_at"] = _now_iso()
-        iterations = manifest.get("iterations") or []
-        iterations.append(iteration_entry)
-        manifest["iterations"] = iterations
-        manifest["iteration_count"] = manifest.get("iteration_count", 0) + 1
-        self._write_manifest(session_dir / _MANIFEST_FILENAME, manifest)
-        return manifest
+        """Append a history iteration, numbered in the same transaction.
 
+        `staged` maps entry keys (e.g. "result_path") to (temp file, name
+        prefix, suffix); each file is renamed to `<prefix>_<NNN><suffix>`
+        under the allocated number, so concurrent writers never share one.
+        """
+        def mutate(session_dir: Path, manifest: dict[str, Any]) -> None:
+            manifest["result_path"] = result_rel_path
+            manifest["last_inference_ml_id"] = ml_id
+            manifest["last_inference_at"] = _now_iso()
+            n = manifest.get("iteration_count", 0)
+            entry: dict[str, Any] = {"iteration": n}
+            for key, (tmp, prefix, suffix) in staged.items():
+                name = f"{prefix}_{n:03d}{suffix}"
+                os.replace(tmp, session_dir / name)
+                entry[key] = name
+            entry.update(iteration_entry)
+            iterations = manifest.get("iterations") or []
+            iterations.append(entry)
+            manifest["iterations"] = iterations
+            manifest["iteration_count"] = manifest.get("iteration_count", 0) + 1
 
-def _load_yaml(path: Path) -> dict[str, Any] | None:
-    try:
-        with open(path, "r") as f:
-            return yaml.safe_load(f)
-    except (OSError, yaml.YAMLError) as exc:
-        logger.warning(f"Could not parse {path}: {exc}")
-        return None
-
-
-def _list_models(models_dir: Path) -> list[dict[str, Any]]:
-    if not models_dir.exists():
-        return []
-    out: list[dict[str, Any]] = []
-    for model_dir in sorted(models_dir.iterdir()):
-        if not model_dir.is_dir():
-            continue
-        model_file = model_dir / "model.py"
-        weights_file = model_dir / "weights.pt"
-        if not (model_file.exists() and weights_file.exists()):
-            continue
-        info: dict[str, Any] = {
-            "ml_id": model_dir.name,
-            "name": model_dir.name,
-            "model_module_path": str(model_file),
-            "checkpoint_path": str(weights_file),
-            "config_path": None,
-            "config": None,
-        }
-        config_file = model_dir / "config.yml"
-        if config_file.exists():
-            info["config_path"] = str(config_file)
-            info["config"] = _load_yaml(config_file)
-        out.append(info)
-    return out
+        return self._update(session_id, mutate)
 
 
 def build_router(
@@ -319,6 +615,20 @@ def build_router(
     ttl_seconds: int,
     enabled: bool,
     enable_history: bool = False,
+    history_deltas: bool = False,
+    max_cache_bytes: int | None = None,
+    sweep_seconds: float = 60.0,
+    preproc_cache: PreprocCache | None = None,
+    shared_state: SharedSessionState | None = None,
+    catalog_path: Path | None = None,
+    max_concurrent_inference: int = 1,
+    model_concurrency: int | None = None,
+    job_ttl_seconds: float = 600.0,
+    infer_wait_timeout: float | None = 300.0,
+    inference_memory_bytes: int | None = None,
+    batcher: MicroBatcher | None = None,
+    model_cache_bytes: int | None = None,
+    preload_models: list[str] | None = None,
 ) -> APIRouter:
     """Build the /ai/* router. When `enabled` is False, every route returns 404."""
     router = APIRouter(prefix="/ai")
@@ -327,27 +637,77 @@ def build_router(
         data_dir=data_dir,
         ttl_seconds=ttl_seconds,
         enable_history=enable_history,
+        history_deltas=history_deltas,
+        max_cache_bytes=max_cache_bytes,
+        sweep_seconds=sweep_seconds,
+        shared_state=shared_state,
+        catalog_path=catalog_path,
     )
+    if enabled:
+        manager.start()
+    scheduler = InferenceScheduler(
+        max_concurrent=max_concurrent_inference, job_ttl_seconds=job_ttl_seconds,
+    )
+    result_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ai-result-writer")
+    registry = ModelRegistry(models_dir, max_bytes=model_cache_bytes)
+
+    def _preload(ml_ids: list[str]) -> None:
+        from ml_inference import warm_model  # lazy; only when AI is enabled
+
+        if ml_ids == ["all"]:
+            ml_ids = [m["ml_id"] for m in registry.list()]
+        for ml_id in ml_ids:
+            try:
+                warm_model(ml_id, models_dir, registry)
+            except Exception:
+                logger.exception(f"Failed to preload model '{ml_id}'")
+
+    if enabled and preload_models:
+        threading.Thread(
+            target=_preload, args=(preload_models,), name="ai-model-preload", daemon=True,
+        ).start()
+
+    def _collect_cache() -> None:
+        stats = manager.cache_stats()
+        AI_CACHE_ENTRIES.set(stats["entries"])
+        AI_CACHE_BYTES.set(stats["bytes"])
+
+    REGISTRY.add_collector(_collect_cache)
 
     def _require_enabled() -> None:
         if not enabled:
             raise HTTPException(status_code=404, detail="AI endpoints disabled")
 
     def _require_ml_id(ml_id: str) -> dict[str, Any]:
-        for m in _list_models(models_dir):
-            if m["ml_id"] == ml_id:
-                return m
-        raise HTTPException(status_code=404, detail=f"Unknown ml_id: {ml_id}")
+        model = registry.get(ml_id)
+        if model is None:
+            raise HTTPException(status_code=404, detail=f"Unknown ml_id: {ml_id}")
+        return model
 
     @router.get("/model/list")
     def model_list():
         _require_enabled()
-        return _list_models(models_dir)
+        return registry.list()
+
+    @router.get("/cache/stats")
+    def cache_stats():
+        _require_enabled()
+        stats = manager.cache_stats()
+        stats["scheduler"] = scheduler.stats()
+        stats["models"] = registry.stats()
+        if preproc_cache is not None:
+            stats["preprocessed"] = preproc_cache.stats()
+        return stats
 
     @router.get("/session/list")
-    def session_list():
+    def session_list(
+        response: Response,
+        offset: int = Query(0, ge=0),
+        limit: int | None = Query(None, ge=1),
+    ):
         _require_enabled()
-        return manager.list_sessions()
+        response.headers["X-Total-Count"] = str(manager.catalog.count())
+        return manager.list_sessions(offset=offset, limit=limit)
 
     @router.post("/session/new")
     def session_new(request: NewSessionRequest):
@@ -380,74 +740,339 @@ def build_router(
         manifest = manager.set_annots(session_id, request.annotation_path)
         return {"success": True, "annotation_path": manifest["annotation_path"]}
 
-    @router.post("/session/{session_id}/infer/{ml_id}")
-    def session_infer(
-        session_id: str,
-        ml_id: str,
-        request: InferRequest | None = None,
-    ):
+    @router.post("/session/{session_id}/clicks")
+    def session_add_clicks(session_id: str, request: ClicksRequest):
+        """Add click/stroke prompts; they become the session's annotations."""
+        _require_enabled()
+        state = manager.add_clicks(
+            session_id,
+            [
+                {"label": stroke.label, "points": stroke.points, "connect": stroke.connect}
+                for stroke in request.strokes
+            ],
+            space=request.space,
+            replace=request.replace,
+        )
+        return {
+            "success": True,
+            "annotation_path": CLICKS_FILENAME,
+            "strokes": len(state["strokes"]),
+            "points": sum(len(stroke["points"]) for stroke in state["strokes"]),
+        }
+
+    @router.get("/session/{session_id}/clicks")
+    def session_get_clicks(session_id: str):
         _require_enabled()
         session_dir, manifest = manager.find_by_id(session_id)
-        _require_ml_id(ml_id)
-        if not manifest.get("volume_path"):
-            raise HTTPException(status_code=400, detail="Session has no volume set")
-        if not manifest.get("annotation_path"):
-            raise HTTPException(status_code=400, detail="Session has no annotations set")
-        label_value = 1 if request is None else max(0, min(255, request.label_value))
+        state = load_clicks(session_dir) if is_clicks(manifest.get("annotation_path")) else None
+        return state or {"ras_dims": None, "strokes": []}
 
-        from ml_inference import run_inference  # lazy; only when AI is enabled
-        import nibabel as nib
+    @router.post("/session/{session_id}/clicks/materialize")
+    def session_materialize_clicks(session_id: str):
+        """Write the session's clicks as an annotation NIfTI (for the viewer)."""
+        _require_enabled()
+        return {
+            "success": True,
+            "annotation_path": manager.materialize_annotations(session_id),
+        }
 
-        cache_entry = manager.touch(session_id)
-        nii, _affine = run_inference(
-            session_id=session_id,
-            ml_id=ml_id,
-            label_value=label_value,
-            cache_entry=cache_entry,
-            session_dir=session_dir,
-            manifest=manifest,
-            data_dir=manager.data_dir,
-            models_dir=models_dir,
+    def _snapshot_annotations(session_dir: Path, manifest: dict[str, Any]) -> tuple[str, bytes, str]:
+        """The session's current annotations as (file suffix, contents, mtime),
+        taken under the lease so the history records what the inference saw."""
+        annot_rel = manifest["annotation_path"]
+        annot_abs, _root = manager.resolve_path_for_session(
+            rel=annot_rel, session_dir=session_dir, allow_data_root=False,
         )
+        with open(annot_abs, "rb") as f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            data = f.read()
+        annotated_at = datetime.fromtimestamp(mtime, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        return (".json" if is_clicks(annot_rel) else ".nii.gz"), data, annotated_at
 
-        result_rel = "result.nii.gz"
-        result_abs = session_dir / result_rel
-        nib.save(nii, str(result_abs))
-
-        if manager.enable_history:
-            n = manifest.get("iteration_count", 0)
-            numbered_result = f"result_{n:03d}.nii.gz"
-            numbered_annot = f"annotations_{n:03d}.nii.gz"
+    def _persist(
+        session_id: str,
+        ml_id: str,
+        label_value: int,
+        nii,
+        timer: StageTimer,
+        versions: tuple[Any, ...] | None = None,
+        annotations: tuple[str, bytes, str] | None = None,
+    ) -> None:
+        """Write the result NIfTI (and history copies) and record it in the manifest.
 
-            annot_rel = manifest["annotation_path"]
-            annot_abs, _root = manager.resolve_path_for_session(
-                rel=annot_rel, session_dir=session_dir, allow_data_root=False,
-            )
-            annotated_at = datetime.fromtimestamp(
-                annot_abs.stat().st_mtime, tz=timezone.utc,
-            ).strftime("%Y-%m-%dT%H:%M:%SZ")
+        `versions` is (version, base_version, base_bits) of the result when
+        history is kept as deltas; see `_save_history_result`. `annotations`
+        is the snapshot from `_snapshot_annotations`, required with history.
+        """
+        import nibabel as nib
 
-            shutil.copy2(result_abs, session_dir / numbered_result)
-            shutil.copy2(annot_abs, session_dir / numbered_annot)
+        session_dir, manifest = manager.find_by_id(session_id)
+        result_abs = session_dir / _RESULT_FILENAME
+        with timer.stage("save") as saved:
+            nib.save(nii, str(result_abs))
+            saved["bytes"] = result_abs.stat().st_size
+        BYTES_WRITTEN.inc(saved["bytes"], kind="ai_result")
 
+        if manager.enable_history:
+            annot_suffix, annot_data, annotated_at = annotations
             iteration_entry = {
-                "iteration": n,
-                "annotation_path": numbered_annot,
-                "result_path": numbered_result,
                 "ml_id": ml_id,
                 "label_value": label_value,
                 "annotated_at": annotated_at,
                 "inferred_at": _now_iso(),
             }
-            manager.record_iteration(session_id, ml_id, result_rel, iteration_entry)
+            # Numbered names are chosen when the iteration is recorded.
+            annot_tmp = session_dir / f".history-{uuid.uuid4().hex}.tmp"
+            result_tmp = session_dir / f".history-{uuid.uuid4().hex}.tmp"
+            try:
+                with timer.stage("history") as history:
+                    if versions is None:
+                        shutil.copy2(result_abs, result_tmp)
+                        history["bytes"] = saved["bytes"]
+                        result_suffix = ".nii.gz"
+                    else:
+                        history["bytes"] = _save_history_result(
+                            result_tmp, manifest, iteration_entry, nii, label_value, versions,
+                        )
+                        result_suffix = ".fbmk"
+                    annot_tmp.write_bytes(annot_data)
+                BYTES_WRITTEN.inc(history["bytes"] + len(annot_data), kind="ai_history")
+                with timer.stage("manifest"):
+                    manager.record_iteration(session_id, ml_id, _RESULT_FILENAME, iteration_entry, {
+                        "annotation_path": (annot_tmp, "annotations", annot_suffix),
+                        "result_path": (result_tmp, "result", result_suffix),
+                    })
+            finally:
+                annot_tmp.unlink(missing_ok=True)
+                result_tmp.unlink(missing_ok=True)
         else:
-            manager.record_inference(session_id, ml_id, result_rel)
+            with timer.stage("manifest"):
+                manager.record_inference(session_id, ml_id, _RESULT_FILENAME)
 
-        return {
-            "success": True,
-            "ml_id": ml_id,
-            "result_path": result_rel,
-            "label_value": label_value,
-        }
+    def _save_history_result(
+        path: Path,
+        manifest: dict[str, Any],
+        iteration_entry: dict[str, Any],
+        nii,
+        label_value: int,
+        versions: tuple[Any, ...],
+    ) -> int:
+        """Store an iteration's result at `path` as an encoded mask, a delta when possible.
+
+        The delta base is the previous result this worker produced; it is only
+        used if that result is recorded in the history, which is then named
+        in `result_base` (see `mask_codec.py expand`). Iterations are only
+        ever appended, so a base found in `manifest` is still there when the
+        iteration is recorded.
+        """
+        import numpy as np
+        from mask_codec import encode_mask, is_delta
+
+        version, base_version, base_bits = versions
+        base_iteration = next(
+            (it["iteration"] for it in reversed(manifest.get("iterations") or [])
+             if base_version is not None and it.get("result_version") == base_version),
+            None,
+        )
+        payload = encode_mask(
+            np.asanyarray(nii.dataobj), nii.affine, label_value,
+            base=None if base_iteration is None else base_bits,
+        )
+        path.write_bytes(payload)
+        iteration_entry["result_version"] = version
+        if is_delta(payload):
+            iteration_entry["result_base"] = base_iteration
+        return len(payload)
+
+    def _persist_in_background(
+        session_id: str,
+        ml_id: str,
+        label_value: int,
+        nii,
+        timer: StageTimer,
+        versions: tuple[Any, ...] | None = None,
+        annotations: tuple[str, bytes, str] | None = None,
+    ) -> None:
+        try:
+            _persist(session_id, ml_id, label_value, nii, timer, versions, annotations)
+        except Exception:
+            logger.exception(f"Failed to save AI result for session {session_id}")
+        timer.log(logger, "ai_inference_timing")
+
+    def _infer(
+        session_id: str,
+        ml_id: str,
+        label_value: int,
+        timer: StageTimer,
+        inline: bool,
+        since: str | None = None,
+    ) -> dict[str, Any]:
+        """Run one inference job (on a scheduler worker) and persist its result.
+
+        With `inline`, the mask is returned encoded and the NIfTI is written
+        afterwards by the result writer. If the caller holds the previous
+        result (its version is `since`), only the changed voxels are sent.
+        """
+        import numpy as np
+        from mask_codec import encode_mask, is_delta, mask_bits
+        from ml_inference import run_inference  # lazy; only when AI is enabled
+
+        # Held until the result is queued for writing, so that a newer click
+        # on the same session cannot be overtaken by this one.
+        with manager.lease(session_id):
+            # Re-read: the session may have changed while the job was queued.
+            session_dir, manifest = manager.find_by_id(session_id)
+            annotations = None
+            if manager.enable_history:
+                annotations = _snapshot_annotations(session_dir, manifest)
+            cache_entry = manager.touch(session_id)
+            try:
+                nii, _affine = run_inference(
+                    session_id=session_id,
+                    ml_id=ml_id,
+                    label_value=label_value,
+                    cache_entry=cache_entry,
+                    session_dir=session_dir,
+                    manifest=manifest,
+                    data_dir=manager.data_dir,
+                    models_dir=models_dir,
+                    timer=timer,
+                    preproc_cache=preproc_cache,
+                    memory_budget=inference_memory_bytes,
+                    batcher=batcher,
+                    registry=registry,
+                )
+                manager.publish(session_id, cache_entry)
+                # Remember this result as the base for the next delta.
+                base_version, base_bits = cache_entry.result_version, cache_entry.last_mask
+                version = bits = None
+                if inline or manager.history_deltas:
+                    version = uuid.uuid4().hex[:16]
+                    bits = mask_bits(np.asanyarray(nii.dataobj))
+                cache_entry.result_version, cache_entry.last_mask = version, bits
+            finally:
+                manager.settle(session_id)
+
+            result: dict[str, Any] = {
+                "success": True,
+                "ml_id": ml_id,
+                "result_path": _RESULT_FILENAME,
+                "label_value": label_value,
+                "result_version": version,
+            }
+            versions = None
+            if manager.enable_history and manager.history_deltas:
+                versions = (version, base_version, base_bits)
+            # Results are written by a single thread, so they land in the
+            # order they were computed.
+            if inline:
+                with timer.stage("encode") as encoded:
+                    result["mask"] = encode_mask(
+                        np.asanyarray(nii.dataobj), nii.affine, label_value,
+                        base=base_bits if since is not None and since == base_version else None,
+                    )
+                    encoded["bytes"] = len(result["mask"])
+                    encoded["delta"] = is_delta(result["mask"])
+                if encoded["delta"]:
+                    result["result_base"] = since
+                result_writer.submit(
+                    _persist_in_background, session_id, ml_id, label_value, nii, timer, versions,
+                    annotations,
+                )
+            else:
+                result_writer.submit(
+                    _persist, session_id, ml_id, label_value, nii, timer, versions, annotations,
+                ).result()
+
+        INFERENCE_SECONDS.observe(timer.total_ms() / 1000.0, ml_id=ml_id)
+        if not inline:
+            timer.log(logger, "ai_inference_timing")
+        return result
+
+    def _model_limit(model: dict[str, Any]) -> int | None:
+        config = model.get("config") if isinstance(model.get("config"), dict) else {}
+        limit = (config.get("inference") or {}).get("max_concurrency", model_concurrency)
+        return limit if limit and limit > 0 else None
+
+    @router.post("/session/{session_id}/infer/{ml_id}")
+    def session_infer(
+        session_id: str,
+        ml_id: str,
+        response: Response,
+        request: InferRequest | None = None,
+        wait: bool = Query(True),
+        since: str | None = Query(None),
+        accept: str | None = Header(None),
+    ):
+        """Queue an inference. With `wait=false`, return 202 and a job to poll;
+        otherwise wait up to `infer_wait_timeout` seconds, then answer 504
+        with the job to poll in Location.
+
+        Clients that accept `application/x-freebrowse-mask` get the result
+        mask inline (see mask_codec.py) instead of a JSON body pointing at
+        the saved NIfTI. Its X-Result-Version can be passed back as `since`
+        on the next request to receive only the voxels that changed; the
+        response then carries X-Result-Base. If the server no longer holds
+        that result, the full mask is sent instead.
+        """
+        from mask_codec import MASK_MEDIA_TYPE  # lazy; numpy is only needed with AI
+
+        _require_enabled()
+        _session_dir, manifest = manager.find_by_id(session_id)
+        model = _require_ml_id(ml_id)
+        if not manifest.get("volume_path"):
+            raise HTTPException(status_code=400, detail="Session has no volume set")
+        if not manifest.get("annotation_path"):
+            raise HTTPException(status_code=400, detail="Session has no annotations set")
+        label_value = 1 if request is None else max(0, min(255, request.label_value))
+        inline = wait and MASK_MEDIA_TYPE in (accept or "")
+
+        timer = StageTimer(session_id=session_id, ml_id=ml_id)
+        job = scheduler.submit(Job(
+            session_id,
+            ml_id,
+            run=lambda: _infer(session_id, ml_id, label_value, timer, inline, since),
+            coalesce_key=(ml_id, label_value, inline, since),
+            model_limit=_model_limit(model),
+            timer=timer,
+        ))
+        if not wait:
+            response.status_code = 202
+            response.headers["Location"] = f"/ai/job/{job.job_id}"
+            return job.describe()
+
+        try:
+            done = job.wait(infer_wait_timeout)
+        except TimeoutError:
+            # The job keeps running; its result can still be polled.
+            raise HTTPException(
+                status_code=504,
+                detail=f"Inference did not finish within {infer_wait_timeout:g}s",
+                headers={"Location": f"/ai/job/{job.job_id}"},
+            )
+        server_timing = done.timer.server_timing()
+        if done is not job:
+            server_timing += ", coalesced"  # answered by a newer request's job
+        result = dict(done.result)
+        mask = result.pop("mask", None)
+        if mask is not None:
+            headers = {
+                "Server-Timing": server_timing,
+                "X-Result-Path": result["result_path"],
+                "X-Result-Version": result["result_version"],
+            }
+            if result.get("result_base"):
+                headers["X-Result-Base"] = result["result_base"]
+            return Response(content=mask, media_type=MASK_MEDIA_TYPE, headers=headers)
+        response.headers["Server-Timing"] = server_timing
+        return result
+
+    @router.get("/job/{job_id}")
+    def job_status(job_id: str):
+        _require_enabled()
+        job = scheduler.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+        return job.describe()
 
     return router
@@ -0,0 +1,125 @@
+"""Micro-batching of forward passes across concurrent inference jobs.
+
+When several sessions run the same model at once (AI_INFERENCE_CONCURRENCY
+above 1), each job would otherwise pay for its own forward pass and leave
+the GPU underused between them. With ENABLE_AI_BATCHING, the model call of
+each job goes through a `MicroBatcher`:
+
+- Calls for the same model with the same input shape join one batch. The
+  first caller leads it: it waits up to `window_ms` for others, stacks the
+  inputs along the batch axis, runs the model once and hands every caller
+  its own slice of the output.
+- The leader only waits while another job for the same model is running
+  and could still join, so a single user never pays the window.
+- A batch closes as soon as it holds `max_batch` inputs. A model can lower
+  that with `inference.max_batch` in its config.yml (1 turns batching off,
+  e.g. for models whose activations do not leave room for several volumes).
+
+Inputs only match when their padded shapes do: whole volumes of the same
+size, or tiles of the same tile size (see tiled_inference.py). ROI crops
+vary with the prompts and rarely batch.
+"""
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from metrics import INFERENCE_BATCH_SIZE
+
+
+class _Batch:
+    def __init__(self):
+        self.inputs: list[Any] = []
+        self.outputs: list[Any] | None = None
+        self.error: BaseException | None = None
+        self.closed = False
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """Groups concurrent model calls with the same model and input shape."""
+
+    def __init__(self, max_batch: int = 4, window_ms: float = 5.0):
+        self.max_batch = max(1, max_batch)
+        self.window = max(0.0, window_ms) / 1000.0
+        self._cond = threading.Condition()
+        self._open: dict[tuple, _Batch] = {}
+        self._active: dict[str, int] = {}
+
+    @contextmanager
+    def active(self, ml_id: str) -> Iterator[None]:
+        """Mark a job that is about to call `ml_id`, so that leaders wait for it."""
+        with self._cond:
+            self._active[ml_id] = self._active.get(ml_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active[ml_id] -= 1
+                if not self._active[ml_id]:
+                    del self._active[ml_id]
+                self._cond.notify_all()
+
+    def forward(
+        self,
+        ml_id: str,
+        model: Callable[[Any], Any],
+        x: Any,
+        max_batch: int | None = None,
+    ) -> tuple[Any, int]:
+        """Run `model` on `x` (batch size 1), possibly together with other calls.
+
+        Returns the output for `x` and the size of the batch it ran in.
+        """
+        import torch  # lazy; only the inference workers need it
+
+        limit = min(self.max_batch, max_batch or self.max_batch)
+        if limit <= 1:
+            with torch.no_grad():
+                return model(x), 1
+        key = (ml_id, tuple(x.shape), x.dtype, x.device)
+        with self._cond:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = _Batch()
+            index = len(batch.inputs)
+            batch.inputs.append(x)
+            if len(batch.inputs) >= limit:
+                self._close(key, batch)
+            self._cond.notify_all()
+            if leader:
+                deadline = time.monotonic() + self.window
+                while not batch.closed:
+                    # Wait only for jobs of this model that have not joined yet.
+                    expected = min(limit, self._active.get(ml_id, 0))
+                    remaining = deadline - time.monotonic()
+                    if len(batch.inputs) >= expected or remaining <= 0:
+                        self._close(key, batch)
+                        break
+                    self._cond.wait(remaining)
+
+        if leader:
+            size = len(batch.inputs)
+            try:
+                with torch.no_grad():
+                    stacked = batch.inputs[0] if size == 1 else torch.cat(batch.inputs)
+                    output = model(stacked)
+                batch.outputs = [output[i:i + 1] for i in range(size)]
+            except BaseException as e:
+                batch.error = e
+            finally:
+                batch.inputs = []
+                batch.done.set()
+            INFERENCE_BATCH_SIZE.observe(size, ml_id=ml_id)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.outputs[index], len(batch.outputs)
+
+    def _close(self, key: tuple, batch: _Batch) -> None:
+        batch.closed = True
+        if self._open.get(key) is batch:
+            del self._open[key]
@@ -0,0 +1,430 @@
+"""Content-addressed store for saved volumes under DATA_DIR/.blobs.
+
+Every volume written through the save and upload endpoints is stored once,
+as `.blobs/<sha256[:2]>/<sha256>`, and reflinked to the path the client
+asked for, so the path shares the blob's extents and saving the same bytes
+again (another scene, another AI session) costs no extra space. User paths
+are never hard links to a blob: each is its own writable inode, so in-place
+writes and mtime-keyed caches of one path cannot affect another. Blob files
+themselves are read-only.
+
+Deduplication therefore only works on filesystems with reflinks (btrfs,
+XFS with reflink=1). Elsewhere (ext4, NFS) every save would be written
+twice, so the server checks `supports_reflinks` and leaves the store off.
+
+A blob's reference count is the number of DATA_DIR paths it was linked to
+that still hold those bytes, plus paths still hard-linked to it (left by
+older versions of the store), plus the number of NVD documents that point
+at it by hash (`data/blobs/<sha256>/<name>` URLs, as written by
+`nvd-create.py --blob-store`). Path and document references are tracked in
+a small SQLite database. A path reference lapses once the file's mtime or
+size no longer match the linked copy (it was overwritten or deleted);
+`collect_garbage` drops lapsed references and rescans the documents before
+deleting blobs nothing refers to.
+
+Clients can ask whether a digest is already stored (HEAD /data/blobs/<sha256>)
+and link it to a new path without sending the bytes again.
+
+Run as a CLI:
+    python blobs.py gc DATA_DIR [--grace-seconds N]
+    python blobs.py stats DATA_DIR
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+from collections.abc import AsyncIterator, Callable, Iterable
+from pathlib import Path
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from metrics import BYTES_WRITTEN
+from uploads import normalize_volume_filename, resolve_target
+
+logger = logging.getLogger(__name__)
+
+BLOB_DIRNAME = ".blobs"
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+_BLOB_URL_RE = re.compile(r"data/blobs/([0-9a-f]{64})")
+_TMP_DIRNAME = "tmp"
+_REFS_FILENAME = "refs.sqlite"
+_READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+_FICLONE = 0x40049409  # Linux ioctl: share the source's extents (btrfs, XFS)
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS document_refs (
+    owner TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (owner, digest)
+);
+CREATE TABLE IF NOT EXISTS path_refs (
+    path TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS path_refs_digest ON path_refs (digest);
+"""
+
+
+class LinkBlobRequest(BaseModel):
+    filename: str
+
+
+def document_blob_refs(document) -> set[str]:
+    """Digests referenced by `data/blobs/<sha256>` URLs anywhere in an NVD."""
+    return set(_BLOB_URL_RE.findall(json.dumps(document)))
+
+
+def _clone_file(source: Path, dest: Path) -> None:
+    """Copy `source` to a new file `dest`, as a reflink where possible."""
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def supports_reflinks(directory: Path) -> bool:
+    """Whether files in `directory` can share extents (FICLONE succeeds)."""
+    try:
+        with tempfile.TemporaryFile(dir=directory) as src, tempfile.TemporaryFile(dir=directory) as dst:
+            src.write(b"\0" * 4096)
+            src.flush()
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def _hash_file(path: Path) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class BlobStore:
+    """sha256-keyed blob files plus the links and references that keep them."""
+
+    def __init__(self, data_dir: Path):
+        self.data_dir = data_dir
+        self.root = data_dir / BLOB_DIRNAME
+        (self.root / _TMP_DIRNAME).mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.root / _REFS_FILENAME), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    # ----- lookup -----
+    def path(self, digest: str) -> Path:
+        digest = digest.lower()
+        if not _DIGEST_RE.match(digest):
+            raise HTTPException(status_code=400, detail=f"Invalid sha256 digest: {digest}")
+        return self.root / digest[:2] / digest
+
+    def exists(self, digest: str) -> bool:
+        return self.path(digest).is_file()
+
+    def refcount(self, digest: str) -> int:
+        try:
+            links = self.path(digest).stat().st_nlink - 1
+        except FileNotFoundError:
+            return 0
+        with self._lock:
+            (docs,) = self._db.execute(
+                "SELECT COUNT(*) FROM document_refs WHERE digest = ?", (digest,),
+            ).fetchone()
+            rows = self._db.execute(
+                "SELECT path, digest, mtime_ns, size FROM path_refs WHERE digest = ?", (digest,),
+            ).fetchall()
+        return links + docs + len(self._live_path_refs(rows))
+
+    def _rel(self, target: Path) -> str:
+        try:
+            return str(target.relative_to(self.data_dir.resolve()))
+        except ValueError:
+            return str(target)
+
+    def _live_path_refs(self, rows) -> dict[str, str]:
+        """Path -> digest for the `path_refs` rows whose file is unchanged
+        since it was linked; the other rows are deleted."""
+        live: dict[str, str] = {}
+        lapsed = []
+        for path, digest, mtime_ns, size in rows:
+            try:
+                st = (self.data_dir / path).stat()
+            except OSError:
+                st = None
+            if st is not None and (st.st_mtime_ns, st.st_size) == (mtime_ns, size):
+                live[path] = digest
+            else:
+                lapsed.append((path, mtime_ns, size))
+        if lapsed:
+            with self._lock:
+                # Only rows not re-linked meanwhile.
+                self._db.executemany(
+                    "DELETE FROM path_refs WHERE path = ? AND mtime_ns = ? AND size = ?", lapsed,
+                )
+                self._db.commit()
+        return live
+
+    # ----- writes -----
+    def _open_temp(self):
+        fd, tmp = tempfile.mkstemp(dir=self.root / _TMP_DIRNAME)
+        return os.fdopen(fd, "wb"), Path(tmp)
+
+    def _adopt(self, tmp: Path, digest: str) -> Path:
+        """Move a fully written temp file into place as blob `digest`."""
+        blob = self.path(digest)
+        if blob.exists():
+            tmp.unlink(missing_ok=True)
+            return blob
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        os.chmod(tmp, _READ_ONLY)
+        os.replace(tmp, blob)
+        BYTES_WRITTEN.inc(blob.stat().st_size, kind="blob")
+        logger.debug(f"Blob store: added {digest}")
+        return blob
+
+    def put_bytes(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        if self.exists(digest):
+            return digest
+        f, tmp = self._open_temp()
+        try:
+            with f:
+                f.write(data)
+            self._adopt(tmp, digest)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        return digest
+
+    def put_file(self, source: Path) -> str:
+        """Move `source` (on the same filesystem) into the store."""
+        digest = _hash_file(source)
+        tmp = self.root / _TMP_DIRNAME / f"{digest}.{os.getpid()}.{threading.get_ident()}"
+        os.replace(source, tmp)
+        self._adopt(tmp, digest)
+        return digest
+
+    async def put_stream(
+        self,
+        chunks: AsyncIterator[bytes],
+        expected_sha256: str | None = None,
+    ) -> tuple[str, int]:
+        """Store an async byte stream, hashing while writing; return (digest, size)."""
+        f, tmp = await run_in_threadpool(self._open_temp)
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with f:
+                async for chunk in chunks:
+                    if not chunk:
+                        continue
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    await run_in_threadpool(f.write, chunk)
+            digest = hasher.hexdigest()
+            if expected_sha256 and expected_sha256.lower() != digest:
+                raise HTTPException(status_code=422, detail="Checksum mismatch for upload")
+            await run_in_threadpool(self._adopt, tmp, digest)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        return digest, size
+
+    def link(self, digest: str, target: Path) -> None:
+        """Atomically make `target` a copy of blob `digest`.
+
+        The copy is a reflink (sharing the blob's extents) where the
+        filesystem supports it, a plain copy elsewhere. Either way `target`
+        is its own writable inode with a fresh mtime, so in-place writes and
+        mtime-keyed caches of other paths are unaffected.
+        """
+        blob = self.path(digest)
+        if not blob.is_file():
+            raise HTTPException(status_code=404, detail=f"Unknown blob: {digest}")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f".blob-{digest[:16]}.{os.getpid()}.{threading.get_ident()}")
+        try:
+            _clone_file(blob, tmp)
+            st = tmp.stat()
+            os.replace(tmp, target)
+        finally:
+            tmp.unlink(missing_ok=True)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO path_refs (path, digest, mtime_ns, size) VALUES (?, ?, ?, ?)",
+                (self._rel(target), digest.lower(), st.st_mtime_ns, st.st_size),
+            )
+            self._db.commit()
+
+    def set_document_refs(self, owner: str, digests: Iterable[str]) -> None:
+        """Replace the set of blobs referenced by the document at `owner`."""
+        with self._lock:
+            self._db.execute("DELETE FROM document_refs WHERE owner = ?", (owner,))
+            self._db.executemany(
+                "INSERT OR IGNORE INTO document_refs (owner, digest) VALUES (?, ?)",
+                [(owner, d) for d in digests],
+            )
+            self._db.commit()
+
+    # ----- maintenance -----
+    def iter_blobs(self):
+        for shard in sorted(self.root.iterdir()):
+            if shard.is_dir() and len(shard.name) == 2:
+                for blob in sorted(shard.iterdir()):
+                    if _DIGEST_RE.match(blob.name):
+                        yield blob
+
+    def _all_path_refs(self) -> dict[str, str]:
+        with self._lock:
+            rows = self._db.execute("SELECT path, digest, mtime_ns, size FROM path_refs").fetchall()
+        return self._live_path_refs(rows)
+
+    def stats(self) -> dict[str, int]:
+        paths_per_blob: dict[str, int] = {}
+        for digest in self._all_path_refs().values():
+            paths_per_blob[digest] = paths_per_blob.get(digest, 0) + 1
+        blobs = linked = stored_bytes = logical_bytes = 0
+        for blob in self.iter_blobs():
+            st = blob.stat()
+            blobs += 1
+            stored_bytes += st.st_size
+            links = st.st_nlink - 1 + paths_per_blob.get(blob.name, 0)
+            linked += links
+            logical_bytes += st.st_size * max(links, 1)
+        return {
+            "blobs": blobs,
+            "links": linked,
+            "stored_bytes": stored_bytes,
+            "logical_bytes": logical_bytes,
+        }
+
+    def collect_garbage(self, documents: Iterable[str], grace_seconds: float = 86400) -> int:
+        """Delete unreferenced blobs older than `grace_seconds`; return the count.
+
+        `documents` are the NVD paths (relative to DATA_DIR) to rescan for
+        blob references first, so documents written outside the server are
+        accounted for too.
+        """
+        refs: dict[str, set[str]] = {}
+        for rel in documents:
+            try:
+                with open(self.data_dir / rel) as f:
+                    refs[rel] = document_blob_refs(json.load(f))
+            except (OSError, ValueError) as exc:
+                logger.warning(f"Blob store: cannot scan {rel}: {exc}")
+        with self._lock:
+            self._db.execute("DELETE FROM document_refs")
+            self._db.executemany(
+                "INSERT OR IGNORE INTO document_refs (owner, digest) VALUES (?, ?)",
+                [(owner, d) for owner, digests in refs.items() for d in digests],
+            )
+            self._db.commit()
+        referenced = set().union(*refs.values()) if refs else set()
+        referenced.update(self._all_path_refs().values())
+
+        cutoff = time.time() - grace_seconds
+        removed = 0
+        for blob in self.iter_blobs():
+            st = blob.stat()
+            if st.st_nlink > 1 or blob.name in referenced or st.st_mtime > cutoff:
+                continue
+            blob.unlink()
+            removed += 1
+        for tmp in (self.root / _TMP_DIRNAME).iterdir():
+            if tmp.stat().st_mtime <= cutoff:
+                tmp.unlink(missing_ok=True)
+        if removed:
+            logger.info(f"Blob store: removed {removed} unreferenced blob(s)")
+        return removed
+
+
+def build_router(
+    *,
+    store: BlobStore,
+    data_dir: Path,
+    on_link: Callable[[Path], None] | None = None,
+) -> APIRouter:
+    """Build the /data/blobs/* router."""
+    router = APIRouter(prefix="/data/blobs")
+
+    def _blob_response(digest: str, media_type: str) -> FileResponse:
+        blob = store.path(digest)
+        if not blob.is_file():
+            raise HTTPException(status_code=404, detail=f"Unknown blob: {digest}")
+        return FileResponse(blob, media_type=media_type, headers={
+            "ETag": f'"{digest.lower()}"',
+            "Cache-Control": "public, max-age=31536000, immutable",
+        })
+
+    @router.api_route("/{digest}", methods=["GET", "HEAD"])
+    def blob_get(digest: str):
+        return _blob_response(digest, "application/octet-stream")
+
+    @router.get("/{digest}/{name}")
+    def blob_get_named(digest: str, name: str):
+        # The name only carries the file type for viewers that sniff extensions.
+        media_type = "application/gzip" if name.endswith(".gz") else "application/octet-stream"
+        return _blob_response(digest, media_type)
+
+    @router.post("/{digest}/link")
+    def blob_link(digest: str, request: LinkBlobRequest):
+        filename = normalize_volume_filename(request.filename)
+        target = resolve_target(data_dir, filename)
+        store.link(digest, target)
+        if on_link is not None:
+            on_link(target)
+        logger.info(f"Volume linked from blob {digest[:12]} to {target}")
+        return {
+            "success": True,
+            "message": f"Volume saved successfully to {filename}",
+            "file_path": str(target.relative_to(data_dir.resolve())),
+            "sha256": digest.lower(),
+        }
+
+    return router
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Maintain the DATA_DIR blob store.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_gc = sub.add_parser("gc", help="Delete blobs nothing refers to")
+    p_gc.add_argument("data_dir", type=Path)
+    p_gc.add_argument("--grace-seconds", type=float, default=86400,
+                      help="Keep unreferenced blobs younger than this (default: 1 day)")
+    p_stats = sub.add_parser("stats", help="Print blob counts and sizes")
+    p_stats.add_argument("data_dir", type=Path)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    store = BlobStore(args.data_dir)
+    if args.command == "gc":
+        documents = [
+            str(p.relative_to(args.data_dir)) for p in args.data_dir.rglob("*.nvd")
+            if BLOB_DIRNAME not in p.parts
+        ]
+        store.collect_garbage(documents, args.grace_seconds)
+    print(json.dumps(store.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
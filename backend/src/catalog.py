@@ -0,0 +1,301 @@
+"""Indexed listing of DATA_DIR backing GET /data/nvd and GET /data/vol.
+
+DATA_DIR is walked once and then kept current by a background thread that
+re-stats every directory on a fixed interval and only re-lists the ones whose
+mtime changed. Directory mtimes change whenever an entry is added, removed or
+renamed directly inside them, so a refresh over an unchanged tree costs one
+stat() per directory instead of one readdir() per directory per pattern.
+
+Listings are served from the in-memory index, filtered by glob pattern and
+optional prefix/subdirectory, and tagged with a content-derived ETag so that
+clients can revalidate with If-None-Match. Re-listing a directory also records
+the mtime and size of its files; they are part of the ETag and version
+per-file URLs (see `file_stat`). Writes through a rename (as the server's
+own are) change the directory mtime; a file rewritten in place is only
+noticed once something else in its directory changes. Files under derived-data
+directories (pyramid levels, thumbnails, metadata, upload staging, the blob
+store) are indexed but not listed; they are looked up per file with
+`sidecar_files`.
+"""
+import fnmatch
+import hashlib
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Directories holding data derived from (or staged for) the listed files.
+DERIVED_DIRNAMES = frozenset({
+    ".blobs", ".meta", ".preprocessed", ".pyramids", ".session-state", ".thumbnails",
+    ".uploads",
+})
+# Derived directories whose contents show up in listing entries (and so in ETags).
+SIDECAR_DIRNAMES = frozenset({".pyramids"})
+
+
+@dataclass
+class _DirEntry:
+    mtime_ns: int
+    files: tuple[str, ...]
+    subdirs: tuple[str, ...]
+    # (mtime_ns, size) per file name, as of the listing.
+    stats: dict[str, tuple[int, int]]
+
+
+@dataclass
+class CatalogPage:
+    total: int
+    paths: list[str]
+    etag: str
+
+
+def _join(parent: str, name: str) -> str:
+    return f"{parent}/{name}" if parent else name
+
+
+def _scan_dir(path: Path, mtime_ns: int) -> _DirEntry:
+    files: list[str] = []
+    subdirs: list[str] = []
+    stats: dict[str, tuple[int, int]] = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    st = entry.stat()
+                    files.append(entry.name)
+                    stats[entry.name] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                continue
+    return _DirEntry(mtime_ns=mtime_ns, files=tuple(sorted(files)),
+                     subdirs=tuple(sorted(subdirs)), stats=stats)
+
+
+class DataCatalog:
+    """In-memory index of every file under `root`, refreshed incrementally.
+
+    The index maps each directory (relative posix path, "" for the root) to
+    the mtime it was listed at plus its files and subdirectories. Filtered
+    listings are memoized per pattern set until the index changes.
+    """
+
+    def __init__(self, root: Path, refresh_seconds: float = 30.0):
+        self.root = root
+        self.refresh_seconds = refresh_seconds
+        self._dirs: dict[str, _DirEntry] = {}
+        self._listings: dict[tuple[str, ...], tuple[list[str], str]] = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    # ----- lifecycle -----
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="data-catalog", daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except Exception as exc:
+                logger.error(f"Data catalog refresh failed: {exc}")
+            finally:
+                self._ready.set()
+            if self._stop.wait(self.refresh_seconds):
+                return
+
+    def _ensure_ready(self) -> None:
+        if self._ready.is_set():
+            return
+        if self._thread is None:
+            self.refresh()
+            self._ready.set()
+        else:
+            self._ready.wait()
+
+    # ----- indexing -----
+    def refresh(self) -> bool:
+        """Walk the tree, re-listing only directories whose mtime changed.
+
+        Returns True when the index changed.
+        """
+        with self._refresh_lock:
+            old_dirs = self._dirs
+            new_dirs: dict[str, _DirEntry] = {}
+            seen: set[tuple[int, int]] = set()
+            changed = False
+            rescanned = 0
+            stack = [""]
+            while stack:
+                rel = stack.pop()
+                path = self.root / rel if rel else self.root
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                # Symlinked directories are followed (as Path.rglob did), but
+                # each physical directory is indexed only once.
+                inode = (st.st_dev, st.st_ino)
+                if inode in seen:
+                    continue
+                seen.add(inode)
+                entry = old_dirs.get(rel)
+                if entry is None or entry.mtime_ns != st.st_mtime_ns:
+                    try:
+                        entry = _scan_dir(path, st.st_mtime_ns)
+                    except OSError as exc:
+                        logger.warning(f"Data catalog: cannot list {path}: {exc}")
+                        continue
+                    changed = changed or old_dirs.get(rel) != entry
+                    rescanned += 1
+                new_dirs[rel] = entry
+                stack.extend(_join(rel, name) for name in entry.subdirs)
+
+            changed = changed or new_dirs.keys() != old_dirs.keys()
+            with self._lock:
+                self._dirs = new_dirs
+                if changed:
+                    self._listings.clear()
+            if rescanned:
+                logger.debug(
+                    f"Data catalog: {len(new_dirs)} directories, "
+                    f"{rescanned} re-listed, changed={changed}"
+                )
+            return changed
+
+    def notify_changed(self, path: Path) -> None:
+        """Re-list the directories leading to `path` so a file just written
+        by the server shows up without waiting for the next refresh."""
+        try:
+            rel_parent = path.resolve().parent.relative_to(self.root.resolve())
+        except (OSError, ValueError):
+            return
+        parts = [] if str(rel_parent) == "." else list(rel_parent.parts)
+        with self._refresh_lock:
+            dirs = dict(self._dirs)
+            rel = ""
+            for depth in range(len(parts) + 1):
+                if depth:
+                    rel = _join(rel, parts[depth - 1])
+                dir_path = self.root / rel if rel else self.root
+                try:
+                    dirs[rel] = _scan_dir(dir_path, os.stat(dir_path).st_mtime_ns)
+                except OSError:
+                    break
+            with self._lock:
+                self._dirs = dirs
+                self._listings.clear()
+
+    # ----- queries -----
+    def _listing(self, patterns: tuple[str, ...]) -> tuple[list[str], str]:
+        with self._lock:
+            cached = self._listings.get(patterns)
+            if cached is not None:
+                return cached
+            dirs = self._dirs
+        paths: list[str] = []
+        versions: list[str] = []
+        derived: list[str] = []
+        for rel, entry in dirs.items():
+            parts = rel.split("/")
+            if rel and not DERIVED_DIRNAMES.isdisjoint(parts):
+                # Not listed, but sidecars are part of the digest since
+                # listing entries expose them.
+                if not SIDECAR_DIRNAMES.isdisjoint(parts):
+                    derived.extend(_join(rel, name) for name in entry.files)
+                continue
+            for name in entry.files:
+                if any(fnmatch.fnmatchcase(name, p) for p in patterns):
+                    path = _join(rel, name)
+                    paths.append(path)
+                    mtime_ns, size = entry.stats[name]
+                    versions.append(f"{path}|{mtime_ns}|{size}")
+        paths.sort()
+        versions.sort()
+        derived.sort()
+        digest = hashlib.sha1("\n".join(versions + derived).encode("utf-8")).hexdigest()
+        with self._lock:
+            if self._dirs is dirs:
+                self._listings[patterns] = (paths, digest)
+        return paths, digest
+
+    def changed_files(self, patterns: list[str], seen: dict[str, int]) -> list[str]:
+        """Listed files matching `patterns` in directories whose mtime is not
+        the one recorded in `seen` (relative dir -> mtime_ns).
+
+        `seen` is updated in place, so passing the same dict again returns
+        only files in directories re-listed since. Files rewritten in place
+        do not change their directory's mtime and are not reported.
+        """
+        self._ensure_ready()
+        with self._lock:
+            dirs = self._dirs
+        paths: list[str] = []
+        for rel, entry in dirs.items():
+            if rel and not DERIVED_DIRNAMES.isdisjoint(rel.split("/")):
+                continue
+            if seen.get(rel) == entry.mtime_ns:
+                continue
+            seen[rel] = entry.mtime_ns
+            for name in entry.files:
+                if any(fnmatch.fnmatchcase(name, p) for p in patterns):
+                    paths.append(_join(rel, name))
+        for rel in seen.keys() - dirs.keys():
+            del seen[rel]
+        paths.sort()
+        return paths
+
+    def file_stat(self, rel_path: str) -> tuple[int, int] | None:
+        """(mtime_ns, size) of an indexed file as of its directory's last listing."""
+        parent, _, name = rel_path.rpartition("/")
+        with self._lock:
+            entry = self._dirs.get(parent)
+        return entry.stats.get(name) if entry is not None else None
+
+    def sidecar_files(self, rel_path: str, dirname: str) -> list[str]:
+        """List files stored for `rel_path` under `<parent>/<dirname>/<name>/`."""
+        parent, _, name = rel_path.rpartition("/")
+        with self._lock:
+            entry = self._dirs.get(_join(_join(parent, dirname), name))
+        return list(entry.files) if entry is not None else []
+
+    def query(
+        self,
+        patterns: list[str],
+        prefix: str | None = None,
+        subdir: str | None = None,
+        offset: int = 0,
+        limit: int | None = None,
+    ) -> CatalogPage:
+        """Return the sorted relative paths matching any of `patterns`.
+
+        `subdir` restricts results to files below that directory; `prefix`
+        restricts them to relative paths starting with that string. Both are
+        applied before `offset`/`limit` pagination.
+        """
+        self._ensure_ready()
+        paths, digest = self._listing(tuple(patterns))
+        if subdir:
+            base = subdir.strip("/") + "/"
+            paths = [p for p in paths if p.startswith(base)]
+        if prefix:
+            paths = [p for p in paths if p.startswith(prefix)]
+        total = len(paths)
+        end = None if limit is None else offset + limit
+        page = paths[offset:end]
+        key = f"{digest}|{subdir}|{prefix}|{offset}|{limit}"
+        etag = '"' + hashlib.sha1(key.encode("utf-8")).hexdigest() + '"'
+        return CatalogPage(total=total, paths=page, etag=etag)
@@ -0,0 +1,355 @@
+"""Accuracy checks of inference shortcuts against plain full-volume inference.
+
+    python inference_check.py roi MODELS_DIR ML_ID VOLUME ANNOTATIONS [--margin N]
+    python inference_check.py tiling MODELS_DIR ML_ID VOLUME ANNOTATIONS [--tile-size N]
+    python inference_check.py backend MODELS_DIR ML_ID [--backend NAME ...] [--shape D H W]
+    python inference_check.py precision MODELS_DIR ML_ID [--mode NAME ...] [--shape D H W]
+
+Runs a model on one volume with the prompts in ANNOTATIONS (an annotation
+NIfTI, or a session's clicks.json) twice per scenario, once on the whole
+volume and once with the shortcut, and prints one JSON line per scenario:
+Dice between the two masks, the number of voxels they disagree on, the
+largest logit difference where the shortcut actually ran the model, and the
+median timings. The ROI scenarios are the first click (no previous
+prediction) and a refinement step (previous logits from a full-volume run).
+
+`backend` compares execution backends (inference.backend, see
+model_backends.py) with the eager model on a synthetic volume with a
+positive and a negative click, or on VOLUME and ANNOTATIONS if given, and
+exits with status 1 if any backend drifts beyond --tolerance. Use it as the
+parity check before deploying a model with a non-eager backend.
+
+`precision` runs fixed synthetic click scenarios (a first click, a positive
+and a negative click, and a refinement on the previous fp32 prediction) in
+fp32 and in each reduced precision (inference.precision) and reports Dice,
+logit drift, speedup and the size of the quantized model; it exits with
+status 1 if any scenario falls below --min-dice.
+
+Run it on a few representative volumes before enabling a shortcut for a
+model in its config.yml.
+"""
+import argparse
+import json
+import logging
+import statistics
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+import torch
+
+from ml_inference import (
+    annotation_mask_to_pos_neg,
+    get_model,
+    load_model,
+    load_model_config,
+    pad_to_multiple,
+    predict_logits,
+    prepare_session_tensors,
+    roi_box,
+    roi_config,
+)
+from model_backends import ARTIFACTS, BACKENDS, PRECISIONS, prepare_backend
+from tiled_inference import plan_tiles, tiling_config
+
+
+def dice(a: np.ndarray, b: np.ndarray) -> float:
+    a, b = a.astype(bool), b.astype(bool)
+    total = int(a.sum()) + int(b.sum())
+    return 1.0 if total == 0 else 2.0 * int((a & b).sum()) / total
+
+
+def _timed(fn: Callable[[], torch.Tensor], repeat: int) -> tuple[torch.Tensor, float]:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return out, statistics.median(times)
+
+
+def compare(
+    reference: torch.Tensor,
+    candidate: torch.Tensor,
+    region: tuple[slice, ...] | None = None,
+) -> dict[str, Any]:
+    """Agreement of two logit volumes (optionally the drift inside `region` only)."""
+    ref_mask = (reference > 0).numpy()
+    cand_mask = (candidate > 0).numpy()
+    diff = (reference - candidate).abs()
+    if region is not None:
+        diff = diff[region]
+    return {
+        "dice": round(dice(ref_mask, cand_mask), 5),
+        "disagreeing_voxels": int((ref_mask != cand_mask).sum()),
+        "max_logit_drift": round(float(diff.max()), 5) if diff.numel() else 0.0,
+    }
+
+
+def load_inputs(volume: Path, annotations: Path):
+    artifacts = prepare_session_tensors(
+        {"volume_path": volume.name, "volume_path_root": "data"},
+        session_dir=volume.parent,
+        data_dir=volume.parent,
+    )
+    pos, neg = annotation_mask_to_pos_neg(
+        annotations.parent, {"annotation_path": annotations.name}, artifacts.ras_dims,
+    )
+    return artifacts, pad_to_multiple(pos, multiple=32), pad_to_multiple(neg, multiple=32)
+
+
+def synthetic_inputs(
+    shape: tuple[int, int, int],
+    pos_points: list[tuple[int, int, int]] | None = None,
+    neg_points: list[tuple[int, int, int]] | None = None,
+    seed: int = 0,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """A noisy volume with a bright sphere and click masks, padded to a
+    multiple of 32. By default, one positive click at the sphere's centre
+    and one negative click in the background."""
+    generator = torch.Generator().manual_seed(seed)
+    grid = torch.stack(torch.meshgrid(*[torch.arange(n, dtype=torch.float32) for n in shape], indexing="ij"))
+    centre = torch.tensor([n / 2 for n in shape]).view(3, 1, 1, 1)
+    radius = min(shape) / 5
+    sphere = ((grid - centre) ** 2).sum(0).sqrt() < radius
+    volume = 0.2 + 0.6 * sphere.float() + 0.1 * torch.rand(shape, generator=generator)
+    pos = torch.zeros(shape)
+    neg = torch.zeros(shape)
+    for point in pos_points if pos_points is not None else [tuple(n // 2 for n in shape)]:
+        pos[point] = 1
+    for point in neg_points if neg_points is not None else [tuple(n // 8 for n in shape)]:
+        neg[point] = 1
+    return tuple(pad_to_multiple(t, multiple=32) for t in (volume, pos, neg))
+
+
+def synthetic_scenarios(shape: tuple[int, int, int]) -> list[tuple[str, list, list, bool]]:
+    """(name, positive clicks, negative clicks, refines the previous scenario)."""
+    centre = tuple(n // 2 for n in shape)
+    inside = (centre[0] + min(shape) // 8, *centre[1:])
+    background = tuple(n // 8 for n in shape)
+    return [
+        ("first_click", [centre], [], False),
+        ("pos_neg", [centre], [background], False),
+        ("refine", [centre, inside], [background], True),
+    ]
+
+
+def load_eager(models_dir: Path, ml_id: str, device: torch.device) -> tuple[torch.nn.Module, dict]:
+    """The plain PyTorch model, bypassing the model cache and its backend."""
+    model_dir = models_dir / ml_id
+    config_file = model_dir / "config.yml"
+    config = load_model_config(config_file) if config_file.exists() else {}
+    return load_model(model_dir / "model.py", model_dir / "weights.pt", device), config
+
+
+def check_roi(args) -> int:
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model, config = get_model(args.ml_id, args.models_dir, device)
+    roi = roi_config(config, force=True)
+    if args.margin is not None:
+        roi["margin"] = args.margin
+    if args.max_fraction is not None:
+        roi["max_fraction"] = args.max_fraction
+    artifacts, pos, neg = load_inputs(args.volume, args.annotations)
+    volume, shape = artifacts.volume_tensor, artifacts.shape_before_pad
+
+    def run(prev: torch.Tensor | None, settings: dict | None) -> torch.Tensor:
+        return predict_logits(model, config, volume, pos, neg, prev, shape, device, roi=settings)
+
+    first_full = run(None, None)
+    for scenario, prev in (("first", None), ("refine", first_full)):
+        full, full_ms = _timed(lambda: run(prev, None), args.repeat)
+        cropped, roi_ms = _timed(lambda: run(prev, roi), args.repeat)
+        box = roi_box(
+            [pos, neg, None if prev is None else prev.gt(0)], tuple(volume.shape),
+            margin=roi["margin"], max_fraction=roi["max_fraction"],
+        )
+        region = None if box is None else tuple(
+            slice(b.start, min(b.stop, n)) for b, n in zip(box, shape)
+        )
+        print(json.dumps({
+            "scenario": scenario,
+            **roi,
+            "crop": None if box is None else [b.stop - b.start for b in box],
+            "volume": list(volume.shape),
+            **compare(full, cropped, region),
+            "full_ms": round(full_ms, 1),
+            "roi_ms": round(roi_ms, 1),
+            "speedup": round(full_ms / roi_ms, 2) if roi_ms else None,
+        }))
+    return 0
+
+
+def check_tiling(args) -> int:
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model, config = get_model(args.ml_id, args.models_dir, device)
+    tiling = dict(((config or {}).get("inference") or {}).get("tiling") or {}, enabled=True)
+    for key in ("tile_size", "overlap", "blend", "workers", "max_memory_mb"):
+        if getattr(args, key) is not None:
+            tiling[key] = getattr(args, key)
+    settings = tiling_config({**(config or {}), "inference": {"tiling": tiling}})
+    artifacts, pos, neg = load_inputs(args.volume, args.annotations)
+    volume, shape = artifacts.volume_tensor, artifacts.shape_before_pad
+    tiles = plan_tiles(tuple(volume.shape), settings)
+
+    def run(settings: dict | None) -> torch.Tensor:
+        return predict_logits(model, config, volume, pos, neg, None, shape, device, tiling=settings)
+
+    full, full_ms = _timed(lambda: run(None), args.repeat)
+    tiled, tiled_ms = _timed(lambda: run(settings), args.repeat)
+    print(json.dumps({
+        "tile_shape": None if tiles is None else [w.stop - w.start for w in tiles[0][0]],
+        "tiles": 0 if tiles is None else len(tiles[0]),
+        "workers": None if tiles is None else tiles[1],
+        "overlap": settings["overlap"],
+        "blend": settings["blend"],
+        "volume": list(volume.shape),
+        **compare(full, tiled),
+        "full_ms": round(full_ms, 1),
+        "tiled_ms": round(tiled_ms, 1),
+    }))
+    return 0
+
+
+def check_backend(args) -> int:
+    device = torch.device("cpu")
+    model, config = load_eager(args.models_dir, args.ml_id, device)
+    if args.volume is not None:
+        artifacts, pos, neg = load_inputs(args.volume, args.annotations)
+        volume, shape = artifacts.volume_tensor, artifacts.shape_before_pad
+    else:
+        shape = tuple(args.shape)
+        volume, pos, neg = synthetic_inputs(shape)
+
+    def run(runner) -> torch.Tensor:
+        return predict_logits(runner, config, volume, pos, neg, None, shape, device)
+
+    reference, eager_ms = _timed(lambda: run(model), args.repeat)
+    failed = False
+    for backend in args.backend or [b for b in BACKENDS if b != "eager"]:
+        row: dict[str, Any] = {"backend": backend, "volume": list(volume.shape)}
+        try:
+            runner = prepare_backend(model, config, args.models_dir / args.ml_id, device, backend)
+            run(runner)  # warm-up (compilation, graph optimisation)
+            logits, backend_ms = _timed(lambda: run(runner), args.repeat)
+        except Exception as e:
+            row["error"] = f"{type(e).__name__}: {e}"
+            failed = True
+        else:
+            row.update(compare(reference, logits))
+            row["passed"] = row["max_logit_drift"] <= args.tolerance
+            failed |= not row["passed"]
+            row.update(
+                eager_ms=round(eager_ms, 1),
+                backend_ms=round(backend_ms, 1),
+                speedup=round(eager_ms / backend_ms, 2) if backend_ms else None,
+            )
+        print(json.dumps(row))
+    return 1 if failed else 0
+
+
+def check_precision(args) -> int:
+    device = torch.device("cpu")
+    model, config = load_eager(args.models_dir, args.ml_id, device)
+    model_dir = args.models_dir / args.ml_id
+    shape = tuple(args.shape)
+    runners: dict[str, Any] = {}
+    failed = False
+    for mode in args.mode or PRECISIONS[1:]:
+        try:
+            runners[mode] = prepare_backend(model, config, model_dir, device, args.backend, mode)
+        except Exception as e:
+            print(json.dumps({"precision": mode, "error": f"{type(e).__name__}: {e}"}))
+            failed = True
+
+    previous = None
+    for scenario, pos_points, neg_points, refine in synthetic_scenarios(shape):
+        volume, pos, neg = synthetic_inputs(shape, pos_points, neg_points)
+        prev = previous if refine else None
+
+        def run(runner) -> torch.Tensor:
+            return predict_logits(runner, config, volume, pos, neg, prev, shape, device)
+
+        reference, fp32_ms = _timed(lambda: run(model), args.repeat)
+        previous = reference
+        for mode, runner in runners.items():
+            run(runner)  # warm-up
+            logits, mode_ms = _timed(lambda: run(runner), args.repeat)
+            row = {"scenario": scenario, "precision": mode, **compare(reference, logits)}
+            row["passed"] = row["dice"] >= args.min_dice
+            failed |= not row["passed"]
+            artifact = model_dir / ARTIFACTS.get(mode, "")
+            row.update(
+                fp32_ms=round(fp32_ms, 1),
+                precision_ms=round(mode_ms, 1),
+                speedup=round(fp32_ms / mode_ms, 2) if mode_ms else None,
+                model_mb=round(artifact.stat().st_size / 2**20, 2) if artifact.is_file() else None,
+            )
+            print(json.dumps(row))
+    return 1 if failed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare inference shortcuts with full-volume inference.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    roi = sub.add_parser("roi", help="ROI-cropped inference (inference.roi in config.yml)")
+    roi.add_argument("models_dir", type=Path)
+    roi.add_argument("ml_id")
+    roi.add_argument("volume", type=Path)
+    roi.add_argument("annotations", type=Path)
+    roi.add_argument("--margin", type=int, default=None, help="Override inference.roi.margin")
+    roi.add_argument("--max-fraction", type=float, default=None,
+                     help="Override inference.roi.max_fraction")
+    roi.add_argument("--repeat", type=int, default=3, help="Runs per timing (median)")
+    tiling = sub.add_parser("tiling", help="Sliding-window inference (inference.tiling in config.yml)")
+    tiling.add_argument("models_dir", type=Path)
+    tiling.add_argument("ml_id")
+    tiling.add_argument("volume", type=Path)
+    tiling.add_argument("annotations", type=Path)
+    tiling.add_argument("--tile-size", type=int, default=None)
+    tiling.add_argument("--overlap", type=float, default=None)
+    tiling.add_argument("--blend", choices=("gaussian", "linear"), default=None)
+    tiling.add_argument("--workers", type=int, default=None)
+    tiling.add_argument("--max-memory-mb", type=int, default=None)
+    tiling.add_argument("--repeat", type=int, default=1, help="Runs per timing (median)")
+    backend = sub.add_parser("backend", help="Execution backends (inference.backend in config.yml)")
+    backend.add_argument("models_dir", type=Path)
+    backend.add_argument("ml_id")
+    backend.add_argument("volume", type=Path, nargs="?", default=None)
+    backend.add_argument("annotations", type=Path, nargs="?", default=None)
+    backend.add_argument("--backend", action="append", choices=BACKENDS[1:], default=None,
+                         help="Backend to check (repeatable; default: all)")
+    backend.add_argument("--shape", type=int, nargs=3, default=[96, 128, 80],
+                         help="Synthetic volume shape, unlike the export shape on purpose")
+    backend.add_argument("--tolerance", type=float, default=1e-3,
+                         help="Largest allowed logit difference from eager")
+    backend.add_argument("--repeat", type=int, default=3, help="Runs per timing (median)")
+    precision = sub.add_parser("precision", help="Reduced precision (inference.precision in config.yml)")
+    precision.add_argument("models_dir", type=Path)
+    precision.add_argument("ml_id")
+    precision.add_argument("--mode", action="append", choices=PRECISIONS[1:], default=None,
+                           help="Precision to check (repeatable; default: all)")
+    precision.add_argument("--backend", choices=("eager", "compile"), default="eager",
+                           help="Backend for bf16 (int8 always runs on onnxruntime)")
+    precision.add_argument("--shape", type=int, nargs=3, default=[96, 128, 80])
+    precision.add_argument("--min-dice", type=float, default=0.99,
+                           help="Lowest Dice with fp32 that still passes")
+    precision.add_argument("--repeat", type=int, default=3, help="Runs per timing (median)")
+    args = parser.parse_args(argv)
+    if args.command == "backend" and (args.volume is None) != (args.annotations is None):
+        parser.error("backend: give both VOLUME and ANNOTATIONS, or neither")
+
+    logging.basicConfig(level=logging.WARNING)
+    commands = {
+        "roi": check_roi,
+        "tiling": check_tiling,
+        "backend": check_backend,
+        "precision": check_precision,
+    }
+    with torch.no_grad():
+        return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
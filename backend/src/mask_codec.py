@@ -0,0 +1,195 @@
+"""Compact binary encoding of 3D label masks (`application/x-freebrowse-mask`).
+
+Used to return an inference result inline instead of writing a NIfTI and
+having the client fetch and decompress it. A mask is a 3D volume whose voxels
+are either 0 or one label value; it is sent as a fixed little-endian header
+followed by the voxels in NIfTI order (x fastest), either bit-packed or
+run-length encoded, whichever is smaller:
+
+    offset  size  field
+    0       4     magic "FBMK"
+    4       1     version (1)
+    5       1     encoding: 0 = bits (LSB first), 1 = RLE, 2 = delta
+    6       1     label value
+    7       1     reserved
+    8       12    dims, 3 x uint32
+    20      64    affine (voxel -> RAS mm), 16 x float32, row-major
+    84      4     payload length, uint32
+    88      ...   payload
+
+RLE payloads are LEB128 varints of alternating run lengths, starting with a
+(possibly empty) run of zeros. Delta payloads have the same layout, but the
+runs alternate between unchanged and changed voxels relative to an earlier
+result the receiver already holds; which one is agreed out of band (the
+X-Result-Base header, or `result_base` in the session history). Between two
+refinement clicks only a few runs change, so a delta is usually tens of bytes.
+The frontend decoder is frontend/src/lib/mask-codec.ts.
+
+With AI_HISTORY_DELTAS, session history results are stored in this format
+(result_NNN.fbmk); `python mask_codec.py expand SESSION_DIR` writes them out
+as result_NNN.nii.gz.
+"""
+import argparse
+import struct
+from pathlib import Path
+
+import numpy as np
+
+MASK_MEDIA_TYPE = "application/x-freebrowse-mask"
+MAGIC = b"FBMK"
+VERSION = 1
+ENCODING_BITS = 0
+ENCODING_RLE = 1
+ENCODING_DELTA = 2
+_HEADER = struct.Struct("<4sBBBB3I16fI")
+
+
+def _varints(values: np.ndarray) -> bytes:
+    """LEB128-encode non-negative integers (vectorized)."""
+    values = values.astype(np.uint64)
+    nbytes = np.ones(values.shape, dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += values >= np.uint64(1 << (7 * k))
+    owner = np.repeat(np.arange(values.size), nbytes)
+    starts = np.cumsum(nbytes) - nbytes
+    position = np.arange(owner.size) - np.repeat(starts, nbytes)
+    out = (values[owner] >> (np.uint64(7) * position.astype(np.uint64))) & np.uint64(0x7F)
+    out |= np.where(position < nbytes[owner] - 1, np.uint64(0x80), np.uint64(0))
+    return out.astype(np.uint8).tobytes()
+
+
+def run_lengths(flat: np.ndarray) -> np.ndarray:
+    """Alternating zero/non-zero run lengths of a 1D boolean array, zeros first."""
+    changes = np.flatnonzero(np.diff(flat.view(np.int8))) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    runs = np.diff(bounds)
+    if flat.size and flat[0]:
+        runs = np.concatenate(([0], runs))
+    return runs
+
+
+def mask_bits(mask: np.ndarray) -> np.ndarray:
+    """Foreground of a 3D mask, bit-packed in NIfTI order; a compact delta base."""
+    flat = np.asarray(mask).ravel(order="F") != 0
+    return np.packbits(flat, bitorder="little")
+
+
+def _unpack(bits: np.ndarray, count: int) -> np.ndarray:
+    return np.unpackbits(bits, count=count, bitorder="little").view(np.bool_)
+
+
+def encode_mask(
+    mask: np.ndarray,
+    affine: np.ndarray,
+    label_value: int = 1,
+    base: np.ndarray | None = None,
+) -> bytes:
+    """Encode a 3D mask (non-zero = foreground) with its voxel-to-RAS affine.
+
+    With `base` (the `mask_bits` of an earlier result of the same shape),
+    only the voxels that changed are encoded, unless a full encoding is
+    smaller.
+    """
+    if mask.ndim != 3:
+        raise ValueError(f"Expected a 3D mask, got shape {mask.shape}")
+    flat = np.asarray(mask).ravel(order="F") != 0
+    rle = _varints(run_lengths(flat))
+    if len(rle) < (flat.size + 7) // 8:
+        encoding, payload = ENCODING_RLE, rle
+    else:
+        encoding, payload = ENCODING_BITS, np.packbits(flat, bitorder="little").tobytes()
+    if base is not None and base.size == (flat.size + 7) // 8:
+        delta = _varints(run_lengths(flat ^ _unpack(base, flat.size)))
+        if len(delta) < len(payload):
+            encoding, payload = ENCODING_DELTA, delta
+    header = _HEADER.pack(
+        MAGIC, VERSION, encoding, int(label_value) & 0xFF, 0,
+        *(int(n) for n in mask.shape),
+        *np.asarray(affine, dtype=np.float32).ravel(),
+        len(payload),
+    )
+    return header + payload
+
+
+def is_delta(data: bytes) -> bool:
+    return len(data) > 5 and data[5] == ENCODING_DELTA
+
+
+def _runs(payload: bytes) -> list[int]:
+    runs, value, shift = [], 0, 0
+    for byte in payload:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            runs.append(value)
+            value, shift = 0, 0
+    return runs
+
+
+def decode_mask(data: bytes, base: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """Inverse of `encode_mask`: returns (uint8 mask with label values, affine).
+
+    Delta-encoded masks need the `mask_bits` of the result they were encoded
+    against as `base`.
+    """
+    magic, version, encoding, label, _reserved, *rest = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a version 1 mask")
+    dims, affine, length = rest[:3], rest[3:19], rest[19]
+    payload = data[_HEADER.size:_HEADER.size + length]
+    count = int(np.prod(dims))
+    if encoding == ENCODING_BITS:
+        flat = _unpack(np.frombuffer(payload, np.uint8), count)
+    elif encoding in (ENCODING_RLE, ENCODING_DELTA):
+        runs = _runs(payload)
+        flat = np.repeat(np.arange(len(runs)) % 2 == 1, runs)
+        if encoding == ENCODING_DELTA:
+            if base is None:
+                raise ValueError("Delta-encoded mask needs a base")
+            flat ^= _unpack(base, count)
+    else:
+        raise ValueError(f"Unknown mask encoding: {encoding}")
+    if flat.size != count:
+        raise ValueError("Mask payload does not match its dims")
+    mask = flat.reshape(dims, order="F").astype(np.uint8) * np.uint8(label)
+    return mask, np.asarray(affine, dtype=np.float64).reshape(4, 4)
+
+
+def expand_history(session_dir: Path) -> list[Path]:
+    """Write every encoded history result of a session as a NIfTI next to it."""
+    import nibabel as nib
+
+    from session_catalog import MANIFEST_FILENAME, read_manifest
+
+    manifest = read_manifest(session_dir / MANIFEST_FILENAME)
+    bits: dict[int, np.ndarray] = {}
+    written = []
+    for it in manifest.get("iterations") or []:
+        if not it["result_path"].endswith(".fbmk"):
+            continue
+        data = (session_dir / it["result_path"]).read_bytes()
+        base = bits.get(it.get("result_base"))
+        if is_delta(data) and base is None:
+            raise ValueError(f"{it['result_path']}: base iteration {it.get('result_base')} missing")
+        mask, affine = decode_mask(data, base)
+        bits[it["iteration"]] = mask_bits(mask)
+        out = session_dir / it["result_path"].replace(".fbmk", ".nii.gz")
+        nib.save(nib.Nifti1Image(mask, affine), str(out))
+        written.append(out)
+    return written
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Inspect encoded AI result masks.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    expand = sub.add_parser("expand", help="Write a session's history results as NIfTI")
+    expand.add_argument("session_dir", type=Path)
+    args = parser.parse_args(argv)
+
+    for path in expand_history(args.session_dir):
+        print(path)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,274 @@
+"""Prometheus text-format metrics for GET /metrics.
+
+A minimal registry of counters, gauges and histograms (standard library
+only) plus a pure ASGI middleware that times every /data/* and /ai/*
+request. Values are plain floats updated under a per-metric lock, so
+recording costs a dict lookup and an addition; anything that is cheaper to
+read than to track (cache occupancy, loaded models) is sampled by collector
+callbacks at scrape time instead.
+
+Metrics are module-level so that any module can record into them without
+threading a registry through; GET /metrics renders `REGISTRY`.
+"""
+import bisect
+import logging
+import math
+import threading
+import time
+from collections.abc import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_TRACKED_PREFIXES = ("/data", "/ai")
+
+Sample = tuple[str, dict[str, str], float]
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self) -> list[Sample]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> list[Sample]:
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, dict(zip(self.labelnames, k)), v) for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket..., +Inf count, sum]
+        self._values: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            row[index] += 1
+            row[-1] += value
+
+    def samples(self) -> list[Sample]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        out: list[Sample] = []
+        for key, row in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (math.inf,), row[:-1]):
+                cumulative += count
+                out.append((f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            out.append((f"{self.name}_count", labels, cumulative))
+            out.append((f"{self.name}_sum", labels, row[-1]))
+        return out
+
+
+class Registry:
+    """Metrics plus scrape-time collectors, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+        self._collectors: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect: Callable[[], None]) -> None:
+        """Run `collect` before each scrape, e.g. to set gauges from live state."""
+        with self._lock:
+            self._collectors.append(collect)
+
+    def render(self) -> str:
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = list(self._metrics)
+        for collect in collectors:
+            try:
+                collect()
+            except Exception as exc:
+                logger.warning(f"Metrics collector failed: {exc}")
+        lines: list[str] = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "freebrowse_http_requests_total", "HTTP requests by route, method and status.",
+    ("route", "method", "status"),
+))
+HTTP_LATENCY = REGISTRY.register(Histogram(
+    "freebrowse_http_request_duration_seconds", "HTTP request latency by route and method.",
+    ("route", "method"),
+))
+HTTP_IN_PROGRESS = REGISTRY.register(Gauge(
+    "freebrowse_http_requests_in_progress", "HTTP requests currently being served.",
+))
+BYTES_UPLOADED = REGISTRY.register(Counter(
+    "freebrowse_uploaded_bytes_total", "Request body bytes received by route.", ("route",),
+))
+BYTES_WRITTEN = REGISTRY.register(Counter(
+    "freebrowse_written_bytes_total", "Bytes written to disk by kind of file.", ("kind",),
+))
+AI_CACHE_ENTRIES = REGISTRY.register(Gauge(
+    "freebrowse_ai_session_cache_entries", "AI sessions held in the RAM cache.",
+))
+AI_CACHE_BYTES = REGISTRY.register(Gauge(
+    "freebrowse_ai_session_cache_bytes", "Bytes held by the AI session RAM cache.",
+))
+AI_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "freebrowse_ai_session_cache_lookups_total", "AI session cache lookups by result.",
+    ("result",),
+))
+AI_CACHE_EVICTIONS = REGISTRY.register(Counter(
+    "freebrowse_ai_session_cache_evictions_total", "AI session cache evictions by reason.",
+    ("reason",),
+))
+MODEL_CACHE_MODELS = REGISTRY.register(Gauge(
+    "freebrowse_model_cache_loaded", "1 for every model held in the model cache.", ("ml_id",),
+))
+MODEL_CACHE_BYTES = REGISTRY.register(Gauge(
+    "freebrowse_model_cache_bytes", "Estimated size of the models held in the model cache.",
+))
+MODEL_CACHE_EVICTIONS = REGISTRY.register(Counter(
+    "freebrowse_model_cache_evictions_total", "Models dropped from the model cache to stay under its cap.",
+))
+MODEL_LOAD_SECONDS = REGISTRY.register(Histogram(
+    "freebrowse_model_load_seconds", "Time to load a model into the cache.", ("ml_id",),
+))
+INFERENCE_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "freebrowse_inference_queue_depth", "Inference requests waiting or running.",
+))
+INFERENCE_COALESCED = REGISTRY.register(Counter(
+    "freebrowse_inference_coalesced_total",
+    "Queued inference requests superseded by a newer one for the same session.", ("ml_id",),
+))
+INFERENCE_SECONDS = REGISTRY.register(Histogram(
+    "freebrowse_inference_duration_seconds", "End-to-end inference time by model.", ("ml_id",),
+))
+INFERENCE_BATCH_SIZE = REGISTRY.register(Histogram(
+    "freebrowse_inference_batch_size", "Model calls run together in one forward pass.",
+    ("ml_id",), buckets=(1, 2, 4, 8, 16),
+))
+
+
+def _route_label(scope) -> str:
+    # Route templates keep the label set bounded; paths under the /data
+    # static mount collapse to one label.
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    if path:
+        return path
+    return "/data (static)" if scope["path"].startswith("/data") else "other"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording count, latency and body bytes per route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(_TRACKED_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+        received = {"bytes": 0}
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                received["bytes"] += len(message.get("body", b""))
+            return message
+
+        async def status_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        HTTP_IN_PROGRESS.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, status_send)
+        finally:
+            elapsed = time.perf_counter() - start
+            HTTP_IN_PROGRESS.dec()
+            route = _route_label(scope)
+            method = scope["method"]
+            HTTP_REQUESTS.inc(route=route, method=method, status=str(status["code"]))
+            HTTP_LATENCY.observe(elapsed, route=route, method=method)
+            if received["bytes"]:
+                BYTES_UPLOADED.inc(received["bytes"], route=route)
@@ -5,8 +5,8 @@ Adapted from freebrowse-eti/backend/src/ml_inference.py:
   session manifest rather than accepting base64-encoded bodies.
 - Annotations arrive as a uint8 NIfTI label mask (1 = positive, 2 = negative)
   rather than flat click-index lists.
-- Model cache is guarded by a threading.Lock since FastAPI runs sync endpoints
-  on a threadpool.
+- Loaded models are held by a thread-safe ModelRegistry (model_registry.py)
+  since FastAPI runs sync endpoints on a threadpool.
 """
 from __future__ import annotations
 
@@ -14,9 +14,11 @@ import importlib.util
 import logging
 import sys
 import threading
+import time
+from contextlib import nullcontext
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
 import nibabel as nib
 import numpy as np
@@ -25,6 +27,14 @@ import yaml
 from fastapi import HTTPException
 
 import utils
+from batching import MicroBatcher
+from metrics import MODEL_LOAD_SECONDS
+from model_backends import Runner, prepare_backend
+from model_registry import ModelRegistry
+from preproc_cache import PreprocCache
+from session_clicks import is_clicks, load_clicks, rasterize
+from tiled_inference import plan_tiles, tiled_forward, tiling_config
+from timing import StageTimer
 
 logger = logging.getLogger(__name__)
 
@@ -35,8 +45,26 @@ if not torch.cuda.is_available():
     )
 
 
-_model_cache: dict[str, tuple[torch.nn.Module, dict]] = {}
-_model_cache_lock = threading.Lock()
+# Bump whenever prepare_session_tensors changes its output, so that volumes
+# cached by an older pipeline are not reused.
+PREPROCESSING_VERSION = 1
+
+_ROI_DEFAULT_MARGIN = 24
+_ROI_DEFAULT_MAX_FRACTION = 0.5
+# Logit outside an ROI crop when there is no previous prediction to keep.
+_ROI_BACKGROUND_LOGIT = -10.0
+
+# Registries for callers that do not pass their own (e.g. inference_check.py).
+_registries: dict[Path, ModelRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def _default_registry(models_dir: Path) -> ModelRegistry:
+    with _registries_lock:
+        registry = _registries.get(models_dir)
+        if registry is None:
+            registry = _registries[models_dir] = ModelRegistry(models_dir)
+        return registry
 
 
 @dataclass
@@ -46,6 +74,7 @@ class InferenceArtifacts:
     affine_ras: np.ndarray
     ras_dims: tuple[int, int, int]
     shape_before_pad: tuple[int, int, int]
+    mapped: bool = False  # volume_tensor is backed by a shared preprocessed-cache file
 
 
 def pad_to_multiple(tensor: torch.Tensor, multiple: int = 16) -> torch.Tensor:
@@ -59,6 +88,70 @@ def pad_to_multiple(tensor: torch.Tensor, multiple: int = 16) -> torch.Tensor:
     return torch.nn.functional.pad(tensor, (0, pw, 0, ph, 0, pd))
 
 
+def roi_config(config: dict | None, force: bool = False) -> dict[str, Any] | None:
+    """The model's `inference.roi` settings, or None when ROI inference is off
+    (unless `force`, as for inference_check.py).
+
+        inference:
+          roi:
+            enabled: true
+            margin: 24          # voxels around clicks and previous prediction
+            max_fraction: 0.5   # run the full volume if the crop is larger
+    """
+    inference = (config or {}).get("inference") or {}
+    roi = inference.get("roi") or {}
+    if not (force or roi.get("enabled", False)):
+        return None
+    return {
+        "margin": int(roi.get("margin", _ROI_DEFAULT_MARGIN)),
+        "max_fraction": float(roi.get("max_fraction", _ROI_DEFAULT_MAX_FRACTION)),
+    }
+
+
+def _bounds(mask: torch.Tensor) -> tuple[list[int], list[int]] | None:
+    """Inclusive-exclusive bounds of the non-zero voxels of a 3d tensor."""
+    lo, hi = [], []
+    for axis in range(3):
+        others = tuple(a for a in range(3) if a != axis)
+        present = torch.nonzero(mask.ne(0).any(dim=others[1]).any(dim=others[0]))
+        if present.numel() == 0:
+            return None
+        lo.append(int(present[0]))
+        hi.append(int(present[-1]) + 1)
+    return lo, hi
+
+
+def roi_box(
+    masks: list[torch.Tensor],
+    padded_shape: tuple[int, ...],
+    margin: int,
+    max_fraction: float = 1.0,
+    multiple: int = 32,
+) -> tuple[slice, slice, slice] | None:
+    """Crop of the padded volume around the non-zero voxels of `masks`.
+
+    The box is expanded by `margin` and grown to a multiple of `multiple`
+    with real image context (the padded volume is a multiple already), so
+    the crop never needs padding of its own. Returns None when there is
+    nothing to crop around or the crop would exceed `max_fraction` of the
+    volume.
+    """
+    found = [b for b in (_bounds(m) for m in masks if m is not None) if b is not None]
+    if not found:
+        return None
+    box = []
+    for axis, dim in enumerate(padded_shape):
+        lo = max(0, min(b[0][axis] for b in found) - margin)
+        hi = min(dim, max(b[1][axis] for b in found) + margin)
+        size = min(dim, -(-(hi - lo) // multiple) * multiple)
+        start = min(max(0, (lo + hi - size) // 2), dim - size)
+        box.append(slice(start, start + size))
+    sizes = [b.stop - b.start for b in box]
+    if sizes == list(padded_shape) or np.prod(sizes) > max_fraction * np.prod(padded_shape):
+        return None
+    return tuple(box)
+
+
 def load_model_config(config_path: Path) -> dict[str, Any]:
     with open(config_path, "r") as f:
         return yaml.safe_load(f)
@@ -94,30 +187,61 @@ def get_model(
     ml_id: str,
     models_dir: Path,
     device: torch.device,
-) -> tuple[torch.nn.Module, dict]:
-    """Lazy cached model loader. Thread-safe."""
-    with _model_cache_lock:
-        cached = _model_cache.get(ml_id)
-        if cached is not None:
-            return cached
+    registry: ModelRegistry | None = None,
+) -> tuple[Runner, dict]:
+    """Lazy cached model loader. Thread-safe.
+
+    Returns the model wrapped in the execution backend and precision chosen
+    in its config.yml (see model_backends.py), or the eager fp32 model if
+    those cannot be set up. Models stay loaded in `registry` (see
+    model_registry.py) and are reloaded when their files change.
+    """
+    registry = registry or _default_registry(models_dir)
+    if registry.get(ml_id) is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Model '{ml_id}' is missing model.py or weights.pt",
+        )
 
-        model_dir = models_dir / ml_id
-        module_file = model_dir / "model.py"
-        checkpoint_file = model_dir / "weights.pt"
-        config_file = model_dir / "config.yml"
+    def load(info: dict[str, Any]) -> tuple[tuple[Runner, dict], int]:
+        t0 = time.perf_counter()
+        checkpoint_file = Path(info["checkpoint_path"])
+        model = load_model(Path(info["model_module_path"]), checkpoint_file, device)
+        config = info["config"] or {}
+        inference_config = config.get("inference") or {}
+        backend = f"{inference_config.get('backend', 'eager')}/{inference_config.get('precision', 'fp32')}"
+        try:
+            runner = prepare_backend(model, config, checkpoint_file.parent, device)
+        except Exception:
+            logger.exception(f"Model '{ml_id}': {backend} unavailable, running eager/fp32")
+            runner, backend = model, "eager/fp32"
+        nbytes = sum(t.numel() * t.element_size() for t in (*model.parameters(), *model.buffers()))
+        elapsed = time.perf_counter() - t0
+        MODEL_LOAD_SECONDS.observe(elapsed, ml_id=ml_id)
+        logger.info(
+            f"Loaded model '{ml_id}' on {device} as {backend} "
+            f"({nbytes / 2**20:.0f} MB, {elapsed:.2f}s)"
+        )
+        return (runner, config), nbytes
 
-        if not module_file.exists() or not checkpoint_file.exists():
-            raise HTTPException(
-                status_code=404,
-                detail=f"Model '{ml_id}' is missing model.py or weights.pt",
-            )
+    return registry.model(ml_id, load)
 
-        model = load_model(module_file, checkpoint_file, device)
-        config = load_model_config(config_file) if config_file.exists() else {}
 
-        _model_cache[ml_id] = (model, config)
-        logger.info(f"Cached model '{ml_id}' on {device}")
-        return model, config
+def warm_model(
+    ml_id: str,
+    models_dir: Path,
+    registry: ModelRegistry | None = None,
+    size: int = 64,
+) -> None:
+    """Load a model and run it once on an empty input, so that the first
+    click does not pay for loading, compilation or graph optimisation."""
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    t0 = time.perf_counter()
+    runner, config = get_model(ml_id, models_dir, device, registry)
+    in_channels = int((config.get("model") or {}).get("in_channels", 5))
+    with torch.no_grad():
+        runner(torch.zeros((1, in_channels, size, size, size), device=device))
+    logger.info(f"Warmed model '{ml_id}' ({time.perf_counter() - t0:.2f}s)")
 
 
 def create_mask_nifti(
@@ -157,25 +281,60 @@ def prepare_session_tensors(
     manifest: dict,
     session_dir: Path,
     data_dir: Path,
+    timer: StageTimer | None = None,
+    preproc_cache: PreprocCache | None = None,
 ) -> InferenceArtifacts:
     """Load the session's volume from disk, run the preprocessing pipeline.
 
     Mirrors eti's _load_and_store_volume_from_path: reorient to RAS, clip
     [0.5, 99.5] percentile, normalize to [0, 1], pad to multiple of 32.
+    With `preproc_cache`, a previously preprocessed copy of the same file is
+    memory-mapped instead, and a fresh result is stored for next time.
     """
+    timer = timer or StageTimer()
     volume_path = _resolve_volume_path(manifest, session_dir, data_dir)
 
-    img = nib.load(str(volume_path))
-    img_ras = nib.as_closest_canonical(img)
-    volume_ras = img_ras.get_fdata().astype(np.float32)
-    affine_ras = img_ras.affine
-    ras_dims = volume_ras.shape
+    cache_key = None
+    if preproc_cache is not None:
+        with timer.stage("preproc_cache"):
+            cache_key = PreprocCache.key(volume_path, PREPROCESSING_VERSION)
+            cached = preproc_cache.get(cache_key)
+        timer.tag(preproc_cache=cached is not None)
+        if cached is not None:
+            return InferenceArtifacts(
+                volume_tensor=torch.from_numpy(cached.volume),
+                affine_ras=cached.affine_ras,
+                ras_dims=cached.ras_dims,
+                shape_before_pad=cached.shape_before_pad,
+                mapped=True,
+            )
 
-    tensor = torch.from_numpy(volume_ras).float()
-    tensor = utils.clip_volume(tensor, "percentile", [0.5, 99.5])
-    tensor = utils.relative_norm(tensor)
+    with timer.stage("load") as stage:
+        img = nib.load(str(volume_path))
+        volume = img.get_fdata().astype(np.float32)
+        stage["bytes"] = volume_path.stat().st_size
+    # Same result as nib.as_closest_canonical(img), applied to the loaded array
+    # so that reading and reorienting are timed separately.
+    with timer.stage("reorient"):
+        ornt = nib.io_orientation(img.affine)
+        volume_ras = np.ascontiguousarray(nib.orientations.apply_orientation(volume, ornt))
+        affine_ras = img.affine @ nib.orientations.inv_ornt_aff(ornt, img.shape)
+        ras_dims = volume_ras.shape
+
+    with timer.stage("normalize"):
+        tensor = torch.from_numpy(volume_ras).float()
+        tensor = utils.clip_volume(tensor, "percentile", [0.5, 99.5])
+        tensor = utils.relative_norm(tensor)
     shape_before_pad = tuple(tensor.shape)
-    tensor = pad_to_multiple(tensor=tensor, multiple=32)
+    with timer.stage("pad"):
+        tensor = pad_to_multiple(tensor=tensor, multiple=32)
+
+    if cache_key is not None:
+        with timer.stage("preproc_store"):
+            preproc_cache.put(
+                cache_key, tensor.numpy(), affine_ras, ras_dims, shape_before_pad,
+                source=str(volume_path),
+            )
 
     return InferenceArtifacts(
         volume_tensor=tensor,
@@ -190,10 +349,24 @@ def annotation_mask_to_pos_neg(
     manifest: dict,
     ras_dims: tuple[int, int, int],
 ) -> tuple[torch.Tensor, torch.Tensor]:
-    """Load annotations NIfTI, reorient to RAS, split by value (1=pos, 2=neg)."""
+    """Load annotations NIfTI, reorient to RAS, split by value (1=pos, 2=neg).
+
+    Click annotations (session_clicks.py) are painted directly on the RAS grid.
+    """
     rel = manifest.get("annotation_path")
     if not rel:
         raise HTTPException(status_code=400, detail="Session has no annotation_path")
+    if is_clicks(rel):
+        state = load_clicks(session_dir)
+        if state is None:
+            raise HTTPException(status_code=404, detail=f"Annotations not found: {rel}")
+        if tuple(state["ras_dims"]) != tuple(ras_dims):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Click grid {tuple(state['ras_dims'])} != volume RAS dims {ras_dims}",
+            )
+        labels = rasterize(state)
+        return torch.from_numpy(labels == 1).float(), torch.from_numpy(labels == 2).float()
     full = (session_dir / rel).resolve()
     session_resolved = session_dir.resolve()
     try:
@@ -227,16 +400,32 @@ def run_inference(
     manifest: dict,
     data_dir: Path,
     models_dir: Path,
+    timer: StageTimer | None = None,
+    preproc_cache: PreprocCache | None = None,
+    memory_budget: int | None = None,
+    batcher: MicroBatcher | None = None,
+    registry: ModelRegistry | None = None,
 ) -> tuple[nib.Nifti1Image, np.ndarray]:
     """Run the model on the session's stored volume + annotation mask.
 
     Uses the SessionManager cache entry (from manager.touch) for iterative
     refinement: the preprocessed volume tensor and the previous logits are
     reused across calls until invalidated by set_volume/set_annots.
+
+    Each step is recorded on `timer` (volume load and preprocessing only
+    appear on a cache miss). `memory_budget` (bytes) caps the model's
+    activation memory by tiling large volumes (see tiled_inference.py).
+    With a `batcher`, the forward pass may run in one batch with other
+    sessions' (see batching.py).
     """
+    timer = timer or StageTimer()
+    timer.tag(volume_cache=cache_entry.volume_tensor is not None)
     if cache_entry.volume_tensor is None:
-        artifacts = prepare_session_tensors(manifest, session_dir, data_dir)
+        artifacts = prepare_session_tensors(
+            manifest, session_dir, data_dir, timer, preproc_cache=preproc_cache,
+        )
         cache_entry.volume_tensor = artifacts.volume_tensor
+        cache_entry.volume_mapped = artifacts.mapped
         cache_entry.affine_ras = artifacts.affine_ras
         cache_entry.ras_dims = artifacts.ras_dims
         cache_entry.shape_before_pad = artifacts.shape_before_pad
@@ -246,38 +435,136 @@ def run_inference(
     ras_dims = cache_entry.ras_dims
     shape_before_pad = cache_entry.shape_before_pad
 
-    pos_mask, neg_mask = annotation_mask_to_pos_neg(session_dir, manifest, ras_dims)
-    pos_mask = pad_to_multiple(pos_mask, multiple=32)
-    neg_mask = pad_to_multiple(neg_mask, multiple=32)
+    with timer.stage("annotations"):
+        pos_mask, neg_mask = annotation_mask_to_pos_neg(session_dir, manifest, ras_dims)
+        pos_mask = pad_to_multiple(pos_mask, multiple=32)
+        neg_mask = pad_to_multiple(neg_mask, multiple=32)
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model, config = get_model(ml_id=ml_id, models_dir=models_dir, device=device)
+    registry = registry or _default_registry(models_dir)
+    timer.tag(model_cache=registry.is_loaded(ml_id), device=device.type)
+    with timer.stage("model"):
+        model, config = get_model(ml_id=ml_id, models_dir=models_dir, device=device, registry=registry)
+
+    prev_logits = cache_entry.previous_logits
+    if isinstance(prev_logits, np.ndarray):  # handed over by another worker
+        prev_logits = torch.from_numpy(prev_logits)
+    if batcher is None:
+        forward = model
+    else:
+        max_batch = ((config or {}).get("inference") or {}).get("max_batch")
+
+        def _batched(x: torch.Tensor) -> torch.Tensor:
+            output, size = batcher.forward(ml_id, model, x, max_batch)
+            timer.tag(batch=size)
+            return output
+
+        forward = _batched
+
+    with batcher.active(ml_id) if batcher is not None else nullcontext():
+        logits = predict_logits(
+            forward, config, volume_tensor, pos_mask, neg_mask, prev_logits,
+            shape_before_pad, device, timer,
+            roi=roi_config(config),
+            tiling=tiling_config(config, memory_budget),
+        )
+
+    with timer.stage("threshold"):
+        cache_entry.previous_logits = logits
+        mask_np = (logits.sigmoid() > 0.5).to(torch.uint8).numpy()
+        nii = create_mask_nifti(mask_np, affine_ras, label_value=label_value)
+    return nii, affine_ras
+
+
+def predict_logits(
+    model: Callable[[torch.Tensor], torch.Tensor],
+    config: dict | None,
+    volume_tensor: torch.Tensor,
+    pos_mask: torch.Tensor,
+    neg_mask: torch.Tensor,
+    prev_logits: torch.Tensor | None,
+    shape_before_pad: tuple[int, int, int],
+    device: torch.device,
+    timer: StageTimer | None = None,
+    roi: dict[str, Any] | None = None,
+    tiling: dict[str, Any] | None = None,
+) -> torch.Tensor:
+    """Run the model once and return logits of shape `shape_before_pad`.
+
+    `volume_tensor` and the prompt masks are padded to a multiple of 32.
+    With `roi` settings (see `roi_config`), only a crop around the prompts
+    and the previous prediction is run, and its logits are pasted over the
+    previous ones. With `tiling` settings (see tiled_inference.py), regions
+    too large for the memory budget are run tile by tile.
+    """
+    timer = timer or StageTimer()
     prompts_config = config.get("prompts", {}) if isinstance(config, dict) else {}
 
-    input_tensor = torch.zeros((1, 5, *volume_tensor.shape), dtype=torch.float32)
-    input_tensor[0, 0] = volume_tensor
-    input_tensor[0, 2] = pos_mask
-    input_tensor[0, 3] = neg_mask
+    box = None
+    if roi:
+        with timer.stage("roi") as stage:
+            previous = None if prev_logits is None else prev_logits.gt(0)
+            box = roi_box(
+                [pos_mask, neg_mask, previous], tuple(volume_tensor.shape),
+                margin=roi["margin"], max_fraction=roi["max_fraction"],
+            )
+            if box is not None:
+                stage["shape"] = [b.stop - b.start for b in box]
+        timer.tag(roi="crop" if box is not None else "full")
+    region = box or tuple(slice(0, n) for n in volume_tensor.shape)
 
-    prev_logits = cache_entry.previous_logits
+    prev_channel = None
     if prev_logits is not None:
-        include_pred = prompts_config.get("include_previous_prediction", False)
-        include_logits = prompts_config.get("include_previous_logits", False)
-        if include_logits:
-            input_tensor[0, 1] = pad_to_multiple(prev_logits, multiple=32)
-        elif include_pred:
-            input_tensor[0, 1] = pad_to_multiple(
-                (torch.sigmoid(prev_logits) > 0.5).float(), multiple=32,
+        if prompts_config.get("include_previous_logits", False):
+            prev_channel = pad_to_multiple(prev_logits, multiple=32)
+        elif prompts_config.get("include_previous_prediction", False):
+            prev_channel = pad_to_multiple((torch.sigmoid(prev_logits) > 0.5).float(), multiple=32)
+    timer.tag(previous_logits=prev_logits is not None)
+
+    def model_input(window: tuple[slice, ...]) -> torch.Tensor:
+        input_tensor = torch.zeros(
+            (1, 5, *(w.stop - w.start for w in window)), dtype=torch.float32,
+        )
+        input_tensor[0, 0] = volume_tensor[window]
+        input_tensor[0, 2] = pos_mask[window]
+        input_tensor[0, 3] = neg_mask[window]
+        if prev_channel is not None:
+            input_tensor[0, 1] = prev_channel[window]
+        return input_tensor
+
+    tiles = None
+    if tiling:
+        tiles = plan_tiles(tuple(r.stop - r.start for r in region), tiling)
+        timer.tag(tiled=tiles is not None)
+
+    if tiles is None:
+        with timer.stage("input"):
+            input_tensor = model_input(region)
+    with timer.stage("forward") as stage:
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        if tiles is None:
+            with torch.no_grad():
+                output = model(input_tensor.to(device))
+                logits = output.squeeze().cpu()
+            del input_tensor, output
+        else:
+            windows, workers = tiles
+            stage["tiles"] = len(windows)
+            stage["tile_shape"] = [w.stop - w.start for w in windows[0]]
+            stage["workers"] = workers
+            logits = tiled_forward(
+                model, model_input, region, windows, workers, tiling["blend"], device,
             )
-
-    with torch.no_grad():
-        output = model(input_tensor.to(device))
-        logits = output.squeeze().cpu()
+        if device.type == "cuda":
+            stage["cuda_peak_mb"] = round(torch.cuda.max_memory_allocated(device) / 2**20, 1)
 
     d, h, w = shape_before_pad
-    logits = logits[:d, :h, :w]
-    cache_entry.previous_logits = logits
-
-    mask_np = (logits.sigmoid() > 0.5).to(torch.uint8).numpy()
-    nii = create_mask_nifti(mask_np, affine_ras, label_value=label_value)
-    return nii, affine_ras
+    if box is not None:
+        with timer.stage("roi_paste"):
+            full = torch.full(tuple(volume_tensor.shape), _ROI_BACKGROUND_LOGIT)
+            if prev_logits is not None:
+                full[:d, :h, :w] = prev_logits
+            full[box] = logits
+            logits = full
+    return logits[:d, :h, :w]
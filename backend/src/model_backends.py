@@ -0,0 +1,260 @@
+"""Execution backends and numeric precisions for segmentation models.
+
+A model is loaded as the eager PyTorch `SegModel` from its model.py and
+weights.pt. Its config.yml can run it through a faster backend instead:
+
+    inference:
+      backend: onnx       # eager | torchscript | compile | onnx
+      onnx_threads: 0     # intra-op threads (0 = onnxruntime default)
+
+- torchscript: the model traced and frozen, saved as weights.torchscript.pt.
+- compile: `torch.compile(dynamic=True)`. Nothing is saved; the first call
+  of each process pays for compilation.
+- onnx: the model exported with dynamic batch and spatial axes, saved as
+  weights.onnx, and run on onnxruntime's CPU execution provider (needs the
+  onnx and onnxruntime packages).
+
+`precision` trades accuracy for speed and memory:
+
+    inference:
+      precision: bf16     # fp32 | bf16 | int8_dynamic | int8_static
+
+- bf16: the forward pass under CPU (or CUDA) autocast; logits come back as
+  float32. Works with the eager and compile backends.
+- int8_dynamic: conv weights quantized to int8 ahead of time and
+  activations at run time, saved as weights.int8-dynamic.onnx.
+- int8_static: conv weights and activations quantized with ranges
+  calibrated on synthetic click inputs, saved as weights.int8-static.onnx.
+
+PyTorch has no int8 kernels for dynamic 3D convolutions, so both int8 modes
+are built from weights.onnx with onnxruntime's quantization tools and run
+on onnxruntime (with `backend` eager or onnx).
+
+Exported files sit next to weights.pt and are rebuilt when they are older
+than weights.pt or model.py. Tracing bakes in any shape-dependent Python in
+the model, so check a backend against eager on a shape other than the export
+shape before enabling it:
+
+    python inference_check.py backend MODELS_DIR ML_ID
+
+and a reduced precision against fp32 with
+
+    python inference_check.py precision MODELS_DIR ML_ID
+"""
+from __future__ import annotations
+
+import logging
+import os
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("eager", "torchscript", "compile", "onnx")
+PRECISIONS = ("fp32", "bf16", "int8_dynamic", "int8_static")
+ARTIFACTS = {
+    "torchscript": "weights.torchscript.pt",
+    "onnx": "weights.onnx",
+    "int8_dynamic": "weights.int8-dynamic.onnx",
+    "int8_static": "weights.int8-static.onnx",
+}
+# Prompt channels of the model input (see ml_inference.predict_logits).
+_POS_CHANNEL = 2
+_NEG_CHANNEL = 3
+_ONNX_OPSET = 17
+# Spatial size of the example input used to trace and export.
+_EXPORT_SIZE = 64
+
+Runner = Callable[[torch.Tensor], torch.Tensor]
+
+
+def backend_name(config: dict | None) -> str:
+    name = ((config or {}).get("inference") or {}).get("backend", "eager")
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {name!r}; expected one of {', '.join(BACKENDS)}")
+    return name
+
+
+def precision_name(config: dict | None) -> str:
+    name = ((config or {}).get("inference") or {}).get("precision", "fp32")
+    if name not in PRECISIONS:
+        raise ValueError(f"Unknown inference precision {name!r}; expected one of {', '.join(PRECISIONS)}")
+    return name
+
+
+def _example_input(config: dict | None, device: torch.device) -> torch.Tensor:
+    in_channels = int(((config or {}).get("model") or {}).get("in_channels", 5))
+    return torch.zeros((1, in_channels, *[_EXPORT_SIZE] * 3), device=device)
+
+
+def _fresh(artifact: Path, model_dir: Path, *extra: Path) -> bool:
+    """Whether `artifact` was built after the model's code and weights (and
+    `extra` sources) last changed."""
+    try:
+        built = artifact.stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+    sources = [model_dir / "weights.pt", model_dir / "model.py", *extra]
+    return all(built >= p.stat().st_mtime_ns for p in sources if p.exists())
+
+
+def _tmp_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+
+def _torchscript(model: torch.nn.Module, config: dict | None, model_dir: Path, device: torch.device) -> Runner:
+    path = model_dir / ARTIFACTS["torchscript"]
+    if not _fresh(path, model_dir):
+        with torch.no_grad():
+            traced = torch.jit.trace(model, _example_input(config, device), check_trace=False)
+            frozen = torch.jit.freeze(traced.eval())
+        tmp = _tmp_path(path)
+        torch.jit.save(frozen, str(tmp))
+        os.replace(tmp, path)
+        logger.info(f"Exported TorchScript model to {path}")
+    return torch.jit.load(str(path), map_location=device)
+
+
+def _export_onnx(model: torch.nn.Module, config: dict | None, model_dir: Path, device: torch.device) -> Path:
+    path = model_dir / ARTIFACTS["onnx"]
+    if not _fresh(path, model_dir):
+        axes = {0: "batch", 2: "depth", 3: "height", 4: "width"}
+        tmp = _tmp_path(path)
+        with torch.no_grad():
+            torch.onnx.export(
+                model, (_example_input(config, device),), str(tmp),
+                input_names=["input"], output_names=["logits"],
+                dynamic_axes={"input": axes, "logits": axes},
+                opset_version=_ONNX_OPSET,
+            )
+        os.replace(tmp, path)
+        logger.info(f"Exported ONNX model to {path}")
+    return path
+
+
+def _ort_runner(path: Path, config: dict | None) -> Runner:
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    threads = int(((config or {}).get("inference") or {}).get("onnx_threads", 0))
+    if threads > 0:
+        options.intra_op_num_threads = threads
+    session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+
+    def run(x: torch.Tensor) -> torch.Tensor:
+        (logits,) = session.run(["logits"], {"input": x.detach().cpu().numpy()})
+        return torch.from_numpy(logits)
+
+    return run
+
+
+def _onnx(model: torch.nn.Module, config: dict | None, model_dir: Path, device: torch.device) -> Runner:
+    if device.type != "cpu":
+        raise ValueError("The onnx backend runs on CPU only")
+    return _ort_runner(_export_onnx(model, config, model_dir, device), config)
+
+
+def calibration_inputs(config: dict | None, count: int = 8, seed: int = 0) -> list[np.ndarray]:
+    """Synthetic model inputs for static quantization: a noisy volume with a
+    bright blob, one positive click inside it and one negative click outside."""
+    in_channels = int(((config or {}).get("model") or {}).get("in_channels", 5))
+    rng = np.random.default_rng(seed)
+    n = _EXPORT_SIZE
+    grid = np.stack(np.meshgrid(*[np.arange(n)] * 3, indexing="ij"))
+    inputs = []
+    for _ in range(count):
+        centre = rng.integers(n // 4, 3 * n // 4, size=3)
+        radius = rng.uniform(n / 10, n / 4)
+        blob = np.sqrt(((grid - centre[:, None, None, None]) ** 2).sum(0)) < radius
+        x = np.zeros((1, in_channels, n, n, n), dtype=np.float32)
+        x[0, 0] = 0.2 + 0.6 * blob + 0.1 * rng.random((n, n, n))
+        x[0, _POS_CHANNEL][tuple(centre)] = 1
+        x[0, _NEG_CHANNEL][tuple((centre + n // 2) % n)] = 1
+        inputs.append(x)
+    return inputs
+
+
+def _quantized(model: torch.nn.Module, config: dict | None, model_dir: Path, device: torch.device, precision: str) -> Runner:
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+        quantize_dynamic,
+        quantize_static,
+    )
+
+    if device.type != "cpu":
+        raise ValueError(f"{precision} runs on onnxruntime's CPU execution provider only")
+    source = _export_onnx(model, config, model_dir, device)
+    path = model_dir / ARTIFACTS[precision]
+    if not _fresh(path, model_dir, source):
+        tmp = _tmp_path(path)
+        if precision == "int8_dynamic":
+            quantize_dynamic(
+                str(source), str(tmp), op_types_to_quantize=["Conv"], weight_type=QuantType.QUInt8,
+            )
+        else:
+            class Reader(CalibrationDataReader):
+                def __init__(self):
+                    self._inputs = iter(calibration_inputs(config))
+
+                def get_next(self):
+                    x = next(self._inputs, None)
+                    return None if x is None else {"input": x}
+
+            quantize_static(
+                str(source), str(tmp), Reader(),
+                quant_format=QuantFormat.QDQ, op_types_to_quantize=["Conv"], per_channel=True,
+                activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+            )
+        os.replace(tmp, path)
+        logger.info(f"Quantized ONNX model ({precision}) to {path}")
+    return _ort_runner(path, config)
+
+
+def _autocast(runner: Runner, device: torch.device) -> Runner:
+    def run(x: torch.Tensor) -> torch.Tensor:
+        with torch.autocast(device.type, dtype=torch.bfloat16):
+            return runner(x).float()
+
+    return run
+
+
+def prepare_backend(
+    model: torch.nn.Module,
+    config: dict | None,
+    model_dir: Path,
+    device: torch.device,
+    backend: str | None = None,
+    precision: str | None = None,
+) -> Runner:
+    """Callable running `model` on a (N, C, D, H, W) input with `backend`
+    at `precision`; both default to the ones in config.yml.
+
+    Raises if they cannot be set up (e.g. onnxruntime is not installed, the
+    export fails, or the combination is not supported).
+    """
+    backend = backend or backend_name(config)
+    precision = precision or precision_name(config)
+    if precision.startswith("int8"):
+        if backend not in ("eager", "onnx"):
+            raise ValueError(f"{precision} runs on the onnx backend, not {backend}")
+        return _quantized(model, config, model_dir, device, precision)
+    if precision == "bf16" and backend not in ("eager", "compile"):
+        raise ValueError(f"bf16 autocast needs the eager or compile backend, not {backend}")
+
+    if backend == "eager":
+        runner = model
+    elif backend == "compile":
+        runner = torch.compile(model, dynamic=True)
+    elif backend == "torchscript":
+        runner = _torchscript(model, config, model_dir, device)
+    elif backend == "onnx":
+        runner = _onnx(model, config, model_dir, device)
+    else:
+        raise ValueError(f"Unknown inference backend {backend!r}; expected one of {', '.join(BACKENDS)}")
+    return _autocast(runner, device) if precision == "bf16" else runner
@@ -0,0 +1,210 @@
+"""Models under MODELS_DIR: their metadata and which ones are loaded.
+
+A model is a directory with model.py, weights.pt and optionally config.yml.
+The registry keeps, per model:
+
+- Its metadata (paths and parsed config.yml), re-read only when the
+  mtime or size of one of those files changes. Looking up one model costs
+  three stat() calls, not a rescan of MODELS_DIR.
+- The loaded model, if any. Loaded models are kept in LRU order and the
+  least recently used ones are dropped once their estimated size exceeds
+  `max_bytes` (AI_MODEL_CACHE_MAX_MB). The model just loaded is always kept.
+- When a model's files change, the next request loads the new version
+  while in-flight requests finish on the old one, then swaps it in. If the
+  new files fail to load (e.g. weights.pt is still being copied), the old
+  version keeps serving until the files change again.
+
+Models listed in AI_PRELOAD_MODELS (comma-separated, or "all") are loaded
+and run once on a background thread at startup (ml_inference.warm_model).
+
+Loading itself is done by the caller (ml_inference.get_model), so this
+module does not need torch.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+import yaml
+
+from metrics import MODEL_CACHE_BYTES, MODEL_CACHE_EVICTIONS, MODEL_CACHE_MODELS, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MODEL_FILENAME = "model.py"
+WEIGHTS_FILENAME = "weights.pt"
+CONFIG_FILENAME = "config.yml"
+
+Signature = tuple[tuple[int, int] | None, ...]
+
+
+def _load_yaml(path: Path) -> dict[str, Any] | None:
+    try:
+        with open(path, "r") as f:
+            return yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as exc:
+        logger.warning(f"Could not parse {path}: {exc}")
+        return None
+
+
+def _signature(model_dir: Path) -> Signature | None:
+    """(mtime, size) of the model's files; None unless model.py and weights.pt exist."""
+    out = []
+    for name in (MODEL_FILENAME, WEIGHTS_FILENAME, CONFIG_FILENAME):
+        try:
+            st = (model_dir / name).stat()
+        except (FileNotFoundError, NotADirectoryError):
+            if name != CONFIG_FILENAME:
+                return None
+            out.append(None)
+            continue
+        out.append((st.st_mtime_ns, st.st_size))
+    return tuple(out)
+
+
+@dataclass
+class _Loaded:
+    model: Any
+    signature: Signature
+    nbytes: int
+
+
+class ModelRegistry:
+    """Metadata and loaded models of every model under `models_dir`. Thread-safe."""
+
+    def __init__(self, models_dir: Path, max_bytes: int | None = None):
+        self.models_dir = models_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._info: dict[str, tuple[Signature, dict[str, Any]]] = {}
+        self._loaded: OrderedDict[str, _Loaded] = OrderedDict()
+        self._load_locks: dict[str, threading.Lock] = {}
+        self._failed: dict[str, Signature] = {}
+        REGISTRY.add_collector(self._collect)
+
+    def _lookup(self, ml_id: str) -> tuple[Signature, dict[str, Any]] | None:
+        if not ml_id or ml_id.startswith(".") or "/" in ml_id or "\\" in ml_id:
+            return None
+        model_dir = self.models_dir / ml_id
+        signature = _signature(model_dir)
+        with self._lock:
+            if signature is None:
+                self._info.pop(ml_id, None)
+                return None
+            cached = self._info.get(ml_id)
+        if cached is not None and cached[0] == signature:
+            return cached
+        info: dict[str, Any] = {
+            "ml_id": ml_id,
+            "name": ml_id,
+            "model_module_path": str(model_dir / MODEL_FILENAME),
+            "checkpoint_path": str(model_dir / WEIGHTS_FILENAME),
+            "config_path": None,
+            "config": None,
+        }
+        if signature[2] is not None:
+            info["config_path"] = str(model_dir / CONFIG_FILENAME)
+            info["config"] = _load_yaml(model_dir / CONFIG_FILENAME)
+        with self._lock:
+            self._info[ml_id] = (signature, info)
+        return signature, info
+
+    def get(self, ml_id: str) -> dict[str, Any] | None:
+        """Metadata of one model, or None if it does not exist."""
+        found = self._lookup(ml_id)
+        return None if found is None else found[1]
+
+    def list(self) -> list[dict[str, Any]]:
+        if not self.models_dir.exists():
+            return []
+        out = []
+        for model_dir in sorted(self.models_dir.iterdir()):
+            if model_dir.is_dir():
+                info = self.get(model_dir.name)
+                if info is not None:
+                    out.append(info)
+        return out
+
+    def is_loaded(self, ml_id: str) -> bool:
+        with self._lock:
+            return ml_id in self._loaded
+
+    def model(self, ml_id: str, load: Callable[[dict[str, Any]], tuple[Any, int]]) -> Any:
+        """The loaded model for `ml_id`, (re)loading it with `load(info)` if
+        needed; `load` returns the model and its estimated size in bytes.
+
+        Raises KeyError if the model does not exist.
+        """
+        found = self._lookup(ml_id)
+        if found is None:
+            raise KeyError(ml_id)
+        signature, info = found
+        with self._lock:
+            loaded = self._current(ml_id, signature)
+            if loaded is not None:
+                return loaded.model
+            load_lock = self._load_locks.setdefault(ml_id, threading.Lock())
+        with load_lock:
+            with self._lock:
+                # Another request may have loaded it while this one waited.
+                loaded = self._current(ml_id, signature)
+                if loaded is not None:
+                    return loaded.model
+                previous = self._loaded.get(ml_id)
+            try:
+                model, nbytes = load(info)
+            except Exception:
+                if previous is None:
+                    raise
+                logger.exception(f"Reloading model '{ml_id}' failed; keeping the previous version")
+                with self._lock:
+                    self._failed[ml_id] = signature
+                return previous.model
+            with self._lock:
+                self._failed.pop(ml_id, None)
+                self._loaded[ml_id] = _Loaded(model, signature, nbytes)
+                self._loaded.move_to_end(ml_id)
+                self._evict(keep=ml_id)
+        if previous is not None:
+            logger.info(f"Reloaded model '{ml_id}' after its files changed")
+        return model
+
+    def _current(self, ml_id: str, signature: Signature) -> _Loaded | None:
+        """The loaded version to serve, if it is up to date (or a newer one failed). Lock held."""
+        loaded = self._loaded.get(ml_id)
+        if loaded is None:
+            return None
+        if loaded.signature != signature and self._failed.get(ml_id) != signature:
+            return None
+        self._loaded.move_to_end(ml_id)
+        return loaded
+
+    def _evict(self, keep: str) -> None:
+        if self.max_bytes is None:
+            return
+        total = sum(m.nbytes for m in self._loaded.values())
+        for ml_id in list(self._loaded):
+            if total <= self.max_bytes:
+                break
+            if ml_id == keep:
+                continue
+            total -= self._loaded.pop(ml_id).nbytes
+            MODEL_CACHE_EVICTIONS.inc()
+            logger.info(f"Evicted model '{ml_id}' from the model cache")
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "models": list(self._loaded),
+                "bytes": sum(m.nbytes for m in self._loaded.values()),
+                "max_bytes": self.max_bytes,
+            }
+
+    def _collect(self) -> None:
+        stats = self.stats()
+        MODEL_CACHE_MODELS.clear()
+        for ml_id in stats["models"]:
+            MODEL_CACHE_MODELS.set(1, ml_id=ml_id)
+        MODEL_CACHE_BYTES.set(stats["bytes"])
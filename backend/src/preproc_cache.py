@@ -0,0 +1,177 @@
+"""Disk cache of preprocessed AI input volumes.
+
+The first inference on a session reads its volume with nibabel, then
+reorients, clips, normalizes and pads it. That costs seconds of CPU, and it
+is repeated for every new session on the same DATA_DIR volume and after
+every restart or RAM cache eviction. This module keeps the result on disk:
+
+    <cache_dir>/<key>/volume.npy   padded float32 tensor
+    <cache_dir>/<key>/meta.json    affine_ras, ras_dims, shape_before_pad
+
+`key` hashes the resolved volume path, its mtime and size, and the
+preprocessing version, so an edited volume or a changed pipeline simply
+misses. Hits are opened with `np.load(mmap_mode="c")`: nothing is read
+until the model needs it, and every session (and every worker process)
+that uses the same volume shares the same page-cache pages.
+
+Entries are written into a temporary directory and renamed into place, so
+readers never see a partial entry. When `max_bytes` is set, the least
+recently used entries are removed after each write; removing an entry that
+is still mapped is safe, the mapping keeps the pages alive.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PREPROC_DIRNAME = ".preprocessed"
+_VOLUME_FILENAME = "volume.npy"
+_META_FILENAME = "meta.json"
+_TMP_DIRNAME = "tmp"
+
+
+@dataclass
+class CachedVolume:
+    volume: "np.ndarray"  # memory-mapped, copy-on-write
+    affine_ras: "np.ndarray"
+    ras_dims: tuple[int, int, int]
+    shape_before_pad: tuple[int, int, int]
+
+
+class PreprocCache:
+    """Memory-mappable preprocessed volumes keyed by source file and pipeline version."""
+
+    def __init__(self, cache_dir: Path, max_bytes: int | None = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        (self.cache_dir / _TMP_DIRNAME).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(volume_path: Path, version: int | str) -> str:
+        """Cache key for the current contents of `volume_path`."""
+        st = volume_path.stat()
+        ident = f"{volume_path.resolve()}|{st.st_mtime_ns}|{st.st_size}|{version}"
+        return hashlib.sha1(ident.encode("utf-8")).hexdigest()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key: str) -> CachedVolume | None:
+        import numpy as np
+
+        entry = self.cache_dir / key
+        try:
+            with open(entry / _META_FILENAME) as f:
+                meta = json.load(f)
+            volume = np.load(entry / _VOLUME_FILENAME, mmap_mode="c")
+        except (OSError, ValueError) as exc:
+            if not isinstance(exc, FileNotFoundError):
+                logger.warning(f"Ignoring unreadable preprocessed volume {key}: {exc}")
+            self._count("misses")
+            return None
+        try:
+            # meta.json's mtime doubles as the LRU clock.
+            os.utime(entry / _META_FILENAME)
+        except OSError:
+            pass
+        self._count("hits")
+        return CachedVolume(
+            volume=volume,
+            affine_ras=np.asarray(meta["affine_ras"], dtype=np.float64),
+            ras_dims=tuple(meta["ras_dims"]),
+            shape_before_pad=tuple(meta["shape_before_pad"]),
+        )
+
+    def put(
+        self,
+        key: str,
+        volume: "np.ndarray",
+        affine_ras: "np.ndarray",
+        ras_dims: tuple[int, int, int],
+        shape_before_pad: tuple[int, int, int],
+        source: str = "",
+    ) -> None:
+        """Store one preprocessed volume. Failures are logged, never raised."""
+        import numpy as np
+
+        entry = self.cache_dir / key
+        if entry.exists():
+            return
+        tmp = Path(tempfile.mkdtemp(prefix=f"{key}-", dir=self.cache_dir / _TMP_DIRNAME))
+        try:
+            np.save(tmp / _VOLUME_FILENAME, np.ascontiguousarray(volume, dtype=np.float32))
+            with open(tmp / _META_FILENAME, "w") as f:
+                json.dump({
+                    "source": source,
+                    "affine_ras": np.asarray(affine_ras, dtype=np.float64).tolist(),
+                    "ras_dims": [int(n) for n in ras_dims],
+                    "shape_before_pad": [int(n) for n in shape_before_pad],
+                }, f)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # Another worker stored the same key first.
+                return
+        except OSError as exc:
+            logger.warning(f"Failed to cache preprocessed volume {source or key}: {exc}")
+            return
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._count("writes")
+        if self.max_bytes is not None:
+            self.prune(self.max_bytes)
+
+    def _entries(self) -> list[tuple[float, int, Path]]:
+        out = []
+        for entry in self.cache_dir.iterdir():
+            if entry.name == _TMP_DIRNAME or not entry.is_dir():
+                continue
+            try:
+                used = (entry / _META_FILENAME).stat().st_mtime
+                size = sum(p.stat().st_size for p in entry.iterdir())
+            except OSError:
+                continue
+            out.append((used, size, entry))
+        return out
+
+    def prune(self, max_bytes: int) -> int:
+        """Remove least recently used entries until the cache fits; returns the count."""
+        entries = sorted(self._entries())
+        total = sum(size for _used, size, _entry in entries)
+        removed = 0
+        for _used, size, entry in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"Pruned {removed} preprocessed volumes ({total / 2**20:.1f} MiB kept)")
+            with self._lock:
+                self._stats["evictions"] += removed
+        return removed
+
+    def stats(self) -> dict:
+        entries = self._entries()
+        with self._lock:
+            counters = dict(self._stats)
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _used, size, _entry in entries),
+            "max_bytes": self.max_bytes,
+            **counters,
+        }
@@ -0,0 +1,360 @@
+"""Multi-resolution pyramids for progressive volume loading.
+
+For a volume `<dir>/<name>` the builder writes downsampled copies to
+`<dir>/.pyramids/<name>/<factor>x.nii.gz` (2x, 4x and 8x by default). The
+listing endpoint advertises them as `levels` so the viewer can show a coarse
+level first and swap in the full-resolution volume once it has arrived.
+
+Intensity volumes are reduced by block mean and label volumes by block mode.
+The source is read sequentially, one slab of `max(factors)` slices at a time,
+straight from the (optionally gzipped) NIfTI byte stream, so the
+full-resolution array is never held in memory and gzip is decompressed once.
+Only the (much smaller) output levels are accumulated.
+
+Run as a CLI:
+    python pyramids.py [--factors 2 4 8] [--labels auto|yes|no] [--force] PATH...
+
+or in the background from the server (see `PyramidWorker`).
+"""
+import argparse
+import fcntl
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Literal
+
+logger = logging.getLogger(__name__)
+
+PYRAMID_DIRNAME = ".pyramids"
+_LOCK_FILENAME = ".lock"
+DEFAULT_FACTORS = (2, 4, 8)
+_LEVEL_RE = re.compile(r"^(\d+)x\.nii\.gz$")
+_LABEL_NAME_RE = re.compile(r"(seg|label|mask|aseg|aparc|parc)", re.IGNORECASE)
+_NIFTI_INTENT_LABEL = 1002
+
+
+def level_dir(volume_path: Path) -> Path:
+    return volume_path.parent / PYRAMID_DIRNAME / volume_path.name
+
+
+def level_path(volume_path: Path, factor: int) -> Path:
+    return level_dir(volume_path) / f"{factor}x.nii.gz"
+
+
+def parse_level_factor(filename: str) -> int | None:
+    """Return the factor encoded in a level filename such as '4x.nii.gz'."""
+    match = _LEVEL_RE.match(filename)
+    return int(match.group(1)) if match else None
+
+
+def is_stale(volume_path: Path, factors=DEFAULT_FACTORS) -> bool:
+    try:
+        source_mtime = volume_path.stat().st_mtime
+    except OSError:
+        return False
+    for factor in factors:
+        try:
+            if level_path(volume_path, factor).stat().st_mtime < source_mtime:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def _is_label_volume(img, volume_path: Path, mode: str) -> bool:
+    import numpy as np
+
+    if mode != "auto":
+        return mode == "yes"
+    header = img.header
+    if int(header.get("intent_code", 0)) == _NIFTI_INTENT_LABEL:
+        return True
+    slope, inter = header.get_slope_inter()
+    unscaled = slope in (None, 1.0) and inter in (None, 0.0)
+    integer = np.issubdtype(header.get_data_dtype(), np.integer)
+    return integer and unscaled and bool(_LABEL_NAME_RE.search(volume_path.name))
+
+
+def block_mean(slab, factor: int):
+    """Mean over non-overlapping factor^3 blocks; trailing edges are replicated."""
+    import numpy as np
+
+    blocks = _blocks(slab, factor)
+    return blocks.mean(axis=-1, dtype=np.float64)
+
+
+def block_mode(slab, factor: int):
+    """Most frequent value in each factor^3 block (ties go to the lower value)."""
+    import numpy as np
+
+    blocks = np.sort(_blocks(slab, factor), axis=-1)
+    n = blocks.shape[-1]
+    positions = np.arange(n)
+    starts = np.empty(blocks.shape, dtype=np.intp)
+    starts[..., 0] = 0
+    starts[..., 1:] = np.where(blocks[..., 1:] != blocks[..., :-1], positions[1:], 0)
+    run_lengths = positions - np.maximum.accumulate(starts, axis=-1)
+    best = np.argmax(run_lengths, axis=-1)
+    return np.take_along_axis(blocks, best[..., None], axis=-1)[..., 0]
+
+
+def _blocks(slab, factor: int):
+    """View a (X, Y, Z) slab as (X/f, Y/f, Z/f, f^3), padding edges to a multiple."""
+    import numpy as np
+
+    pads = [(0, (-s) % factor) for s in slab.shape]
+    if any(p for _, p in pads):
+        slab = np.pad(slab, pads, mode="edge")
+    x, y, z = (s // factor for s in slab.shape)
+    return (slab.reshape(x, factor, y, factor, z, factor)
+                .transpose(0, 2, 4, 1, 3, 5)
+                .reshape(x, y, z, factor ** 3))
+
+
+def _level_affine(affine, factor: int):
+    import numpy as np
+
+    scale = np.diag([factor, factor, factor, 1.0])
+    scale[:3, 3] = (factor - 1) / 2.0
+    return affine @ scale
+
+
+def iter_slabs(img, volume_path: Path, step: int, scale: bool = True):
+    """Yield (frame, z0, slab) for a NIfTI volume, `step` slices at a time.
+
+    Reads the image bytes sequentially from the (optionally gzipped) file, so
+    each slab is decoded exactly once and only one slab is resident. With
+    `scale`, the NIfTI slope/intercept is applied to every slab.
+    """
+    import nibabel as nib
+    import numpy as np
+    from nibabel.openers import ImageOpener
+
+    if not isinstance(img, (nib.Nifti1Image, nib.Nifti2Image)):
+        raise ValueError(f"Only NIfTI volumes can be streamed: {volume_path}")
+    shape = img.shape
+    if len(shape) < 3:
+        raise ValueError(f"Expected a 3D or 4D volume: {volume_path}")
+    nx, ny, nz = shape[:3]
+    n_frames = int(np.prod(shape[3:])) if len(shape) > 3 else 1
+    # The image header's offset is reset on load; the proxy keeps the on-disk layout.
+    proxy = img.dataobj
+    slope, inter = float(proxy.slope), float(proxy.inter)
+    scale = scale and (slope != 1.0 or inter != 0.0)
+    slice_bytes = nx * ny * proxy.dtype.itemsize
+
+    with ImageOpener(str(volume_path), "rb") as fobj:
+        fobj.seek(proxy.offset)
+        for frame in range(n_frames):
+            for z0 in range(0, nz, step):
+                nslices = min(step, nz - z0)
+                buf = fobj.read(slice_bytes * nslices)
+                if len(buf) != slice_bytes * nslices:
+                    raise ValueError(f"Truncated image data in {volume_path}")
+                slab = np.frombuffer(buf, dtype=proxy.dtype).reshape(
+                    (nx, ny, nslices), order="F")
+                if scale:
+                    slab = slab * slope + inter
+                yield frame, z0, slab
+
+
+def build_pyramid(
+    volume_path: Path,
+    factors=DEFAULT_FACTORS,
+    labels: Literal["auto", "yes", "no"] = "auto",
+    force: bool = False,
+) -> list[Path]:
+    """Write the pyramid levels for one NIfTI volume; return the paths written."""
+    import nibabel as nib
+    import numpy as np
+
+    factors = tuple(sorted(set(int(f) for f in factors)))
+    if any(max(factors) % f for f in factors):
+        raise ValueError(f"Every factor must divide the largest one: {list(factors)}")
+    if not force and not is_stale(volume_path, factors):
+        return []
+
+    img = nib.load(str(volume_path))
+    if not isinstance(img, (nib.Nifti1Image, nib.Nifti2Image)):
+        raise ValueError(f"Pyramids are only supported for NIfTI volumes: {volume_path}")
+    header = img.header
+    shape = img.shape
+    if len(shape) < 3:
+        raise ValueError(f"Expected a 3D or 4D volume: {volume_path}")
+    nx, ny, nz = shape[:3]
+    n_frames = int(np.prod(shape[3:])) if len(shape) > 3 else 1
+    dtype = img.dataobj.dtype
+    scaled = float(img.dataobj.slope) != 1.0 or float(img.dataobj.inter) != 0.0
+    use_mode = _is_label_volume(img, volume_path, labels)
+    out_dtype = dtype if use_mode or not scaled else np.dtype(np.float32)
+
+    levels = {
+        f: np.zeros((-(-nx // f), -(-ny // f), -(-nz // f), n_frames), dtype=out_dtype)
+        for f in factors
+    }
+    for frame, z0, slab in iter_slabs(img, volume_path, max(factors), scale=not use_mode):
+        for f, level in levels.items():
+            reduced = block_mode(slab, f) if use_mode else block_mean(slab, f)
+            if np.issubdtype(out_dtype, np.integer) and not use_mode:
+                reduced = np.rint(reduced)
+            zs = z0 // f
+            level[:, :, zs:zs + reduced.shape[2], frame] = reduced
+
+    written: list[Path] = []
+    out_dir = level_dir(volume_path)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for f, level in levels.items():
+        data = level[..., 0] if n_frames == 1 else level.reshape(level.shape[:3] + shape[3:])
+        out_header = header.copy()
+        out_header.set_data_dtype(out_dtype)
+        out_header.set_slope_inter(np.nan, np.nan)
+        out = img.__class__(data, _level_affine(img.affine, f), out_header)
+        target = level_path(volume_path, f)
+        tmp = target.with_name(f".{target.name[:-len('.nii.gz')]}.{os.getpid()}.tmp.nii.gz")
+        nib.save(out, str(tmp))
+        os.replace(tmp, target)
+        written.append(target)
+    logger.info(
+        f"Pyramid built for {volume_path} "
+        f"({'mode' if use_mode else 'mean'}, factors {list(factors)})"
+    )
+    return written
+
+
+class PyramidWorker:
+    """Background thread that builds missing or stale pyramids for large files.
+
+    On each pass it asks the data catalog for the imaging files in
+    directories that changed since the previous pass (all of them on the
+    first) and builds levels, one volume at a time, for those of at least
+    `min_bytes`. Files modified within the last `interval_seconds` may still
+    be being written, so they are checked again on the next pass.
+
+    With several server processes, only the one holding the flock on
+    `<root>/.pyramids/.lock` builds; the others retry the lock every
+    interval and take over if that process exits.
+    """
+
+    def __init__(
+        self,
+        catalog,
+        patterns: list[str],
+        min_bytes: int,
+        interval_seconds: float = 300.0,
+        factors=DEFAULT_FACTORS,
+    ):
+        self.catalog = catalog
+        self.patterns = patterns
+        self.min_bytes = min_bytes
+        self.interval_seconds = interval_seconds
+        self.factors = factors
+        self._seen: dict[str, int] = {}
+        self._recent: set[str] = set()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="pyramid-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def run_once(self) -> int:
+        built = 0
+        candidates = set(self.catalog.changed_files(self.patterns, self._seen)) | self._recent
+        self._recent = set()
+        for rel in sorted(candidates):
+            if self._stop.is_set():
+                self._recent.add(rel)
+                continue
+            path = self.catalog.root / rel
+            try:
+                st = path.stat()
+                if time.time() - st.st_mtime < self.interval_seconds:
+                    self._recent.add(rel)
+                if st.st_size < self.min_bytes or not is_stale(path, self.factors):
+                    continue
+                if build_pyramid(path, self.factors):
+                    built += 1
+            except FileNotFoundError:
+                continue
+            except Exception as exc:
+                logger.warning(f"Pyramid build failed for {path}: {exc}")
+        return built
+
+    def _try_lock(self) -> int | None:
+        """Take the builder lock without blocking; return its fd, or None."""
+        lock_path = self.catalog.root / PYRAMID_DIRNAME / _LOCK_FILENAME
+        try:
+            lock_path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as exc:
+            logger.warning(f"Pyramid worker: cannot open {lock_path}: {exc}")
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        logger.info(f"Pyramid worker: building pyramids in process {os.getpid()}")
+        return fd
+
+    def _run(self) -> None:
+        fd = None
+        try:
+            while not self._stop.is_set():
+                if fd is None:
+                    fd = self._try_lock()
+                if fd is not None:
+                    self.run_once()
+                self._stop.wait(self.interval_seconds)
+        finally:
+            if fd is not None:
+                os.close(fd)  # also releases the lock
+
+
+def _iter_volumes(paths: list[str], patterns: list[str]):
+    for p in map(Path, paths):
+        if p.is_dir():
+            for pattern in patterns:
+                for found in sorted(p.rglob(pattern)):
+                    if PYRAMID_DIRNAME not in found.parts:
+                        yield found
+        else:
+            yield p
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Build downsampled pyramid levels next to NIfTI volumes.",
+    )
+    parser.add_argument("paths", nargs="+", help="Volumes or directories to process")
+    parser.add_argument("--factors", nargs="+", type=int, default=list(DEFAULT_FACTORS),
+                        help="Downsampling factors (default: 2 4 8)")
+    parser.add_argument("--labels", choices=["auto", "yes", "no"], default="auto",
+                        help="Use block mode (label volumes) instead of block mean")
+    parser.add_argument("--patterns", nargs="+", default=["*.nii", "*.nii.gz"],
+                        help="Glob patterns used when a directory is given")
+    parser.add_argument("--force", action="store_true", help="Rebuild up-to-date levels")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    failures = 0
+    for volume in _iter_volumes(args.paths, args.patterns):
+        try:
+            build_pyramid(volume, args.factors, labels=args.labels, force=args.force)
+        except Exception as exc:
+            failures += 1
+            logger.error(f"{volume}: {exc}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Queue for AI inference jobs.
+
+Inference requests are queued here rather than run directly on the
+request threadpool:
+
+- At most `max_concurrent` jobs run at once (one worker thread each), and
+  never more than a job's `model_limit` for the same model.
+- Jobs for one session run one at a time, in arrival order, so two quick
+  clicks cannot race on the session's cached logits.
+- A queued job is superseded when a newer request for the same session,
+  model and label arrives before it starts. Its waiters get the newer job's
+  result instead, so a burst of clicks costs one forward pass rather than
+  one per click.
+
+Jobs are kept for `job_ttl_seconds` after they finish so that clients using
+the asynchronous API can poll them by id.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections.abc import Callable
+from typing import Any
+
+from metrics import INFERENCE_COALESCED, INFERENCE_QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SUPERSEDED = "superseded"
+
+
+class Job:
+    """One inference request; `run` is called with no arguments on a worker."""
+
+    def __init__(
+        self,
+        session_id: str,
+        ml_id: str,
+        run: Callable[[], Any],
+        coalesce_key: Any = None,
+        model_limit: int | None = None,
+        timer=None,
+    ):
+        self.job_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.ml_id = ml_id
+        self.coalesce_key = coalesce_key
+        self.model_limit = model_limit
+        self.timer = timer
+        self.status = QUEUED
+        self.result: Any = None
+        self.error: BaseException | None = None
+        self.superseded_by: "Job | None" = None
+        self.submitted_at = time.time()
+        self.finished_at: float | None = None
+        self._run = run
+        self._done = threading.Event()
+
+    def _finish(self, status: str) -> None:
+        self.status = status
+        self.finished_at = time.time()
+        self._run = None
+        self._done.set()
+
+    def wait(self, timeout: float | None = None) -> "Job":
+        """Block until this job, or the job that superseded it, has finished.
+
+        Returns the job that produced the result; re-raises its error. Raises
+        TimeoutError if that takes longer than `timeout` seconds in total.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        job = self
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not job._done.wait(remaining):
+                raise TimeoutError(job.job_id)
+            if job.status != SUPERSEDED:
+                break
+            job = job.superseded_by
+        if job.error is not None:
+            raise job.error
+        return job
+
+    def describe(self) -> dict[str, Any]:
+        out: dict[str, Any] = {
+            "job_id": self.job_id,
+            "session_id": self.session_id,
+            "ml_id": self.ml_id,
+            "status": self.status,
+        }
+        if self.superseded_by is not None:
+            out["superseded_by"] = self.superseded_by.job_id
+        if self.status == DONE:
+            # Binary payloads (inline masks) are only returned to the submitter.
+            out["result"] = {k: v for k, v in self.result.items() if not isinstance(v, bytes)}
+        elif self.status == FAILED:
+            out["error"] = {
+                "status_code": getattr(self.error, "status_code", 500),
+                "detail": getattr(self.error, "detail", str(self.error)),
+            }
+        return out
+
+
+class InferenceScheduler:
+    """Bounded, per-session ordered and coalescing inference queue."""
+
+    def __init__(self, max_concurrent: int = 1, job_ttl_seconds: float = 600.0):
+        self.max_concurrent = max(1, max_concurrent)
+        self.job_ttl_seconds = job_ttl_seconds
+        self._cond = threading.Condition()
+        self._queue: list[Job] = []
+        self._jobs: dict[str, Job] = {}
+        self._running_sessions: set[str] = set()
+        self._running_models: dict[str, int] = {}
+        self._workers: list[threading.Thread] = []
+
+    def _start(self) -> None:
+        for i in range(self.max_concurrent):
+            worker = threading.Thread(
+                target=self._work, name=f"ai-inference-{i}", daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, job: Job) -> Job:
+        with self._cond:
+            if not self._workers:
+                self._start()
+            self._prune()
+            self._jobs[job.job_id] = job
+            last = max(
+                (i for i, queued in enumerate(self._queue) if queued.session_id == job.session_id),
+                default=None,
+            )
+            if last is not None and self._queue[last].coalesce_key == job.coalesce_key:
+                # Take over the superseded job's place in the queue.
+                superseded = self._queue[last]
+                superseded.superseded_by = job
+                superseded._finish(SUPERSEDED)
+                self._queue[last] = job
+                INFERENCE_COALESCED.inc(ml_id=job.ml_id)
+            else:
+                self._queue.append(job)
+                INFERENCE_QUEUE_DEPTH.inc()
+            self._cond.notify_all()
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict[str, Any]:
+        with self._cond:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "queued": len(self._queue),
+                "running": sum(self._running_models.values()),
+                "running_by_model": dict(self._running_models),
+            }
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.job_ttl_seconds
+        stale = [jid for jid, j in self._jobs.items()
+                 if j.finished_at is not None and j.finished_at < cutoff]
+        for jid in stale:
+            del self._jobs[jid]
+
+    def _next_job(self) -> Job | None:
+        """First queued job whose session is idle and whose model has capacity."""
+        blocked: set[str] = set()
+        for i, job in enumerate(self._queue):
+            if job.session_id in blocked or job.session_id in self._running_sessions:
+                blocked.add(job.session_id)  # keep per-session order
+                continue
+            running = self._running_models.get(job.ml_id, 0)
+            if job.model_limit is not None and running >= job.model_limit:
+                blocked.add(job.session_id)
+                continue
+            return self._queue.pop(i)
+        return None
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                job.status = RUNNING
+                self._running_sessions.add(job.session_id)
+                self._running_models[job.ml_id] = self._running_models.get(job.ml_id, 0) + 1
+            if job.timer is not None:
+                job.timer.add("queue", (time.time() - job.submitted_at) * 1000.0)
+            try:
+                job.result = job._run()
+                status = DONE
+            except Exception as exc:
+                job.error = exc
+                status = FAILED
+                if not hasattr(exc, "status_code"):
+                    logger.exception(f"Inference job {job.job_id} failed")
+            with self._cond:
+                self._running_sessions.discard(job.session_id)
+                self._running_models[job.ml_id] -= 1
+                if not self._running_models[job.ml_id]:
+                    del self._running_models[job.ml_id]
+                INFERENCE_QUEUE_DEPTH.dec()
+                job._finish(status)
+                self._cond.notify_all()
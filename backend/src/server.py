@@ -4,13 +4,31 @@ import mimetypes
 import logging
 import uuid
 import base64
+import sqlite3
 from pathlib import Path
+from urllib.parse import quote
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 
 from ai_session import build_router as build_ai_router
+from batching import MicroBatcher
+from blobs import BlobStore, document_blob_refs, supports_reflinks
+from blobs import build_router as build_blob_router
+from catalog import DataCatalog
+from metrics import BYTES_WRITTEN, REGISTRY, MetricsMiddleware
+from preproc_cache import PREPROC_DIRNAME, PreprocCache
+from session_state import STATE_DIRNAME, SharedSessionState
+from pyramids import PYRAMID_DIRNAME, PyramidWorker, parse_level_factor
+from slices import build_router as build_slice_router
+from thumbnails import THUMBNAIL_DIRNAME
+from thumbnails import thumbnail_version
+from volume_meta import META_DIRNAME, VolumeMetaIndex, read_header_meta
+from thumbnails import build_router as build_thumbnail_router
+from uploads import build_router as build_upload_router
+from uploads import normalize_volume_filename, resolve_target, stream_to_file, write_atomic
 
 # Configure logging.  Possible logging levels are:
 #   - logging.DEBUG
@@ -32,7 +50,38 @@ ai_dir = os.getenv('AI_DIR')
 models_dir = os.getenv('MODELS_DIR')
 enable_ai = os.getenv('ENABLE_AI', 'false').lower() == 'true' and not serverless_mode
 enable_ai_history = os.getenv('ENABLE_AI_HISTORY', 'false').lower() == 'true' and enable_ai
+ai_history_deltas = os.getenv('AI_HISTORY_DELTAS', 'false').lower() == 'true' and enable_ai_history
 ai_cache_ttl_seconds = int(os.getenv('AI_SESSION_CACHE_TTL_SECONDS', '1800'))
+ai_cache_max_mb = int(os.getenv('AI_SESSION_CACHE_MAX_MB', '8192'))
+ai_cache_sweep_seconds = float(os.getenv('AI_SESSION_CACHE_SWEEP_SECONDS', '60'))
+enable_ai_preproc_cache = os.getenv('ENABLE_AI_PREPROC_CACHE', 'false').lower() == 'true' and enable_ai
+ai_preproc_cache_dir = os.getenv('AI_PREPROC_CACHE_DIR')
+ai_preproc_cache_max_mb = int(os.getenv('AI_PREPROC_CACHE_MAX_MB', '20480'))
+enable_ai_shared_state = os.getenv('ENABLE_AI_SHARED_STATE', 'false').lower() == 'true' and enable_ai
+ai_session_state_dir = os.getenv('AI_SESSION_STATE_DIR')
+ai_session_lease_timeout_seconds = float(os.getenv('AI_SESSION_LEASE_TIMEOUT_SECONDS', '120'))
+ai_session_catalog_db = os.getenv('AI_SESSION_CATALOG_DB')
+ai_inference_concurrency = int(os.getenv('AI_INFERENCE_CONCURRENCY', '1'))
+ai_inference_model_concurrency = int(os.getenv('AI_INFERENCE_MODEL_CONCURRENCY', '0'))
+ai_job_ttl_seconds = float(os.getenv('AI_JOB_TTL_SECONDS', '600'))
+ai_infer_wait_timeout_seconds = float(os.getenv('AI_INFER_WAIT_TIMEOUT_SECONDS', '300'))
+ai_inference_memory_mb = int(os.getenv('AI_INFERENCE_MEMORY_MB', '0'))
+enable_ai_batching = os.getenv('ENABLE_AI_BATCHING', 'false').lower() == 'true' and enable_ai
+ai_batch_max_size = int(os.getenv('AI_BATCH_MAX_SIZE', '4'))
+ai_batch_window_ms = float(os.getenv('AI_BATCH_WINDOW_MS', '5'))
+ai_model_cache_max_mb = int(os.getenv('AI_MODEL_CACHE_MAX_MB', '0'))
+ai_preload_models = [m.strip() for m in os.getenv('AI_PRELOAD_MODELS', '').split(',') if m.strip()]
+data_catalog_refresh_seconds = float(os.getenv('DATA_CATALOG_REFRESH_SECONDS', '30'))
+upload_staging_ttl_seconds = int(os.getenv('UPLOAD_STAGING_TTL_SECONDS', '86400'))
+slice_cache_mb = int(os.getenv('SLICE_CACHE_MB', '1024'))
+enable_pyramids = os.getenv('ENABLE_PYRAMIDS', 'false').lower() == 'true' and not serverless_mode
+pyramid_min_mb = int(os.getenv('PYRAMID_MIN_MB', '64'))
+enable_thumbnails = os.getenv('ENABLE_THUMBNAILS', 'false').lower() == 'true' and not serverless_mode
+thumbnail_size = int(os.getenv('THUMBNAIL_SIZE', '96'))
+thumbnail_workers = int(os.getenv('THUMBNAIL_WORKERS', '2'))
+volume_meta_db = os.getenv('VOLUME_META_DB')
+enable_blob_store = os.getenv('ENABLE_BLOB_STORE', 'false').lower() == 'true' and not serverless_mode
+enable_metrics = os.getenv('ENABLE_METRICS', 'false').lower() == 'true'
 
 logger.info(f"NIIVUE_BUILD_DIR: {static_dir}")
 logger.info(f"DATA_DIR: {data_dir}")
@@ -43,7 +92,38 @@ logger.info(f"AI_DIR: {ai_dir}")
 logger.info(f"MODELS_DIR: {models_dir}")
 logger.info(f"ENABLE_AI: {enable_ai}")
 logger.info(f"ENABLE_AI_HISTORY: {enable_ai_history}")
+logger.info(f"AI_HISTORY_DELTAS: {ai_history_deltas}")
 logger.info(f"AI_SESSION_CACHE_TTL_SECONDS: {ai_cache_ttl_seconds}")
+logger.info(f"AI_SESSION_CACHE_MAX_MB: {ai_cache_max_mb}")
+logger.info(f"AI_SESSION_CACHE_SWEEP_SECONDS: {ai_cache_sweep_seconds}")
+logger.info(f"ENABLE_AI_PREPROC_CACHE: {enable_ai_preproc_cache}")
+logger.info(f"AI_PREPROC_CACHE_DIR: {ai_preproc_cache_dir}")
+logger.info(f"AI_PREPROC_CACHE_MAX_MB: {ai_preproc_cache_max_mb}")
+logger.info(f"ENABLE_AI_SHARED_STATE: {enable_ai_shared_state}")
+logger.info(f"AI_SESSION_STATE_DIR: {ai_session_state_dir}")
+logger.info(f"AI_SESSION_LEASE_TIMEOUT_SECONDS: {ai_session_lease_timeout_seconds}")
+logger.info(f"AI_SESSION_CATALOG_DB: {ai_session_catalog_db}")
+logger.info(f"AI_INFERENCE_CONCURRENCY: {ai_inference_concurrency}")
+logger.info(f"AI_INFERENCE_MODEL_CONCURRENCY: {ai_inference_model_concurrency}")
+logger.info(f"AI_JOB_TTL_SECONDS: {ai_job_ttl_seconds}")
+logger.info(f"AI_INFER_WAIT_TIMEOUT_SECONDS: {ai_infer_wait_timeout_seconds}")
+logger.info(f"AI_INFERENCE_MEMORY_MB: {ai_inference_memory_mb}")
+logger.info(f"ENABLE_AI_BATCHING: {enable_ai_batching}")
+logger.info(f"AI_BATCH_MAX_SIZE: {ai_batch_max_size}")
+logger.info(f"AI_BATCH_WINDOW_MS: {ai_batch_window_ms}")
+logger.info(f"AI_MODEL_CACHE_MAX_MB: {ai_model_cache_max_mb}")
+logger.info(f"AI_PRELOAD_MODELS: {ai_preload_models}")
+logger.info(f"DATA_CATALOG_REFRESH_SECONDS: {data_catalog_refresh_seconds}")
+logger.info(f"UPLOAD_STAGING_TTL_SECONDS: {upload_staging_ttl_seconds}")
+logger.info(f"SLICE_CACHE_MB: {slice_cache_mb}")
+logger.info(f"ENABLE_PYRAMIDS: {enable_pyramids}")
+logger.info(f"PYRAMID_MIN_MB: {pyramid_min_mb}")
+logger.info(f"ENABLE_THUMBNAILS: {enable_thumbnails}")
+logger.info(f"THUMBNAIL_SIZE: {thumbnail_size}")
+logger.info(f"THUMBNAIL_WORKERS: {thumbnail_workers}")
+logger.info(f"VOLUME_META_DB: {volume_meta_db}")
+logger.info(f"ENABLE_BLOB_STORE: {enable_blob_store}")
+logger.info(f"ENABLE_METRICS: {enable_metrics}")
 
 # Register the MIME type so that .gz files (or .nii.gz files) are served correctly.
 mimetypes.add_type("application/gzip", ".nii.gz", strict=True)
@@ -58,45 +138,166 @@ class SaveVolumeRequest(BaseModel):
 
 app = FastAPI()
 
+# Request counts/latency for /data/* and /ai/*, scraped from GET /metrics
+if enable_metrics:
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/metrics")
+    def get_metrics():
+        return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+# Index of DATA_DIR shared by the listing endpoints; refreshed in the background.
+data_catalog = None
+if not serverless_mode:
+    data_catalog = DataCatalog(Path(data_dir), refresh_seconds=data_catalog_refresh_seconds)
+    data_catalog.start()
+
+# Header-only volume metadata, persisted across restarts (see volume_meta.py)
+volume_meta_index = None
+if not serverless_mode:
+    try:
+        volume_meta_index = VolumeMetaIndex(
+            Path(volume_meta_db) if volume_meta_db else Path(data_dir) / META_DIRNAME / 'volume-meta.sqlite',
+            Path(data_dir),
+        )
+    except (OSError, sqlite3.Error) as e:
+        # e.g. a read-only DATA_DIR: parse headers on every request instead
+        logger.warning(f"Volume metadata index unavailable, reading headers directly: {e}")
+
+# Content-addressed storage for saved volumes (see blobs.py)
+blob_store = None
+if enable_blob_store:
+    if supports_reflinks(Path(data_dir)):
+        blob_store = BlobStore(Path(data_dir))
+    else:
+        # Without reflinks every save would be stored twice (blob plus copy).
+        logger.warning("ENABLE_BLOB_STORE ignored: DATA_DIR does not support reflinks (btrfs, XFS)")
+
+# Background builder for downsampled levels of large volumes (see pyramids.py)
+if enable_pyramids:
+    PyramidWorker(
+        data_catalog,
+        imaging_extensions,
+        min_bytes=pyramid_min_mb * 1024 * 1024,
+    ).start()
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+def _file_entry(rel_path: str) -> dict:
+    return {"filename": rel_path, "url": "data/" + rel_path}
+
+def _imaging_entry(rel_path: str) -> dict:
+    """File entry plus its thumbnail URL and any pyramid levels, coarsest last."""
+    entry = _file_entry(rel_path)
+    if enable_thumbnails:
+        entry["thumbnail"] = "data/thumb?path=" + quote(rel_path)
+        # Pin the URL to the indexed version (part of the listing ETag) so
+        # browsers may cache it for good.
+        file_stat = data_catalog.file_stat(rel_path)
+        if file_stat is not None:
+            entry["thumbnail"] += "&v=" + thumbnail_version(*file_stat, thumbnail_size)
+    parent, _, name = rel_path.rpartition("/")
+    level_base = "/".join(p for p in (parent, PYRAMID_DIRNAME, name) if p)
+    levels = []
+    for level_name in data_catalog.sidecar_files(rel_path, PYRAMID_DIRNAME):
+        factor = parse_level_factor(level_name)
+        if factor is not None:
+            levels.append({"factor": factor, "url": f"data/{level_base}/{level_name}"})
+    if levels:
+        entry["levels"] = sorted(levels, key=lambda level: level["factor"])
+    return entry
+
+def _list_catalog(request, response, patterns, prefix, subdir, offset, limit,
+                  make_entry=_file_entry):
+    """Serve one page of the data catalog, honouring If-None-Match."""
+    page = data_catalog.query(patterns, prefix=prefix, subdir=subdir,
+                              offset=offset, limit=limit)
+    headers = {
+        "ETag": page.etag,
+        "Cache-Control": "no-cache",
+        "X-Total-Count": str(page.total),
+    }
+    if _etag_matches(request, page.etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return [make_entry(p) for p in page.paths]
+
 # Define API routes BEFORE static file mounts to prevent catch-all behavior
 @app.get("/data/nvd")
-def list_niivue_documents():
+def list_niivue_documents(
+    request: Request,
+    response: Response,
+    prefix: str | None = None,
+    subdir: str | None = None,
+    offset: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1),
+):
     if serverless_mode:
         raise HTTPException(status_code=404, detail="Endpoint not available in serverless mode")
-    nvd_dir = os.path.join(data_dir)
-    logger.debug(f"Looking for niivue documents (.nvd) files recursivly in {nvd_dir}")
-    nvd_files = []
+    logger.debug(f"Listing niivue documents (.nvd, .nvdb) from the catalog of {data_dir}")
     try:
-      for filepath in Path(nvd_dir).rglob('*.nvd'):
-        rel_filepath = str(filepath.relative_to(nvd_dir))
-        nvd_file = {
-            "filename": rel_filepath,
-            "url": "data/" + rel_filepath
-        }
-        nvd_files.append(nvd_file)
+        return _list_catalog(request, response, ['*.nvd', '*.nvdb'], prefix, subdir, offset, limit)
     except Exception as e:
         return {"error": str(e)}
-    return sorted(nvd_files, key=lambda x: x["url"])
 
 @app.get("/data/vol")
-def list_imaging_files():
+def list_imaging_files(
+    request: Request,
+    response: Response,
+    prefix: str | None = None,
+    subdir: str | None = None,
+    offset: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1),
+):
     if serverless_mode:
         raise HTTPException(status_code=404, detail="Endpoint not available in serverless mode")
-    imaging_dir = os.path.join(data_dir)
-    logger.debug(f"Looking for imaging files {imaging_extensions} recursively in {imaging_dir}")
-    imaging_files = []
+    logger.debug(f"Listing imaging files {imaging_extensions} from the catalog of {data_dir}")
     try:
-        for pattern in imaging_extensions:
-            for filepath in Path(imaging_dir).rglob(pattern):
-                rel_filepath = str(filepath.relative_to(imaging_dir))
-                imaging_file = {
-                    "filename": rel_filepath,
-                    "url": "data/" + rel_filepath
-                }
-                imaging_files.append(imaging_file)
+        return _list_catalog(request, response, imaging_extensions, prefix, subdir, offset, limit,
+                             make_entry=_imaging_entry)
     except Exception as e:
         return {"error": str(e)}
-    return sorted(imaging_files, key=lambda x: x["url"])
+
+@app.get("/data/vol/meta")
+def list_imaging_metadata(
+    path: list[str] | None = Query(None),
+    prefix: str | None = None,
+    subdir: str | None = None,
+    offset: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1),
+):
+    """
+    Header-derived metadata for imaging files.
+
+    Either for the given `path`s, or for the same page of files that
+    GET /data/vol returns for the given filters. Each entry carries dims,
+    RAS dims, voxel size, dtype, orientation code, file size and the
+    intensity range (null until computed in the background).
+    """
+    if serverless_mode:
+        raise HTTPException(status_code=404, detail="Endpoint not available in serverless mode")
+    if path:
+        rel_paths = [p[5:] if p.startswith('data/') else p for p in path]
+    else:
+        rel_paths = data_catalog.query(imaging_extensions, prefix=prefix, subdir=subdir,
+                                       offset=offset, limit=limit).paths
+    entries = []
+    for rel_path in rel_paths:
+        entry = _file_entry(rel_path)
+        try:
+            if volume_meta_index is not None:
+                entry["meta"] = volume_meta_index.get(rel_path)
+            else:
+                entry["meta"] = read_header_meta(resolve_target(Path(data_dir), rel_path))
+        except Exception as e:
+            entry["error"] = str(e)
+        entries.append(entry)
+    return entries
 
 @app.post("/data/nvd")
 def save_scene(request: SaveSceneRequest):
@@ -131,6 +332,12 @@ def save_scene(request: SaveSceneRequest):
         # Write the JSON data to file
         with open(file_path, 'w') as f:
             json.dump(request.data, f, indent=2)
+        BYTES_WRITTEN.inc(file_path.stat().st_size, kind="scene")
+        data_catalog.notify_changed(file_path)
+        if blob_store is not None:
+            blob_store.set_document_refs(
+                str(file_path.relative_to(data_dir)), document_blob_refs(request.data),
+            )
         
         logger.info(f"Scene saved successfully to {file_path}")
         
@@ -158,18 +365,7 @@ def save_volume(request: SaveVolumeRequest):
     if serverless_mode:
         raise HTTPException(status_code=404, detail="Endpoint not available in serverless mode")
     try:
-        # Validate filename
-        if not request.filename:
-            raise HTTPException(status_code=400, detail="Filename is required")
-        
-        # Remove 'data/' prefix if present (frontend URLs vs backend paths)
-        filename = request.filename
-        if filename.startswith('data/'):
-            filename = filename[5:]  # Remove 'data/' prefix
-        
-        # Ensure filename has .nii or .nii.gz extension
-        if not filename.endswith('.nii') and not filename.endswith('.nii.gz'):
-            filename = filename + '.nii.gz'  # Default to compressed
+        filename = normalize_volume_filename(request.filename)
         
         # Decode base64 data
         try:
@@ -177,37 +373,153 @@ def save_volume(request: SaveVolumeRequest):
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Invalid base64 data: {str(e)}")
         
-        # Create full file path
-        file_path = Path(data_dir) / filename
-        
-        # Create directory if it doesn't exist
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        # Write the binary data to file
-        with open(file_path, 'wb') as f:
-            f.write(volume_data)
+        # Write via a temp file + rename so readers never see a partial volume
+        file_path = resolve_target(Path(data_dir), filename)
+        if blob_store is not None:
+            blob_store.link(blob_store.put_bytes(volume_data), file_path)
+        else:
+            write_atomic(file_path, volume_data)
+            BYTES_WRITTEN.inc(len(volume_data), kind="volume")
+        data_catalog.notify_changed(file_path)
         
         logger.info(f"Volume saved successfully to {file_path}")
         
         return {
             "success": True,
             "message": f"Volume saved successfully to {filename}",
-            "file_path": str(file_path.relative_to(data_dir))
+            "file_path": str(file_path.relative_to(Path(data_dir).resolve()))
         }
         
     except Exception as e:
         logger.error(f"Error saving volume: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to save volume: {str(e)}")
 
+@app.put("/data/nii")
+async def stream_volume(
+    request: Request,
+    filename: str,
+    x_content_sha256: str | None = Header(default=None),
+):
+    """
+    Save volume data streamed as the raw request body (application/octet-stream).
+
+    Unlike POST /data/nii, the body is the NIfTI file itself rather than
+    base64 inside JSON. It is written to a temp file chunk by chunk and
+    renamed into place, so memory use stays flat regardless of volume size.
+
+    With the blob store enabled, the body is stored by its sha256 (checked
+    against X-Content-Sha256 when given) and linked to the destination.
+
+    Args:
+        request: Raw request whose body is the NIfTI data
+        filename: Destination path relative to DATA_DIR
+        x_content_sha256: Optional sha256 of the body
+
+    Returns:
+        Success message or error
+    """
+    if serverless_mode:
+        raise HTTPException(status_code=404, detail="Endpoint not available in serverless mode")
+    filename = normalize_volume_filename(filename)
+    file_path = resolve_target(Path(data_dir), filename)
+    try:
+        if blob_store is not None:
+            digest, size = await blob_store.put_stream(request.stream(), x_content_sha256)
+            await run_in_threadpool(blob_store.link, digest, file_path)
+        else:
+            size = await stream_to_file(request.stream(), file_path)
+            BYTES_WRITTEN.inc(size, kind="volume")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error saving volume: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to save volume: {str(e)}")
+    data_catalog.notify_changed(file_path)
+
+    logger.info(f"Volume streamed successfully to {file_path} ({size} bytes)")
+
+    return {
+        "success": True,
+        "message": f"Volume saved successfully to {filename}",
+        "file_path": str(file_path.relative_to(Path(data_dir).resolve())),
+        "size": size,
+    }
+
+# Resumable chunked uploads (staged under DATA_DIR/.uploads) and slice previews
+if not serverless_mode:
+    app.include_router(build_upload_router(
+        data_dir=Path(data_dir),
+        ttl_seconds=upload_staging_ttl_seconds,
+        on_commit=data_catalog.notify_changed,
+        blob_store=blob_store,
+    ))
+    app.include_router(build_slice_router(
+        data_dir=Path(data_dir),
+        cache_bytes=slice_cache_mb * 1024 * 1024,
+    ))
+if blob_store is not None:
+    app.include_router(build_blob_router(
+        store=blob_store,
+        data_dir=Path(data_dir),
+        on_link=data_catalog.notify_changed,
+    ))
+if enable_thumbnails:
+    app.include_router(build_thumbnail_router(
+        data_dir=Path(data_dir),
+        cache_dir=Path(data_dir) / THUMBNAIL_DIRNAME,
+        size=thumbnail_size,
+        workers=thumbnail_workers,
+    ))
+
 # Register the AI router before the /data static mount so explicit routes win.
 if enable_ai:
+    ai_root = Path(ai_dir) if ai_dir else Path('./ai-sessions')
+    preproc_cache = None
+    if enable_ai_preproc_cache:
+        preproc_cache = PreprocCache(
+            Path(ai_preproc_cache_dir) if ai_preproc_cache_dir else ai_root / PREPROC_DIRNAME,
+            max_bytes=ai_preproc_cache_max_mb * 1024 * 1024 if ai_preproc_cache_max_mb > 0 else None,
+        )
+    shared_state = None
+    if enable_ai_shared_state:
+        shared_state = SharedSessionState(
+            Path(ai_session_state_dir) if ai_session_state_dir else ai_root / STATE_DIRNAME,
+            lease_timeout=ai_session_lease_timeout_seconds,
+        )
+        if preproc_cache is None:
+            logger.warning(
+                "ENABLE_AI_SHARED_STATE without ENABLE_AI_PREPROC_CACHE: every worker "
+                "will preprocess session volumes itself"
+            )
+    batcher = None
+    if enable_ai_batching:
+        batcher = MicroBatcher(max_batch=ai_batch_max_size, window_ms=ai_batch_window_ms)
+        if ai_inference_concurrency < 2:
+            logger.warning(
+                "ENABLE_AI_BATCHING with AI_INFERENCE_CONCURRENCY below 2: jobs run "
+                "one at a time, so no batches can form"
+            )
     app.include_router(build_ai_router(
-        ai_dir=Path(ai_dir) if ai_dir else Path('./ai-sessions'),
+        ai_dir=ai_root,
         data_dir=Path(data_dir) if data_dir else Path('./data'),
         models_dir=Path(models_dir) if models_dir else Path('./models'),
         ttl_seconds=ai_cache_ttl_seconds,
         enabled=True,
         enable_history=enable_ai_history,
+        history_deltas=ai_history_deltas,
+        max_cache_bytes=ai_cache_max_mb * 1024 * 1024 if ai_cache_max_mb > 0 else None,
+        sweep_seconds=ai_cache_sweep_seconds,
+        preproc_cache=preproc_cache,
+        shared_state=shared_state,
+        catalog_path=Path(ai_session_catalog_db) if ai_session_catalog_db else None,
+        max_concurrent_inference=ai_inference_concurrency,
+        model_concurrency=ai_inference_model_concurrency or None,
+        job_ttl_seconds=ai_job_ttl_seconds,
+        infer_wait_timeout=ai_infer_wait_timeout_seconds if ai_infer_wait_timeout_seconds > 0 else None,
+        inference_memory_bytes=ai_inference_memory_mb * 1024 * 1024 if ai_inference_memory_mb > 0 else None,
+        batcher=batcher,
+        model_cache_bytes=ai_model_cache_max_mb * 1024 * 1024 if ai_model_cache_max_mb > 0 else None,
+        preload_models=ai_preload_models,
     ))
 
 # Mount static directories AFTER all API routes
@@ -0,0 +1,254 @@
+"""SQLite index of AI session manifests.
+
+Each session folder under AI_DIR holds a `session.json` manifest, and the
+manifests stay the source of truth. This catalog mirrors them (id, name,
+folder, paths, timestamps, iteration count and the full manifest) so that
+looking a session up by id is one indexed query instead of a scan that
+parses every manifest, and listings can be paged.
+
+Rows remember the manifest's mtime. A lookup stats the file and re-reads it
+only if it changed behind the catalog's back. Mutations go through `update`,
+which applies them inside a `BEGIN IMMEDIATE` transaction. That serializes
+read-modify-write cycles across threads and worker processes, so concurrent
+requests cannot lose each other's manifest changes. `sync` reconciles the
+catalog with the folders on disk at startup.
+
+Run as a CLI to rebuild the catalog from the manifests:
+    python session_catalog.py rebuild AI_DIR [--db PATH]
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections.abc import Callable
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILENAME = ".sessions.sqlite"
+MANIFEST_FILENAME = "session.json"
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    session_name TEXT NOT NULL,
+    dir_name TEXT NOT NULL UNIQUE,
+    created_at TEXT,
+    volume_path TEXT,
+    volume_path_root TEXT,
+    annotation_path TEXT,
+    result_path TEXT,
+    last_inference_ml_id TEXT,
+    last_inference_at TEXT,
+    iteration_count INTEGER,
+    manifest_mtime_ns INTEGER NOT NULL,
+    manifest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_created_at ON sessions (created_at, dir_name);
+"""
+_COLUMNS = (
+    "session_name", "created_at", "volume_path", "volume_path_root", "annotation_path",
+    "result_path", "last_inference_ml_id", "last_inference_at", "iteration_count",
+)
+
+
+def read_manifest(path: Path) -> dict[str, Any]:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(path: Path, manifest: dict[str, Any]) -> None:
+    tmp = path.with_suffix(f"{path.suffix}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+class SessionCatalog:
+    """Indexed mirror of the session manifests under `ai_dir`."""
+
+    def __init__(self, ai_dir: Path, db_path: Path | None = None):
+        self.ai_dir = ai_dir
+        self.db_path = db_path or ai_dir / CATALOG_FILENAME
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit mode: transactions are opened explicitly in `_transaction`.
+        self._db = sqlite3.connect(
+            str(self.db_path), check_same_thread=False, isolation_level=None, timeout=30.0,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _upsert(self, db, dir_name: str, manifest: dict[str, Any], mtime_ns: int) -> None:
+        # REPLACE also drops a stale row for the same folder under another id.
+        db.execute(
+            f"INSERT OR REPLACE INTO sessions (session_id, dir_name, {', '.join(_COLUMNS)}, "
+            f"manifest_mtime_ns, manifest) VALUES (?, ?, {', '.join('?' * len(_COLUMNS))}, ?, ?)",
+            (
+                manifest["session_id"], dir_name,
+                *(manifest.get(c) for c in _COLUMNS),
+                mtime_ns, json.dumps(manifest),
+            ),
+        )
+
+    def _select(self, db, session_id: str):
+        return db.execute(
+            "SELECT dir_name, manifest_mtime_ns, manifest FROM sessions WHERE session_id = ?",
+            (session_id,),
+        ).fetchone()
+
+    def _refresh(self, db, session_id: str) -> tuple[Path, dict[str, Any]] | None:
+        """Current manifest of a session, re-read if the file changed; None if gone."""
+        row = self._select(db, session_id)
+        if row is None:
+            return None
+        dir_name, mtime_ns, text = row
+        session_dir = self.ai_dir / dir_name
+        path = session_dir / MANIFEST_FILENAME
+        try:
+            current = path.stat().st_mtime_ns
+            if current == mtime_ns:
+                return session_dir, json.loads(text)
+            manifest = read_manifest(path)
+        except (OSError, json.JSONDecodeError):
+            manifest = None
+        if manifest is None or manifest.get("session_id") != session_id:
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            return None
+        self._upsert(db, dir_name, manifest, current)
+        return session_dir, manifest
+
+    def get(self, session_id: str) -> tuple[Path, dict[str, Any]] | None:
+        with self._lock:
+            row = self._select(self._db, session_id)
+        if row is None:
+            return None
+        dir_name, mtime_ns, text = row
+        try:
+            if (self.ai_dir / dir_name / MANIFEST_FILENAME).stat().st_mtime_ns == mtime_ns:
+                return self.ai_dir / dir_name, json.loads(text)
+        except OSError:
+            pass
+        # Changed or removed outside the catalog.
+        with self._transaction() as db:
+            return self._refresh(db, session_id)
+
+    def list(self, offset: int = 0, limit: int | None = None) -> list[dict[str, Any]]:
+        """Manifests ordered by creation time, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT manifest FROM sessions ORDER BY created_at, dir_name "
+                "LIMIT ? OFFSET ?",
+                (-1 if limit is None else limit, offset),
+            ).fetchall()
+        return [json.loads(text) for (text,) in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def add(self, session_dir: Path, manifest: dict[str, Any]) -> None:
+        """Write a new session's manifest and index it."""
+        path = session_dir / MANIFEST_FILENAME
+        with self._transaction() as db:
+            write_manifest(path, manifest)
+            self._upsert(db, session_dir.name, manifest, path.stat().st_mtime_ns)
+
+    def update(
+        self,
+        session_id: str,
+        mutate: Callable[[Path, dict[str, Any]], None],
+    ) -> tuple[Path, dict[str, Any]] | None:
+        """Apply `mutate(session_dir, manifest)` and persist it atomically.
+
+        Returns None if the session does not exist.
+        """
+        with self._transaction() as db:
+            loaded = self._refresh(db, session_id)
+            if loaded is None:
+                return None
+            session_dir, manifest = loaded
+            mutate(session_dir, manifest)
+            path = session_dir / MANIFEST_FILENAME
+            write_manifest(path, manifest)
+            self._upsert(db, session_dir.name, manifest, path.stat().st_mtime_ns)
+            return session_dir, manifest
+
+    def remove(self, session_id: str) -> None:
+        with self._transaction() as db:
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def sync(self, full: bool = False) -> dict[str, int]:
+        """Reconcile the catalog with the session folders on disk.
+
+        Only manifests whose mtime changed are parsed, unless `full` is set.
+        """
+        counts = {"indexed": 0, "updated": 0, "removed": 0}
+        dirs = []
+        if self.ai_dir.exists():
+            dirs = [d for d in sorted(self.ai_dir.iterdir())
+                    if d.is_dir() and (d / MANIFEST_FILENAME).exists()]
+        with self._transaction() as db:
+            known = {
+                dir_name: mtime_ns
+                for dir_name, mtime_ns in db.execute(
+                    "SELECT dir_name, manifest_mtime_ns FROM sessions"
+                )
+            }
+            if full:
+                db.execute("DELETE FROM sessions")
+                known = {}
+            for session_dir in dirs:
+                counts["indexed"] += 1
+                path = session_dir / MANIFEST_FILENAME
+                try:
+                    mtime_ns = path.stat().st_mtime_ns
+                    if known.pop(session_dir.name, None) == mtime_ns:
+                        continue
+                    manifest = read_manifest(path)
+                except (OSError, json.JSONDecodeError) as exc:
+                    logger.warning(f"Skipping unreadable session {session_dir.name}: {exc}")
+                    continue
+                if not manifest.get("session_id"):
+                    logger.warning(f"Skipping session {session_dir.name}: no session_id")
+                    continue
+                self._upsert(db, session_dir.name, manifest, mtime_ns)
+                counts["updated"] += 1
+            for dir_name in known:
+                db.execute("DELETE FROM sessions WHERE dir_name = ?", (dir_name,))
+                counts["removed"] += 1
+        return counts
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Maintain the AI session catalog.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild = sub.add_parser("rebuild", help="Re-index every session manifest under AI_DIR")
+    rebuild.add_argument("ai_dir", type=Path)
+    rebuild.add_argument("--db", type=Path, default=None,
+                         help=f"Catalog path (default: AI_DIR/{CATALOG_FILENAME})")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    catalog = SessionCatalog(args.ai_dir, args.db)
+    counts = catalog.sync(full=True)
+    print(json.dumps(counts))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,173 @@
+"""Click and stroke annotations of an AI session, kept as coordinate lists.
+
+Sending the drawing layer as a NIfTI for every click costs megabytes of
+upload and a full-volume decode on the server. Instead, clients can post the
+prompts themselves:
+
+    {"space": "ras", "strokes": [{"label": 1, "points": [[x, y, z], ...]}]}
+
+`label` is 1 (positive), 2 (negative) or 0 (erase). The points of a stroke are
+separate clicks, or with `"connect": true` the vertices of a polyline. They
+can be given as RAS millimetres ("ras"), voxel indices of the volume file
+("voxel"), or voxel indices of the volume reoriented to RAS ("ras_voxel",
+the grid of the viewer's drawing layer and of inference). They are stored in
+that last grid, in order, in <session>/clicks.json:
+
+    {"ras_dims": [X, Y, Z], "strokes": [{"label": 1, "points": [[i, j, k]], "connect": false}]}
+
+At inference time the strokes are painted in order straight into the
+positive/negative prompt masks. `materialize` writes the equivalent
+annotation NIfTI, in the volume's own orientation, only when a file is
+actually needed (e.g. to reopen the session in the viewer).
+"""
+import json
+import os
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    import numpy as np
+
+CLICKS_FILENAME = "clicks.json"
+CLICKS_NIFTI_FILENAME = "clicks.nii.gz"
+LABELS = (0, 1, 2)  # erase, positive, negative
+SPACES = ("ras", "voxel", "ras_voxel")
+
+
+def is_clicks(annotation_path: str | None) -> bool:
+    return annotation_path == CLICKS_FILENAME
+
+
+@dataclass
+class VolumeGrid:
+    affine: "np.ndarray"  # voxel -> RAS mm, as stored in the file
+    shape: tuple[int, int, int]
+    ornt: "np.ndarray"  # nib.io_orientation(affine)
+    affine_ras: "np.ndarray"  # voxel -> RAS mm of the RAS-reoriented grid
+    ras_dims: tuple[int, int, int]
+
+
+def volume_grid(volume_path: Path) -> VolumeGrid:
+    """Geometry of a volume and of its RAS-reoriented grid (header only)."""
+    import nibabel as nib
+    import numpy as np
+
+    img = nib.load(str(volume_path))
+    shape = tuple(int(n) for n in img.shape[:3])
+    ornt = nib.io_orientation(img.affine)
+    ras_dims = [0, 0, 0]
+    for vox_axis, (ras_axis, _flip) in enumerate(ornt[:3]):
+        ras_dims[int(ras_axis)] = shape[vox_axis]
+    return VolumeGrid(
+        affine=np.asarray(img.affine, dtype=np.float64),
+        shape=shape,
+        ornt=ornt,
+        affine_ras=img.affine @ nib.orientations.inv_ornt_aff(ornt, shape),
+        ras_dims=tuple(ras_dims),
+    )
+
+
+def to_ras_voxels(points: list[list[float]], space: str, grid: VolumeGrid) -> "np.ndarray":
+    """Convert points to integer indices of the RAS grid; ValueError if outside."""
+    import numpy as np
+
+    given = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    pts = given
+    if space == "ras":
+        mm = pts
+    elif space == "voxel":
+        mm = pts @ grid.affine[:3, :3].T + grid.affine[:3, 3]
+    elif space == "ras_voxel":
+        mm = None
+    else:
+        raise ValueError(f"Unknown space {space!r}; expected one of {', '.join(SPACES)}")
+    if mm is not None:
+        inv = np.linalg.inv(grid.affine_ras)
+        pts = mm @ inv[:3, :3].T + inv[:3, 3]
+    vox = np.rint(pts).astype(np.int64)
+    outside = (vox < 0).any(axis=1) | (vox >= np.asarray(grid.ras_dims)).any(axis=1)
+    if outside.any():
+        raise ValueError(f"Point {given[outside][0].tolist()} is outside the volume")
+    return vox
+
+
+def _polyline(vertices: "np.ndarray") -> "np.ndarray":
+    """Voxels along the segments between consecutive vertices."""
+    import numpy as np
+
+    pieces = [vertices[:1]]
+    for a, b in zip(vertices[:-1], vertices[1:]):
+        steps = int(np.abs(b - a).max())
+        if steps:
+            t = np.arange(1, steps + 1)[:, None] / steps
+            pieces.append(np.rint(a + (b - a) * t).astype(np.int64))
+    return np.concatenate(pieces)
+
+
+def rasterize(state: dict[str, Any]) -> "np.ndarray":
+    """Paint the strokes, in order, into a uint8 label volume on the RAS grid."""
+    import numpy as np
+
+    out = np.zeros(tuple(state["ras_dims"]), dtype=np.uint8)
+    for stroke in state["strokes"]:
+        vox = np.asarray(stroke["points"], dtype=np.int64).reshape(-1, 3)
+        if stroke.get("connect") and len(vox) > 1:
+            vox = _polyline(vox)
+        out[vox[:, 0], vox[:, 1], vox[:, 2]] = stroke["label"]
+    return out
+
+
+def strokes_from_labels(labels: "np.ndarray") -> list[dict[str, Any]]:
+    """Strokes reproducing a label volume on the RAS grid (one per label)."""
+    import numpy as np
+
+    return [
+        {"label": label, "points": np.argwhere(labels == label).tolist(), "connect": False}
+        for label in LABELS[1:]
+        if (labels == label).any()
+    ]
+
+
+def load_clicks(session_dir: Path) -> dict[str, Any] | None:
+    try:
+        with open(session_dir / CLICKS_FILENAME) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_clicks(session_dir: Path, state: dict[str, Any]) -> None:
+    path = session_dir / CLICKS_FILENAME
+    tmp = path.with_suffix(f".json.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(state, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def materialize(session_dir: Path, state: dict[str, Any], grid: VolumeGrid) -> Path:
+    """Write the strokes as an annotation NIfTI in the volume's orientation.
+
+    The file is reused while it is newer than clicks.json.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    out = session_dir / CLICKS_NIFTI_FILENAME
+    try:
+        if out.stat().st_mtime_ns >= (session_dir / CLICKS_FILENAME).stat().st_mtime_ns:
+            return out
+    except FileNotFoundError:
+        pass
+    labels = rasterize(state)
+    to_native = nib.orientations.ornt_transform(
+        nib.orientations.axcodes2ornt("RAS"), grid.ornt,
+    )
+    native = np.ascontiguousarray(nib.orientations.apply_orientation(labels, to_native))
+    nii = nib.Nifti1Image(native, grid.affine)
+    nii.header.set_data_dtype(np.uint8)
+    tmp = out.with_name(f"{out.name}.{os.getpid()}.tmp.nii.gz")
+    nib.save(nii, str(tmp))
+    os.replace(tmp, out)
+    return out
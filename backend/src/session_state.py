@@ -0,0 +1,186 @@
+"""AI session state shared between worker processes.
+
+`SessionManager` keeps its RAM cache per process, so with several uvicorn
+workers each click may land on a worker that has never seen the session.
+This module keeps the part of that state that cannot be rebuilt cheaply on
+disk, next to a small locking protocol:
+
+    <state_dir>/<session_id>/lease.lock   held for the whole of an inference
+    <state_dir>/<session_id>/state.lock   held briefly around state.json
+    <state_dir>/<session_id>/state.json   {"volume_epoch": n, "logits_epoch": m}
+    <state_dir>/<session_id>/logits.npy   previous logits (float32)
+
+The lease is an exclusive `flock`, so concurrent inferences on one session
+run one at a time whichever worker they reach, and a worker that dies drops
+its leases with it. Epochs tell a worker whether its cached entry is still
+current: `set_volume` bumps both, `set_annots` and every stored result bump
+`logits_epoch`. A result is only stored if nothing invalidated the logits
+while it was being computed.
+
+Preprocessed volumes are shared through the preprocessed-volume cache (see
+preproc_cache.py), so only the logits live here. Put `state_dir` on a tmpfs
+such as /dev/shm to keep them in shared memory.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from fastapi import HTTPException
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STATE_DIRNAME = ".session-state"
+_LEASE_FILENAME = "lease.lock"
+_STATE_LOCK_FILENAME = "state.lock"
+_STATE_FILENAME = "state.json"
+_LOGITS_FILENAME = "logits.npy"
+_POLL_SECONDS = 0.05
+
+
+@contextmanager
+def _flock(path: Path, timeout: float | None = None):
+    """Hold an exclusive flock on `path`; poll until `timeout` (None = wait forever)."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError as exc:
+                    if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(str(path)) from None
+                    time.sleep(_POLL_SECONDS)
+        yield
+    finally:
+        os.close(fd)  # also releases the lock
+
+
+class SharedSessionState:
+    """Cross-process session epochs, previous logits and per-session leases."""
+
+    def __init__(self, state_dir: Path, lease_timeout: float = 120.0):
+        self.state_dir = state_dir
+        self.lease_timeout = lease_timeout
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+
+    def _dir(self, session_id: str) -> Path:
+        path = self.state_dir / session_id
+        path.mkdir(exist_ok=True)
+        return path
+
+    @contextmanager
+    def lease(self, session_id: str):
+        """Exclusive lease on a session; 409 if another request holds it too long."""
+        try:
+            with _flock(self._dir(session_id) / _LEASE_FILENAME, self.lease_timeout):
+                yield
+        except TimeoutError:
+            raise HTTPException(
+                status_code=409, detail=f"Session is busy: {session_id}",
+            ) from None
+
+    def _read_epochs(self, path: Path) -> dict[str, int]:
+        try:
+            with open(path / _STATE_FILENAME) as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            state = {}
+        return {
+            "volume_epoch": int(state.get("volume_epoch", 0)),
+            "logits_epoch": int(state.get("logits_epoch", 0)),
+        }
+
+    def _write_epochs(self, path: Path, epochs: dict[str, int]) -> None:
+        tmp = path / f"{_STATE_FILENAME}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(epochs, f)
+        os.replace(tmp, path / _STATE_FILENAME)
+
+    def epochs(self, session_id: str) -> tuple[int, int]:
+        path = self._dir(session_id)
+        with _flock(path / _STATE_LOCK_FILENAME):
+            epochs = self._read_epochs(path)
+        return epochs["volume_epoch"], epochs["logits_epoch"]
+
+    def invalidate(self, session_id: str, volume: bool) -> None:
+        """Drop the stored logits (and, with `volume`, the volume) for every worker."""
+        path = self._dir(session_id)
+        with _flock(path / _STATE_LOCK_FILENAME):
+            epochs = self._read_epochs(path)
+            epochs["logits_epoch"] += 1
+            if volume:
+                epochs["volume_epoch"] += 1
+            (path / _LOGITS_FILENAME).unlink(missing_ok=True)
+            self._write_epochs(path, epochs)
+
+    def load_logits(self, session_id: str) -> "np.ndarray | None":
+        import numpy as np
+
+        try:
+            return np.load(self._dir(session_id) / _LOGITS_FILENAME)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exc:
+            logger.warning(f"Ignoring unreadable logits for session {session_id}: {exc}")
+            return None
+
+    def store_logits(self, session_id: str, logits, expected_epoch: int) -> int | None:
+        """Store `logits` if the logits epoch is still `expected_epoch`.
+
+        Returns the new epoch, or None when the session was invalidated in
+        the meantime and the logits are stale.
+        """
+        import numpy as np
+
+        path = self._dir(session_id)
+        tmp = path / f"{_LOGITS_FILENAME}.{os.getpid()}.tmp.npy"
+        np.save(tmp, np.ascontiguousarray(np.asarray(logits), dtype=np.float32))
+        try:
+            with _flock(path / _STATE_LOCK_FILENAME):
+                epochs = self._read_epochs(path)
+                if epochs["logits_epoch"] != expected_epoch:
+                    return None
+                os.replace(tmp, path / _LOGITS_FILENAME)
+                epochs["logits_epoch"] += 1
+                self._write_epochs(path, epochs)
+                return epochs["logits_epoch"]
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def discard(self, session_id: str) -> None:
+        shutil.rmtree(self.state_dir / session_id, ignore_errors=True)
+
+    def sweep(self, ttl_seconds: float) -> int:
+        """Remove stored logits of sessions idle for longer than `ttl_seconds`."""
+        cutoff = time.time() - ttl_seconds
+        removed = 0
+        for path in self.state_dir.iterdir():
+            logits = path / _LOGITS_FILENAME
+            try:
+                if logits.stat().st_mtime >= cutoff:
+                    continue
+            except OSError:
+                continue
+            try:
+                with _flock(path / _LEASE_FILENAME, timeout=0):
+                    self.invalidate(path.name, volume=False)
+                removed += 1
+            except TimeoutError:
+                pass  # in use
+        return removed
@@ -0,0 +1,267 @@
+"""Server-side 2D slice rendering for GET /data/slice.
+
+Returns a single slice of a DATA_DIR volume as a PNG (with window/level and
+an optional colormap) or as the raw typed array, so QA browsing does not need
+to download and decode whole volumes in the browser.
+
+Slices are taken in RAS space: the requested axis is mapped onto the voxel
+axis closest to it via the affine, and only that plane is read from nibabel's
+lazy `dataobj` proxy. Uncompressed .nii files are memory mapped, so this
+reads one slice from disk. Compressed volumes cannot be seeked, so their
+decoded arrays are kept in a byte-bounded LRU to make browsing through one
+volume cheap after the first slice; the LRU also caps how many volumes
+(and memory maps) it keeps open.
+
+numpy and nibabel are imported lazily so that the server still starts in
+deployments without them.
+"""
+import hashlib
+import logging
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Literal
+
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+
+logger = logging.getLogger(__name__)
+
+_AXES = {"sagittal": 0, "coronal": 1, "axial": 2}
+_COMPRESSED_SUFFIXES = (".gz", ".mgz", ".bz2", ".zst")
+
+# Piecewise-linear colormaps as (intensity 0-255, R, G, B) control points,
+# following NiiVue's colormap definitions of the same names.
+COLORMAPS: dict[str, list[tuple[int, int, int, int]]] = {
+    "gray": [(0, 0, 0, 0), (255, 255, 255, 255)],
+    "hot": [(0, 0, 0, 0), (95, 255, 0, 0), (191, 255, 255, 0), (255, 255, 255, 255)],
+    "winter": [(0, 0, 0, 255), (255, 0, 255, 128)],
+    "red": [(0, 0, 0, 0), (255, 255, 0, 0)],
+    "green": [(0, 0, 0, 0), (255, 0, 255, 0)],
+    "blue": [(0, 0, 0, 0), (255, 0, 0, 255)],
+    "viridis": [
+        (0, 68, 1, 84), (64, 59, 82, 139), (128, 33, 145, 140),
+        (192, 94, 201, 98), (255, 253, 231, 37),
+    ],
+}
+
+
+def colormap_lut(name: str):
+    """Expand a colormap's control points into a (256, 3) uint8 lookup table."""
+    import numpy as np
+
+    points = COLORMAPS.get(name)
+    if points is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown colormap '{name}'; expected one of {sorted(COLORMAPS)}",
+        )
+    xs = [p[0] for p in points]
+    idx = np.arange(256)
+    channels = [np.interp(idx, xs, [p[c] for p in points]) for c in (1, 2, 3)]
+    return np.stack(channels, axis=-1).round().astype(np.uint8)
+
+
+def encode_png(pixels) -> bytes:
+    """Encode a (H, W) or (H, W, 3) uint8 array as a PNG (stdlib zlib only)."""
+    import numpy as np
+
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    height, width = pixels.shape[:2]
+    color_type = 2 if pixels.ndim == 3 else 0
+    rows = pixels.reshape(height, -1)
+    # Filter type 0 (None) prepended to every scanline.
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), rows]).tobytes()
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return (struct.pack(">I", len(data)) + tag + data
+                + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+
+def apply_window(plane, window: float | None, level: float | None):
+    """Map intensities to uint8 with window/level; default to a robust range."""
+    import numpy as np
+
+    plane = np.asarray(plane, dtype=np.float32)
+    if window is None or level is None:
+        finite = plane[np.isfinite(plane)]
+        if finite.size == 0:
+            return np.zeros(plane.shape, dtype=np.uint8)
+        lo, hi = np.percentile(finite, [0.5, 99.5])
+        if window is None:
+            window = float(hi - lo)
+        if level is None:
+            level = float(lo + hi) / 2.0
+    window = max(float(window), 1e-6)
+    scaled = (plane - (level - window / 2.0)) / window
+    return (np.nan_to_num(np.clip(scaled, 0.0, 1.0)) * 255.0).round().astype(np.uint8)
+
+
+class VolumeCache:
+    """LRU of opened volumes keyed by path + mtime + size.
+
+    Entries are nibabel images whose `dataobj` is either the lazy proxy
+    (uncompressed files) or a fully decoded array (compressed files).
+    Decoded arrays are bounded by `max_bytes`. Proxies cost next to no memory
+    but hold a memory map (and its file descriptor) open, so the cache also
+    keeps at most `max_entries` volumes, and opening a new version of a file
+    drops the cached old one.
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int = 64):
+        self.max_bytes = max_bytes
+        self.max_entries = max(1, max_entries)
+        self._entries: OrderedDict[tuple, tuple[Any, int]] = OrderedDict()
+        self._keys: dict[str, tuple] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, path: Path):
+        import nibabel as nib
+        import numpy as np
+
+        st = path.stat()
+        key = (str(path), st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                return cached[0]
+
+        img = nib.load(str(path), mmap=True)
+        nbytes = 0
+        if str(path).endswith(_COMPRESSED_SUFFIXES):
+            data = np.asanyarray(img.dataobj)
+            img = img.__class__(data, img.affine, img.header)
+            nbytes = data.nbytes
+
+        with self._lock:
+            if nbytes <= self.max_bytes and key not in self._entries:
+                stale = self._keys.get(key[0])
+                if stale is not None:
+                    self._pop(stale)
+                self._entries[key] = (img, nbytes)
+                self._keys[key[0]] = key
+                self._bytes += nbytes
+                while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                    self._pop(next(iter(self._entries)))
+        return img
+
+    def _pop(self, key: tuple) -> None:
+        """Drop one entry. Lock held."""
+        _img, nbytes = self._entries.pop(key)
+        self._bytes -= nbytes
+        if self._keys.get(key[0]) == key:
+            del self._keys[key[0]]
+
+
+def extract_slice(img, axis: str, index: int | None, frame: int = 0):
+    """Return the RAS-oriented 2D plane `index` along `axis` plus its size.
+
+    The plane is returned ready for display: rows run superior/anterior to
+    inferior/posterior and columns left to right (neurological convention).
+    """
+    import nibabel as nib
+    import numpy as np
+
+    ras_axis = _AXES[axis]
+    shape = img.shape
+    ornt = nib.io_orientation(img.affine)
+    vox_axis = int(np.flatnonzero(ornt[:, 0] == ras_axis)[0])
+    n = shape[vox_axis]
+    if index is None:
+        index = n // 2
+    if not 0 <= index < n:
+        raise HTTPException(status_code=400, detail=f"index {index} out of range [0, {n})")
+    if len(shape) > 3:
+        n_frames = int(np.prod(shape[3:]))
+        if not 0 <= frame < n_frames:
+            raise HTTPException(
+                status_code=400, detail=f"frame {frame} out of range [0, {n_frames})",
+            )
+    vox_index = index if ornt[vox_axis, 1] > 0 else n - 1 - index
+
+    slicer: list[Any] = [slice(None)] * 3
+    slicer[vox_axis] = vox_index
+    if len(shape) > 3:
+        slicer.extend(np.unravel_index(frame, shape[3:]))
+    plane = np.asanyarray(img.dataobj[tuple(slicer)])
+
+    # Reorder the two remaining voxel axes into RAS order and undo flips.
+    remaining = [a for a in range(3) if a != vox_axis]
+    order = sorted(range(2), key=lambda i: ornt[remaining[i], 0])
+    plane = plane.transpose(order)
+    for i, src in enumerate(remaining[j] for j in order):
+        if ornt[src, 1] < 0:
+            plane = np.flip(plane, axis=i)
+    return np.flipud(plane.T), n
+
+
+def _resolve_volume(data_dir: Path, rel: str) -> Path:
+    if rel.startswith("data/"):
+        rel = rel[len("data/"):]
+    candidate = (data_dir / rel).resolve()
+    try:
+        candidate.relative_to(data_dir.resolve())
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid path: {rel}")
+    if not candidate.is_file():
+        raise HTTPException(status_code=404, detail=f"Volume not found: {rel}")
+    return candidate
+
+
+def build_router(*, data_dir: Path, cache_bytes: int) -> APIRouter:
+    """Build the GET /data/slice router."""
+    router = APIRouter(prefix="/data")
+    cache = VolumeCache(max_bytes=cache_bytes)
+
+    @router.get("/slice")
+    def get_slice(
+        request: Request,
+        path: str,
+        axis: Literal["sagittal", "coronal", "axial"] = "axial",
+        index: int | None = None,
+        frame: int = Query(0, ge=0),
+        window: float | None = Query(None, gt=0),
+        level: float | None = None,
+        colormap: str = "gray",
+        format: Literal["png", "raw"] = "png",
+    ):
+        volume_path = _resolve_volume(data_dir, path)
+        st = volume_path.stat()
+        key = (f"{volume_path}|{st.st_mtime_ns}|{st.st_size}|{axis}|{index}|{frame}"
+               f"|{window}|{level}|{colormap}|{format}")
+        etag = '"' + hashlib.sha1(key.encode("utf-8")).hexdigest() + '"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+        try:
+            img = cache.get(volume_path)
+        except Exception as exc:
+            logger.error(f"Error opening {volume_path} for slicing: {exc}")
+            raise HTTPException(status_code=400, detail=f"Cannot read volume: {path}")
+        plane, n_slices = extract_slice(img, axis, index, frame)
+        headers["X-Slice-Count"] = str(n_slices)
+
+        if format == "raw":
+            import numpy as np
+
+            plane = np.ascontiguousarray(plane)
+            plane = plane.astype(plane.dtype.newbyteorder("<"), copy=False)
+            headers["X-Slice-Shape"] = ",".join(str(s) for s in plane.shape)
+            headers["X-Slice-Dtype"] = plane.dtype.name
+            return Response(content=plane.tobytes(), media_type="application/octet-stream",
+                            headers=headers)
+
+        pixels = apply_window(plane, window, level)
+        if colormap != "gray":
+            pixels = colormap_lut(colormap)[pixels]
+        return Response(content=encode_png(pixels), media_type="image/png", headers=headers)
+
+    return router
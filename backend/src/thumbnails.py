@@ -0,0 +1,256 @@
+"""Cached orthogonal-slice thumbnails for the file browser.
+
+GET /data/thumb?path=... returns a small grayscale PNG with the sagittal,
+coronal and axial mid-slices of a DATA_DIR volume side by side.
+
+Thumbnails are cached on disk under a name derived from the volume's path,
+mtime and size, so a changed file simply gets a new cache entry. A cache miss
+never blocks: the render is queued on a bounded process pool and the request
+is answered with 202 and Retry-After until the thumbnail exists. Rendering
+reads from the coarsest suitable pyramid level when one has been built.
+
+Listings link to /data/thumb?path=...&v=<version>, where the version is
+derived from the mtime and size the data catalog recorded for the file; a
+request whose `v` matches the file's current version is served with an
+immutable, year-long Cache-Control.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import stat
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from fastapi import APIRouter, HTTPException, Request, Response
+
+from pyramids import level_dir, parse_level_factor
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIRNAME = ".thumbnails"
+_RENDER_VERSION = 1
+_AXES = ("sagittal", "coronal", "axial")
+_LONG_CACHE = "public, max-age=31536000, immutable"
+_SHORT_CACHE = "public, max-age=300"
+_MAX_CRASHES = 2
+# Failed keys are forgotten wholesale past this many (they change with mtime anyway).
+_MAX_FAILED = 10000
+
+
+def thumbnail_version(mtime_ns: int, file_size: int, size: int) -> str:
+    """The `v` of a thumbnail URL for a volume with that mtime and size."""
+    key = f"{mtime_ns}|{file_size}|{size}|{_RENDER_VERSION}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def _source_for(volume_path: Path, size: int) -> Path:
+    """Pick the coarsest pyramid level that still covers `size` pixels."""
+    levels = []
+    try:
+        for entry in level_dir(volume_path).iterdir():
+            factor = parse_level_factor(entry.name)
+            if factor is not None and entry.stat().st_mtime >= volume_path.stat().st_mtime:
+                levels.append((factor, entry))
+    except OSError:
+        return volume_path
+    import nibabel as nib
+
+    for _factor, path in sorted(levels, reverse=True):
+        if max(nib.load(str(path)).shape[:3]) >= size:
+            return path
+    return volume_path
+
+
+def _fit_tile(plane, spacing: tuple[float, float], size: int):
+    """Nearest-neighbour resample `plane` into a size x size tile, keeping aspect."""
+    import numpy as np
+
+    rows, cols = plane.shape
+    height, width = rows * spacing[0], cols * spacing[1]
+    scale = size / max(height, width, 1e-6)
+    out_rows = max(1, min(size, round(height * scale)))
+    out_cols = max(1, min(size, round(width * scale)))
+    r_idx = np.minimum((np.arange(out_rows) * rows / out_rows).astype(int), rows - 1)
+    c_idx = np.minimum((np.arange(out_cols) * cols / out_cols).astype(int), cols - 1)
+    tile = np.zeros((size, size), dtype=np.uint8)
+    r0, c0 = (size - out_rows) // 2, (size - out_cols) // 2
+    tile[r0:r0 + out_rows, c0:c0 + out_cols] = plane[np.ix_(r_idx, c_idx)]
+    return tile
+
+
+def render_thumbnail(volume_path: str, out_path: str, size: int) -> str:
+    """Render the three mid-slices of `volume_path` into a PNG at `out_path`.
+
+    Runs in a worker process; writes through a temp file so readers never see
+    a partial image.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    from slices import apply_window, encode_png, extract_slice
+
+    img = nib.load(str(_source_for(Path(volume_path), size)), mmap=True)
+    ornt = nib.io_orientation(img.affine)
+    zooms = img.header.get_zooms()[:3]
+    ras_zooms = [1.0, 1.0, 1.0]
+    for vox_axis, (ras_axis, _flip) in enumerate(ornt):
+        ras_zooms[int(ras_axis)] = float(zooms[vox_axis])
+
+    tiles = []
+    for ras_axis, axis in enumerate(_AXES):
+        plane, _n = extract_slice(img, axis, None)
+        # Displayed rows follow the higher remaining RAS axis, columns the lower.
+        col_axis, row_axis = [a for a in range(3) if a != ras_axis]
+        pixels = apply_window(plane, None, None)
+        tiles.append(_fit_tile(pixels, (ras_zooms[row_axis], ras_zooms[col_axis]), size))
+
+    out = Path(out_path)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_name(f".{out.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(encode_png(np.hstack(tiles)))
+    os.replace(tmp, out)
+    return out_path
+
+
+class ThumbnailService:
+    """Disk cache plus a bounded process pool for lazy thumbnail rendering.
+
+    A worker that dies (e.g. killed for memory on a huge volume) breaks the
+    whole pool; it is then replaced, and a volume whose render has crashed
+    the pool `_MAX_CRASHES` times, or raised, is not retried until it changes.
+    """
+
+    def __init__(self, cache_dir: Path, size: int, workers: int, max_pending: int):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pool = self._new_pool()
+        self._pending: dict[str, Future] = {}
+        self._crashes: dict[str, int] = {}
+        self._failed: set[str] = set()
+        self._lock = threading.Lock()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def _replace_pool(self, broken: ProcessPoolExecutor) -> None:
+        """Swap in a fresh pool if `broken` is still the current one. Lock held."""
+        if self._pool is broken:
+            logger.warning("Thumbnail worker died; restarting the render pool")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._pool = self._new_pool()
+
+    def cache_key(self, volume_path: Path, st: os.stat_result) -> str:
+        key = f"{volume_path}|{st.st_mtime_ns}|{st.st_size}|{self.size}|{_RENDER_VERSION}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def cache_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.png"
+
+    def request(self, volume_path: Path, st: os.stat_result) -> tuple[str, Path | None]:
+        """Return (key, cached PNG path) for the volume as of `st`, queueing a
+        render on a miss."""
+        key = self.cache_key(volume_path, st)
+        cached = self.cache_path(key)
+        if cached.exists():
+            return key, cached
+        with self._lock:
+            if key in self._failed:
+                raise HTTPException(status_code=503, detail="Thumbnail could not be rendered")
+            if key not in self._pending:
+                if len(self._pending) >= self.max_pending:
+                    raise HTTPException(
+                        status_code=503,
+                        detail="Thumbnail queue is full",
+                        headers={"Retry-After": "5"},
+                    )
+                pool = self._pool
+                try:
+                    future = pool.submit(
+                        render_thumbnail, str(volume_path), str(cached), self.size,
+                    )
+                except BrokenProcessPool:
+                    self._replace_pool(pool)
+                    raise HTTPException(
+                        status_code=503,
+                        detail="Thumbnail renderer restarting",
+                        headers={"Retry-After": "1"},
+                    )
+                self._pending[key] = future
+                future.add_done_callback(lambda f, k=key, p=pool: self._finish(k, f, p))
+        return key, None
+
+    def _finish(self, key: str, future: Future, pool: ProcessPoolExecutor) -> None:
+        exc = None if future.cancelled() else future.exception()
+        with self._lock:
+            self._pending.pop(key, None)
+            if isinstance(exc, BrokenProcessPool):
+                # Every render in flight fails with the pool, not only the culprit.
+                self._replace_pool(pool)
+                self._crashes[key] = self._crashes.get(key, 0) + 1
+                if self._crashes[key] >= _MAX_CRASHES:
+                    self._failed.add(key)
+            elif exc is not None:
+                self._failed.add(key)
+            if len(self._failed) > _MAX_FAILED:
+                self._failed.clear()
+                self._crashes.clear()
+        if exc is not None:
+            logger.warning(f"Thumbnail render failed ({key}): {exc!r}")
+
+
+def build_router(
+    *,
+    data_dir: Path,
+    cache_dir: Path,
+    size: int,
+    workers: int,
+    max_pending: int = 256,
+) -> APIRouter:
+    """Build the GET /data/thumb router."""
+    router = APIRouter(prefix="/data")
+    service = ThumbnailService(
+        cache_dir=cache_dir, size=size, workers=workers, max_pending=max_pending,
+    )
+
+    @router.get("/thumb")
+    def get_thumbnail(request: Request, path: str, v: str | None = None):
+        rel = path[len("data/"):] if path.startswith("data/") else path
+        volume_path = (data_dir / rel).resolve()
+        try:
+            volume_path.relative_to(data_dir.resolve())
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid path: {path}")
+        try:
+            st = volume_path.stat()
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            raise HTTPException(status_code=404, detail=f"Volume not found: {path}")
+
+        key, cached = service.request(volume_path, st)
+        if cached is None:
+            return Response(status_code=202, headers={
+                "Retry-After": "1", "Cache-Control": "no-store",
+            })
+        etag = f'"{key}"'
+        # A request pinned to the current version can be cached forever.
+        headers = {
+            "ETag": etag,
+            "Cache-Control": (
+                _LONG_CACHE if v == thumbnail_version(st.st_mtime_ns, st.st_size, service.size)
+                else _SHORT_CACHE
+            ),
+        }
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(content=cached.read_bytes(), media_type="image/png", headers=headers)
+
+    return router
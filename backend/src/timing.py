@@ -0,0 +1,97 @@
+"""Per-stage wall-clock and memory timing for request pipelines.
+
+A `StageTimer` collects named stages (each timed with `with timer.stage(...)`)
+plus free-form tags such as the session, model and cache hits. It renders
+them as a `Server-Timing` header value and as one structured (JSON) log line,
+so a slow request can be attributed to I/O, preprocessing, the model or
+compression from either the browser's network panel or the server logs.
+
+Memory is the process resident set size, read after each stage together with
+its change over the stage; on CUDA the caller can attach allocator peaks.
+"""
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes() -> int:
+    """Current resident set size of this process (peak RSS where unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _header_token(value: str) -> str:
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in value)
+
+
+class StageTimer:
+    """Collects stage durations, memory readings and tags for one request."""
+
+    def __init__(self, **tags: Any):
+        self.tags: dict[str, Any] = dict(tags)
+        self.stages: list[dict[str, Any]] = []
+        self._start = time.perf_counter()
+
+    def tag(self, **tags: Any) -> None:
+        self.tags.update(tags)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the enclosed block; yields a dict for extra per-stage fields."""
+        extra: dict[str, Any] = {}
+        rss_before = rss_bytes()
+        t0 = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            elapsed = time.perf_counter() - t0
+            rss_after = rss_bytes()
+            self.stages.append({
+                "stage": name,
+                "ms": round(elapsed * 1000.0, 2),
+                "rss_mb": round(rss_after / 2**20, 1),
+                "rss_delta_mb": round((rss_after - rss_before) / 2**20, 1),
+                **extra,
+            })
+
+    def add(self, name: str, ms: float, **extra: Any) -> None:
+        """Record a stage measured elsewhere, e.g. time spent waiting in a queue."""
+        self.stages.append({"stage": name, "ms": round(ms, 2), **extra})
+
+    def total_ms(self) -> float:
+        return round((time.perf_counter() - self._start) * 1000.0, 2)
+
+    def server_timing(self) -> str:
+        """Render stages and tags as a Server-Timing header value."""
+        parts = [f"{_header_token(s['stage'])};dur={s['ms']}" for s in self.stages]
+        parts.append(f"total;dur={self.total_ms()}")
+        for key, value in self.tags.items():
+            if isinstance(value, bool) or isinstance(value, str):
+                if isinstance(value, bool):
+                    # Cache lookups read as hit/miss, other flags as true/false.
+                    if key.endswith("_cache"):
+                        desc = "hit" if value else "miss"
+                    else:
+                        desc = "true" if value else "false"
+                else:
+                    desc = value
+                parts.append(f'{_header_token(key)};desc="{_header_token(desc)}"')
+        return ", ".join(parts)
+
+    def as_record(self) -> dict[str, Any]:
+        return {**self.tags, "total_ms": self.total_ms(), "stages": self.stages}
+
+    def log(self, logger: logging.Logger, event: str, level: int = logging.INFO) -> None:
+        logger.log(level, f"{event} {json.dumps(self.as_record(), default=str)}")
@@ -0,0 +1,381 @@
+"""Streaming and resumable writes of uploaded volumes into DATA_DIR.
+
+Request bodies are written chunk by chunk to a temporary file next to the
+destination and renamed into place once complete, so peak memory does not
+depend on the size of the upload and readers never observe a partial file.
+
+Large uploads can also go through the /data/upload/* session API: the client
+creates an upload, PUTs numbered chunks (in any order, in parallel, each with
+an optional sha256), asks which chunks are still missing after a dropped
+connection, and finally commits.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+from collections.abc import AsyncIterator, Callable
+from pathlib import Path
+from typing import Any
+
+from fastapi import APIRouter, Header, HTTPException, Request
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from metrics import BYTES_WRITTEN
+
+logger = logging.getLogger(__name__)
+
+_TMP_PREFIX = ".upload-"
+# mkstemp creates files 0600; saved volumes get the usual umask-derived mode.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def normalize_volume_filename(filename: str) -> str:
+    """Strip the frontend's 'data/' URL prefix and default to .nii.gz."""
+    if not filename:
+        raise HTTPException(status_code=400, detail="Filename is required")
+    # Remove 'data/' prefix if present (frontend URLs vs backend paths)
+    if filename.startswith('data/'):
+        filename = filename[5:]
+    # Ensure filename has .nii or .nii.gz extension
+    if not filename.endswith('.nii') and not filename.endswith('.nii.gz'):
+        filename = filename + '.nii.gz'  # Default to compressed
+    return filename
+
+
+def resolve_target(data_dir: Path, filename: str) -> Path:
+    """Resolve `filename` under `data_dir`, rejecting paths that escape it."""
+    target = (data_dir / filename).resolve()
+    try:
+        target.relative_to(data_dir.resolve())
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid filename: {filename}")
+    return target
+
+
+def _open_temp(target: Path):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=target.parent)
+    os.fchmod(fd, 0o666 & ~_UMASK)
+    return os.fdopen(fd, 'wb'), Path(tmp)
+
+
+def write_atomic(target: Path, data: bytes) -> None:
+    """Write `data` to a temp file beside `target`, then rename into place."""
+    f, tmp = _open_temp(target)
+    try:
+        with f:
+            f.write(data)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+async def stream_to_file(
+    chunks: AsyncIterator[bytes],
+    target: Path,
+    max_bytes: int | None = None,
+) -> int:
+    """Write an async byte stream to `target` atomically; return bytes written.
+
+    Each chunk is written from the threadpool so slow (network) storage does
+    not stall the event loop. The temp file is removed if the stream fails or
+    exceeds `max_bytes`.
+    """
+    f, tmp = await run_in_threadpool(_open_temp, target)
+    written = 0
+    try:
+        with f:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                written += len(chunk)
+                if max_bytes is not None and written > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Upload exceeds {max_bytes} bytes",
+                    )
+                await run_in_threadpool(f.write, chunk)
+        await run_in_threadpool(os.replace, tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    logger.debug(f"Streamed {written} bytes to {target}")
+    return written
+
+
+# ----- resumable upload sessions -----
+
+_UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_STAGING_DIRNAME = ".uploads"
+_META_FILENAME = "upload.json"
+_PART_FILENAME = "data.part"
+_CHUNKS_DIRNAME = "chunks"
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class CreateUploadRequest(BaseModel):
+    filename: str
+    size: int
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+    sha256: str | None = None  # optional digest of the whole file, checked on commit
+
+
+class UploadSessionManager:
+    """Owns resumable uploads staged under DATA_DIR/.uploads/<upload_id>/.
+
+    Each upload has a preallocated `data.part` file that chunks are written
+    into at their own offsets, so chunks may arrive in any order and in
+    parallel. Each chunk is staged in a temp file and verified before it is
+    copied into `data.part`; it counts as received once its marker file
+    exists under `chunks/`, and the marker holds the chunk's sha256. A
+    re-sent chunk drops its marker first, so an interrupted or corrupt retry
+    shows up as missing again. The staging directory is the only state, so
+    uploads survive a server restart; its mtime is bumped on every chunk and
+    uploads idle for `ttl_seconds` are swept.
+
+    With a `blob_store`, committed uploads are moved into the store and
+    linked to their destination instead of being renamed there.
+    """
+
+    def __init__(self, data_dir: Path, ttl_seconds: int, blob_store=None):
+        self.data_dir = data_dir
+        self.staging_dir = data_dir / _STAGING_DIRNAME
+        self.ttl_seconds = ttl_seconds
+        self.blob_store = blob_store
+
+    def _upload_dir(self, upload_id: str) -> Path:
+        if not _UPLOAD_ID_RE.match(upload_id):
+            raise HTTPException(status_code=400, detail=f"Invalid upload id: {upload_id}")
+        upload_dir = self.staging_dir / upload_id
+        if not (upload_dir / _META_FILENAME).exists():
+            raise HTTPException(status_code=404, detail=f"Upload not found: {upload_id}")
+        return upload_dir
+
+    def _read_meta(self, upload_dir: Path) -> dict[str, Any]:
+        with open(upload_dir / _META_FILENAME, "r") as f:
+            return json.load(f)
+
+    def _sweep_expired(self) -> None:
+        if not self.staging_dir.exists():
+            return
+        cutoff = time.time() - self.ttl_seconds
+        for entry in self.staging_dir.iterdir():
+            try:
+                if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry)
+                    logger.info(f"Upload staging: expired {entry.name}")
+            except OSError as exc:
+                logger.warning(f"Upload staging: could not expire {entry.name}: {exc}")
+
+    def create(self, request: CreateUploadRequest) -> dict[str, Any]:
+        if request.size < 0:
+            raise HTTPException(status_code=400, detail="size must be >= 0")
+        if not 0 < request.chunk_size <= MAX_CHUNK_SIZE:
+            raise HTTPException(
+                status_code=400,
+                detail=f"chunk_size must be between 1 and {MAX_CHUNK_SIZE}",
+            )
+        filename = normalize_volume_filename(request.filename)
+        resolve_target(self.data_dir, filename)
+        self._sweep_expired()
+
+        upload_id = uuid.uuid4().hex
+        upload_dir = self.staging_dir / upload_id
+        (upload_dir / _CHUNKS_DIRNAME).mkdir(parents=True)
+        with open(upload_dir / _PART_FILENAME, "wb") as f:
+            f.truncate(request.size)
+        chunk_count = max(1, -(-request.size // request.chunk_size))
+        meta = {
+            "upload_id": upload_id,
+            "filename": filename,
+            "size": request.size,
+            "chunk_size": request.chunk_size,
+            "chunk_count": chunk_count,
+            "sha256": request.sha256.lower() if request.sha256 else None,
+        }
+        with open(upload_dir / _META_FILENAME, "w") as f:
+            json.dump(meta, f, indent=2)
+        logger.info(f"Upload created: {upload_id} -> {filename} ({request.size} bytes)")
+        return meta
+
+    def _chunk_length(self, meta: dict[str, Any], index: int) -> int:
+        start = index * meta["chunk_size"]
+        return max(0, min(meta["chunk_size"], meta["size"] - start))
+
+    async def write_chunk(
+        self,
+        upload_id: str,
+        index: int,
+        chunks: AsyncIterator[bytes],
+        sha256: str | None,
+    ) -> dict[str, Any]:
+        """Write chunk `index` at its offset, verifying length and checksum."""
+        upload_dir = self._upload_dir(upload_id)
+        meta = await run_in_threadpool(self._read_meta, upload_dir)
+        if not 0 <= index < meta["chunk_count"]:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Chunk index {index} out of range [0, {meta['chunk_count']})",
+            )
+        expected = self._chunk_length(meta, index)
+        offset = index * meta["chunk_size"]
+        marker = upload_dir / _CHUNKS_DIRNAME / str(index)
+        # A re-sent chunk no longer counts as received until it has been
+        # verified and written in full.
+        await run_in_threadpool(self._begin_chunk, upload_dir, marker)
+        hasher = hashlib.sha256()
+        written = 0
+        f, tmp = await run_in_threadpool(_open_temp, marker)
+        try:
+            with f:
+                async for piece in chunks:
+                    if not piece:
+                        continue
+                    if written + len(piece) > expected:
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"Chunk {index} exceeds its length of {expected} bytes",
+                        )
+                    hasher.update(piece)
+                    await run_in_threadpool(f.write, piece)
+                    written += len(piece)
+            if written != expected:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Chunk {index} is {written} bytes, expected {expected}",
+                )
+            digest = hasher.hexdigest()
+            if sha256 and sha256.lower() != digest:
+                raise HTTPException(
+                    status_code=422,
+                    detail=f"Checksum mismatch for chunk {index}",
+                )
+            await run_in_threadpool(self._store_chunk, upload_dir, tmp, offset, marker, digest)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return {"upload_id": upload_id, "index": index, "size": written, "sha256": digest}
+
+    def _begin_chunk(self, upload_dir: Path, marker: Path) -> None:
+        marker.unlink(missing_ok=True)
+        # Chunk writes do not change the directory's mtime, which expiry goes by.
+        os.utime(upload_dir)
+
+    def _store_chunk(self, upload_dir: Path, tmp: Path, offset: int, marker: Path, digest: str) -> None:
+        """Copy a verified chunk into data.part at `offset`, then mark it received."""
+        fd = os.open(upload_dir / _PART_FILENAME, os.O_WRONLY)
+        try:
+            with open(tmp, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    os.pwrite(fd, block, offset)
+                    offset += len(block)
+        finally:
+            os.close(fd)
+        write_atomic(marker, digest.encode("ascii"))
+        os.utime(upload_dir)
+
+    def status(self, upload_id: str) -> dict[str, Any]:
+        upload_dir = self._upload_dir(upload_id)
+        meta = self._read_meta(upload_dir)
+        received = {
+            int(p.name) for p in (upload_dir / _CHUNKS_DIRNAME).iterdir()
+            if p.name.isdigit()
+        }
+        missing = [i for i in range(meta["chunk_count"]) if i not in received]
+        return {**meta, "received": sorted(received), "missing": missing}
+
+    def commit(self, upload_id: str) -> tuple[str, Path]:
+        """Move a fully received upload to its destination under DATA_DIR."""
+        upload_dir = self._upload_dir(upload_id)
+        state = self.status(upload_id)
+        if state["missing"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload incomplete; {len(state['missing'])} chunk(s) missing",
+            )
+        part = upload_dir / _PART_FILENAME
+        if state["sha256"]:
+            hasher = hashlib.sha256()
+            with open(part, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(block)
+            if hasher.hexdigest() != state["sha256"]:
+                raise HTTPException(status_code=422, detail="Checksum mismatch for upload")
+        target = resolve_target(self.data_dir, state["filename"])
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if self.blob_store is not None:
+            self.blob_store.link(self.blob_store.put_file(part), target)
+        else:
+            os.replace(part, target)
+            BYTES_WRITTEN.inc(state["size"], kind="volume")
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        logger.info(f"Upload committed: {upload_id} -> {target}")
+        return state["filename"], target
+
+    def abort(self, upload_id: str) -> None:
+        shutil.rmtree(self._upload_dir(upload_id), ignore_errors=True)
+        logger.info(f"Upload aborted: {upload_id}")
+
+
+def build_router(
+    *,
+    data_dir: Path,
+    ttl_seconds: int,
+    on_commit: Callable[[Path], None] | None = None,
+    blob_store=None,
+) -> APIRouter:
+    """Build the /data/upload/* router for resumable chunked uploads."""
+    router = APIRouter(prefix="/data/upload")
+    manager = UploadSessionManager(
+        data_dir=data_dir, ttl_seconds=ttl_seconds, blob_store=blob_store,
+    )
+
+    @router.post("")
+    def upload_create(request: CreateUploadRequest):
+        meta = manager.create(request)
+        return {
+            "upload_id": meta["upload_id"],
+            "chunk_size": meta["chunk_size"],
+            "chunk_count": meta["chunk_count"],
+        }
+
+    @router.get("/{upload_id}")
+    def upload_status(upload_id: str):
+        return manager.status(upload_id)
+
+    @router.put("/{upload_id}/chunk/{index}")
+    async def upload_chunk(
+        upload_id: str,
+        index: int,
+        request: Request,
+        x_chunk_sha256: str | None = Header(default=None),
+    ):
+        return await manager.write_chunk(
+            upload_id, index, request.stream(), x_chunk_sha256,
+        )
+
+    @router.post("/{upload_id}/commit")
+    def upload_commit(upload_id: str):
+        filename, target = manager.commit(upload_id)
+        if on_commit is not None:
+            on_commit(target)
+        return {
+            "success": True,
+            "message": f"Volume saved successfully to {filename}",
+            "file_path": filename,
+        }
+
+    @router.delete("/{upload_id}")
+    def upload_abort(upload_id: str):
+        manager.abort(upload_id)
+        return {"success": True}
+
+    return router
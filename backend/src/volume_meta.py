@@ -0,0 +1,164 @@
+"""Header-only metadata for imaging files, persisted in a small SQLite index.
+
+Dimensions, voxel size, dtype, orientation and file size come from the image
+header alone, so they are cheap enough to compute on request. The intensity
+range is the only value that needs the voxel data; it is filled in by a
+background thread that streams the volume slab by slab, and reported as null
+until then.
+
+Entries are keyed by path + mtime + size, so a rewritten file is re-parsed
+and restarts reuse everything computed so far.
+"""
+import json
+import logging
+import math
+import queue
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+META_DIRNAME = ".meta"
+_SLAB_SLICES = 8
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS volume_meta (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    meta TEXT NOT NULL,
+    range_min REAL,
+    range_max REAL
+)
+"""
+
+
+def read_header_meta(path: Path) -> dict[str, Any]:
+    """Parse only the image header of `path` (no voxel data is read)."""
+    import nibabel as nib
+    import numpy as np
+
+    st = path.stat()
+    img = nib.load(str(path))
+    header = img.header
+    shape = [int(s) for s in img.shape]
+    ornt = nib.io_orientation(img.affine)
+    ras_dims = list(shape[:3])
+    for vox_axis, (ras_axis, _flip) in enumerate(ornt[:len(shape)]):
+        ras_dims[int(ras_axis)] = shape[vox_axis]
+    dtype = np.dtype(header.get_data_dtype())
+    return {
+        "dims": shape,
+        "ras_dims": ras_dims,
+        "voxel_size": [float(z) for z in header.get_zooms()],
+        "dtype": dtype.name,
+        "orientation": "".join(nib.aff2axcodes(img.affine)),
+        "file_size": st.st_size,
+        "data_bytes": int(np.prod(shape)) * dtype.itemsize,
+        "intensity_range": None,
+    }
+
+
+def compute_intensity_range(path: Path) -> tuple[float, float] | None:
+    """Return the (min, max) of the finite voxel values of `path`."""
+    import nibabel as nib
+    import numpy as np
+
+    from pyramids import iter_slabs
+
+    img = nib.load(str(path))
+    if isinstance(img, (nib.Nifti1Image, nib.Nifti2Image)) and len(img.shape) >= 3:
+        slabs = (slab for _frame, _z0, slab in iter_slabs(img, path, _SLAB_SLICES))
+    else:
+        slabs = iter([np.asanyarray(img.dataobj)])
+    lo, hi = math.inf, -math.inf
+    for slab in slabs:
+        finite = slab[np.isfinite(slab)] if slab.dtype.kind == "f" else slab
+        if finite.size:
+            lo = min(lo, float(finite.min()))
+            hi = max(hi, float(finite.max()))
+    return (lo, hi) if lo <= hi else None
+
+
+class VolumeMetaIndex:
+    """SQLite-backed cache of `read_header_meta` plus background range jobs."""
+
+    def __init__(self, db_path: Path, data_dir: Path, max_queue: int = 10000):
+        self.db_path = db_path
+        self.data_dir = data_dir
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[tuple[str, int, int]] = queue.Queue(maxsize=max_queue)
+        self._queued: set[str] = set()
+        self._failed: set[tuple[str, int, int]] = set()
+        self._thread = threading.Thread(
+            target=self._range_worker, name="volume-meta-range", daemon=True,
+        )
+        self._thread.start()
+
+    def get(self, rel: str) -> dict[str, Any]:
+        """Metadata for `rel` (relative to DATA_DIR), parsing the header on a miss."""
+        path = (self.data_dir / rel).resolve()
+        if not path.is_relative_to(self.data_dir.resolve()):
+            raise ValueError(f"Path escapes DATA_DIR: {rel}")
+        st = path.stat()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT meta, range_min, range_max FROM volume_meta "
+                "WHERE path = ? AND mtime_ns = ? AND size = ?",
+                (rel, st.st_mtime_ns, st.st_size),
+            ).fetchone()
+        if row is not None:
+            meta = json.loads(row[0])
+            if row[1] is not None:
+                meta["intensity_range"] = [row[1], row[2]]
+            else:
+                self._enqueue_range(rel, st.st_mtime_ns, st.st_size)
+            return meta
+
+        meta = read_header_meta(path)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO volume_meta (path, mtime_ns, size, meta) "
+                "VALUES (?, ?, ?, ?)",
+                (rel, st.st_mtime_ns, st.st_size, json.dumps(meta)),
+            )
+            self._db.commit()
+        self._enqueue_range(rel, st.st_mtime_ns, st.st_size)
+        return meta
+
+    def _enqueue_range(self, rel: str, mtime_ns: int, size: int) -> None:
+        with self._lock:
+            if rel in self._queued or (rel, mtime_ns, size) in self._failed:
+                return
+            try:
+                self._queue.put_nowait((rel, mtime_ns, size))
+            except queue.Full:
+                return
+            self._queued.add(rel)
+
+    def _range_worker(self) -> None:
+        while True:
+            rel, mtime_ns, size = self._queue.get()
+            try:
+                value = compute_intensity_range(self.data_dir / rel)
+                if value is not None:
+                    with self._lock:
+                        self._db.execute(
+                            "UPDATE volume_meta SET range_min = ?, range_max = ? "
+                            "WHERE path = ? AND mtime_ns = ? AND size = ?",
+                            (value[0], value[1], rel, mtime_ns, size),
+                        )
+                        self._db.commit()
+            except Exception as exc:
+                logger.warning(f"Intensity range failed for {rel}: {exc}")
+                with self._lock:
+                    self._failed.add((rel, mtime_ns, size))
+            finally:
+                with self._lock:
+                    self._queued.discard(rel)
@@ -115,9 +115,16 @@ if command -v ss >/dev/null 2>&1; then
 fi
 
 # Start the backend (FastAPI)
-echo "Starting backend on ${BACKEND_HOST}:${BACKEND_PORT}..."
+# With several workers, AI session state must be shared between them.
+# Each worker also runs its own catalog poller and metadata indexer; only
+# pyramid building is limited to one worker (by a lock in DATA_DIR/.pyramids).
+BACKEND_WORKERS=${BACKEND_WORKERS:-1}
+if [ "$BACKEND_WORKERS" -gt 1 ]; then
+    export ENABLE_AI_SHARED_STATE=${ENABLE_AI_SHARED_STATE:-true}
+fi
+echo "Starting backend on ${BACKEND_HOST}:${BACKEND_PORT} (${BACKEND_WORKERS} workers)..."
 cd /app/backend
-uvicorn src.server:app --host ${BACKEND_HOST} --port ${BACKEND_PORT} &
+uvicorn src.server:app --host ${BACKEND_HOST} --port ${BACKEND_PORT} --workers ${BACKEND_WORKERS} &
 BACKEND_PID=$!
 
 # Give backend time to start
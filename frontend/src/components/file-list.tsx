@@ -1,8 +1,64 @@
-import React, { useEffect, useState } from 'react'
+import React, { useEffect, useRef, useState } from 'react'
+
+export interface PyramidLevel {
+  factor: number;
+  url: string;
+}
 
 export interface FileItem {
   filename: string;
   url: string;
+  levels?: PyramidLevel[];
+  thumbnail?: string;
+}
+
+const THUMBNAIL_MAX_ATTEMPTS = 10
+
+// Fetches a thumbnail once it scrolls into view. The backend answers 202 while
+// the thumbnail is still being rendered, so retry after its Retry-After delay.
+const Thumbnail: React.FC<{ url: string }> = ({ url }) => {
+  const ref = useRef<HTMLDivElement>(null)
+  const [src, setSrc] = useState<string | null>(null)
+
+  useEffect(() => {
+    const element = ref.current
+    if (!element) return
+    let cancelled = false
+    let objectUrl: string | null = null
+
+    const load = async () => {
+      for (let attempt = 0; attempt < THUMBNAIL_MAX_ATTEMPTS && !cancelled; attempt++) {
+        const response = await fetch(url)
+        if (response.status === 200) {
+          objectUrl = URL.createObjectURL(await response.blob())
+          if (!cancelled) setSrc(objectUrl)
+          return
+        }
+        if (response.status !== 202 && response.status !== 503) return
+        const delay = Number(response.headers.get('Retry-After') ?? '1')
+        await new Promise((resolve) => setTimeout(resolve, delay * 1000))
+      }
+    }
+
+    const observer = new IntersectionObserver((entries) => {
+      if (entries.some((entry) => entry.isIntersecting)) {
+        observer.disconnect()
+        load().catch((err) => console.warn(`Thumbnail ${url} failed:`, err))
+      }
+    })
+    observer.observe(element)
+    return () => {
+      cancelled = true
+      observer.disconnect()
+      if (objectUrl) URL.revokeObjectURL(objectUrl)
+    }
+  }, [url])
+
+  return (
+    <div ref={ref} className="h-8 w-24 shrink-0 rounded-sm bg-muted">
+      {src && <img src={src} alt="" className="h-full w-full object-contain" />}
+    </div>
+  )
 }
 
 interface FileListProps {
@@ -53,10 +109,11 @@ export const FileList: React.FC<FileListProps> = ({
           {files.map((file, index) => (
             <li
               key={index}
-              className="cursor-pointer px-3 py-2 rounded-md text-sm hover:bg-accent hover:text-accent-foreground transition-colors"
+              className="flex items-center gap-2 cursor-pointer px-3 py-2 rounded-md text-sm hover:bg-accent hover:text-accent-foreground transition-colors"
               onClick={() => onFileSelect(file)}
             >
-              {file.filename}
+              {file.thumbnail && <Thumbnail url={file.thumbnail} />}
+              <span className="min-w-0 break-all">{file.filename}</span>
             </li>
           ))}
         </ul>
@@ -1,11 +1,18 @@
-import { useCallback, useEffect } from "react";
-import type { Niivue } from "@niivue/niivue";
+import { useCallback, useEffect, useRef } from "react";
+import { NVImage, type Niivue } from "@niivue/niivue";
 import { useFreeBrowseStore } from "@/store";
 import {
   requestImagingUploadConfirmation,
   requestSessionDeleteConfirmation,
 } from "@/lib/confirmations";
-import { uint8ArrayToBase64 } from "@/lib/niivue-helpers";
+import { uploadVolume } from "@/lib/volume-upload";
+import { drawingStrokes, type ClickStroke } from "@/lib/drawing-clicks";
+import {
+  MASK_MEDIA_TYPE,
+  decodeMask,
+  maskToNifti,
+  type DecodedMask,
+} from "@/lib/mask-codec";
 import type { AiSessionSummary } from "@/store/ai-slice";
 
 const SESSION_NAME_RE = /^[A-Za-z0-9_-]+$/;
@@ -34,47 +41,38 @@ async function fetchArrayBuffer(url: string): Promise<Uint8Array> {
   return new Uint8Array(await res.arrayBuffer());
 }
 
-async function exportAndUploadDrawing(
-  nv: Niivue,
-  sessionName: string,
-): Promise<string | null> {
-  if (!nv.drawBitmap || nv.volumes.length === 0) return null;
-  // NVImage.saveToUint8Array(filename, drawing8) returns the drawing as a
-  // gzipped NIfTI (when filename ends in .gz), without triggering a download.
-  const annotRel = "annotations.nii.gz";
-  const bytes = await nv.volumes[0].saveToUint8Array(annotRel, nv.drawBitmap);
-  const targetPath = `ai-sessions/${sessionName}/${annotRel}`;
-  const res = await fetch("/data/nii", {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({
-      filename: targetPath,
-      data: uint8ArrayToBase64(bytes),
-    }),
-  });
-  if (!res.ok)
-    throw new Error(`annotations upload failed: ${res.status} ${res.statusText}`);
-  return annotRel;
-}
-
-async function postSetAnnots(
+async function postClicks(
   sessionId: string,
-  annotationRelPath: string,
+  strokes: ClickStroke[],
+  replace: boolean,
 ): Promise<void> {
   const res = await fetch(
-    `/ai/session/${encodeURIComponent(sessionId)}/set_annots`,
+    `/ai/session/${encodeURIComponent(sessionId)}/clicks`,
     {
       method: "POST",
       headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ annotation_path: annotationRelPath }),
+      body: JSON.stringify({ strokes, space: "ras_voxel", replace }),
     },
   );
   if (!res.ok) {
     const msg = await res.text();
-    throw new Error(`set_annots failed (${res.status}): ${msg}`);
+    throw new Error(`clicks failed (${res.status}): ${msg}`);
   }
 }
 
+async function materializeAnnotations(sessionId: string): Promise<string | null> {
+  const res = await fetch(
+    `/ai/session/${encodeURIComponent(sessionId)}/clicks/materialize`,
+    { method: "POST" },
+  );
+  if (!res.ok) {
+    const msg = await res.text();
+    throw new Error(`materialize failed (${res.status}): ${msg}`);
+  }
+  const data = await res.json();
+  return data.annotation_path ?? null;
+}
+
 const RESULT_FILENAME = "result.nii.gz";
 const AI_RESULT_COLORMAP_NAME = "sky_blue";
 
@@ -107,6 +105,34 @@ export function useAiSession(nvRef: React.RefObject<Niivue | null>) {
   const incrementVolumeVersion = useFreeBrowseStore(
     (s) => s.incrementVolumeVersion,
   );
+  // Drawing layer as last sent to the session, so only edits are sent next.
+  const sentDrawingRef = useRef<{ sessionId: string; bitmap: Uint8Array } | null>(
+    null,
+  );
+  // Last inline result, so the next one can be sent as a delta against it.
+  const lastResultRef = useRef<{
+    sessionId: string;
+    version: string;
+    mask: DecodedMask;
+  } | null>(null);
+
+  /** Send drawing-layer edits as click prompts; false if there is no layer. */
+  const syncDrawing = useCallback(
+    async (nv: Niivue, sessionId: string): Promise<boolean> => {
+      const dims = nv.volumes[0]?.dimsRAS;
+      if (!nv.drawBitmap || !dims) return false;
+      const sent =
+        sentDrawingRef.current?.sessionId === sessionId
+          ? sentDrawingRef.current.bitmap
+          : null;
+      const strokes = drawingStrokes(nv.drawBitmap, sent, [dims[1], dims[2], dims[3]]);
+      if (sent && strokes.length === 0) return true;
+      await postClicks(sessionId, strokes, !sent);
+      sentDrawingRef.current = { sessionId, bitmap: nv.drawBitmap.slice() };
+      return true;
+    },
+    [],
+  );
 
   const refreshSessions = useCallback(async () => {
     try {
@@ -191,17 +217,7 @@ export function useAiSession(nvRef: React.RefObject<Niivue | null>) {
         const basename = ensureNiiName(volume.name);
         const targetPath = `ai-sessions/${trimmed}/${basename}`;
         const uint8Array = await volume.saveToUint8Array(basename);
-        const base64Data = uint8ArrayToBase64(uint8Array);
-
-        const uploadRes = await fetch("/data/nii", {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({ filename: targetPath, data: base64Data }),
-        });
-        if (!uploadRes.ok)
-          throw new Error(
-            `Volume upload failed: ${uploadRes.status} ${uploadRes.statusText}`,
-          );
+        await uploadVolume(targetPath, uint8Array);
 
         volumePathForSetVolume = targetPath;
       } else {
@@ -253,9 +269,13 @@ export function useAiSession(nvRef: React.RefObject<Niivue | null>) {
       await nv.loadVolumes([{ url: volumeUrl }]);
       incrementVolumeVersion();
 
+      sentDrawingRef.current = null;
       if (summary.annotation_path) {
         try {
-          const annotUrl = `/data/ai-sessions/${summary.session_name}/${summary.annotation_path}`;
+          // Click annotations are written out as a NIfTI only when needed.
+          const annotRel = await materializeAnnotations(summary.session_id);
+          if (!annotRel) throw new Error("session has no annotation file");
+          const annotUrl = `/data/ai-sessions/${summary.session_name}/${annotRel}?t=${Date.now()}`;
           const bytes = await fetchArrayBuffer(annotUrl);
           const nvimage = await nv.niftiArray2NVImage(bytes);
           const ok = nv.loadDrawing(nvimage);
@@ -263,6 +283,11 @@ export function useAiSession(nvRef: React.RefObject<Niivue | null>) {
             console.warn(
               "loadDrawing returned false — annotation dimensions may not match the volume",
             );
+          else if (nv.drawBitmap)
+            sentDrawingRef.current = {
+              sessionId: summary.session_id,
+              bitmap: nv.drawBitmap.slice(),
+            };
         } catch (err) {
           console.error("Failed to load existing annotations:", err);
         }
@@ -284,17 +309,21 @@ export function useAiSession(nvRef: React.RefObject<Niivue | null>) {
       if (!nv || !active || nv.volumes.length === 0)
         throw new Error("No active session or volume");
 
-      const annotRel = await exportAndUploadDrawing(nv, active.session_name);
-      if (!annotRel)
+      if (!(await syncDrawing(nv, active.session_id)))
         throw new Error("No drawing layer to send as annotations");
 
-      await postSetAnnots(active.session_id, annotRel);
-
+      const previous = lastResultRef.current;
+      const base = previous?.sessionId === active.session_id ? previous : null;
       const inferRes = await fetch(
-        `/ai/session/${encodeURIComponent(active.session_id)}/infer/${encodeURIComponent(mlId)}`,
+        `/ai/session/${encodeURIComponent(active.session_id)}/infer/${encodeURIComponent(mlId)}` +
+          (base ? `?since=${encodeURIComponent(base.version)}` : ""),
         {
           method: "POST",
-          headers: { "Content-Type": "application/json" },
+          headers: {
+            "Content-Type": "application/json",
+            // Get the result inline; result.nii.gz is still written for reloads.
+            Accept: `${MASK_MEDIA_TYPE}, application/json`,
+          },
           body: JSON.stringify({ label_value: labelValue }),
         },
       );
@@ -302,7 +331,20 @@ export function useAiSession(nvRef: React.RefObject<Niivue | null>) {
         const msg = await inferRes.text();
         throw new Error(`inference failed (${inferRes.status}): ${msg}`);
       }
-      await inferRes.json();
+      const inline = inferRes.headers.get("Content-Type")?.startsWith(MASK_MEDIA_TYPE);
+      let mask: DecodedMask | null = null;
+      if (inline) {
+        const bytes = new Uint8Array(await inferRes.arrayBuffer());
+        const isDelta = inferRes.headers.get("X-Result-Base") === base?.version;
+        mask = decodeMask(bytes, isDelta ? base?.mask : undefined);
+        const version = inferRes.headers.get("X-Result-Version");
+        lastResultRef.current = version
+          ? { sessionId: active.session_id, version, mask }
+          : null;
+      } else {
+        await inferRes.json();
+        lastResultRef.current = null;
+      }
 
       // Replace any prior result overlay before loading the fresh one.
       const lastIdx = nv.volumes.length - 1;
@@ -315,19 +357,29 @@ export function useAiSession(nvRef: React.RefObject<Niivue | null>) {
         }
       }
 
-      const resultUrl =
-        `/data/ai-sessions/${active.session_name}/${RESULT_FILENAME}` +
-        `?t=${Date.now()}`;
       nv.addColormap(AI_RESULT_COLORMAP_NAME, AI_RESULT_COLORMAP);
-      await nv.addVolumeFromUrl({
-        url: resultUrl,
-        name: RESULT_FILENAME,
-        colormap: AI_RESULT_COLORMAP_NAME,
-        opacity: 0.5,
-      });
+      if (mask) {
+        const nvimage = await NVImage.loadFromUrl({
+          url: maskToNifti(mask),
+          name: RESULT_FILENAME,
+          colormap: AI_RESULT_COLORMAP_NAME,
+          opacity: 0.5,
+        });
+        nv.addVolume(nvimage);
+      } else {
+        const resultUrl =
+          `/data/ai-sessions/${active.session_name}/${RESULT_FILENAME}` +
+          `?t=${Date.now()}`;
+        await nv.addVolumeFromUrl({
+          url: resultUrl,
+          name: RESULT_FILENAME,
+          colormap: AI_RESULT_COLORMAP_NAME,
+          opacity: 0.5,
+        });
+      }
       incrementVolumeVersion();
     },
-    [nvRef, incrementVolumeVersion],
+    [nvRef, incrementVolumeVersion, syncDrawing],
   );
 
   const handleExitAndSaveSession = useCallback(async (): Promise<void> => {
@@ -335,14 +387,13 @@ export function useAiSession(nvRef: React.RefObject<Niivue | null>) {
     const active = useFreeBrowseStore.getState().aiActiveSession;
     if (nv && active) {
       try {
-        const annotRel = await exportAndUploadDrawing(nv, active.session_name);
-        if (annotRel) await postSetAnnots(active.session_id, annotRel);
+        await syncDrawing(nv, active.session_id);
       } catch (err) {
         console.error("Failed to save annotations on exit:", err);
       }
     }
     exitDrawModeLocal();
-  }, [nvRef, exitDrawModeLocal]);
+  }, [nvRef, exitDrawModeLocal, syncDrawing]);
 
   const handleExitAndDeleteSession = useCallback(async (): Promise<void> => {
     if (!aiActiveSession) return;
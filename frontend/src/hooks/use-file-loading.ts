@@ -2,6 +2,48 @@ import { useCallback, useEffect, useRef } from "react";
 import { useFreeBrowseStore } from "@/store";
 import { NVDocument, NVImage, type Niivue } from "@niivue/niivue";
 import type { FileItem } from "@/components/file-list";
+import {
+  readBinaryNvdBlob,
+  readBinaryNvdStream,
+  type BinaryNvdHeader,
+  type OnNvdImage,
+} from "@/lib/nvd-binary";
+
+type BinaryNvdReader = (
+  onHeader: (header: BinaryNvdHeader) => Promise<void>,
+  onImage: OnNvdImage,
+) => Promise<BinaryNvdHeader>;
+
+const isBinaryNvdName = (name: string) => name.toLowerCase().endsWith(".nvdb");
+
+// Same defaults as NVImage.loadFromBase64, minus the base64 decoding.
+function nvImageFromBytes(bytes: Uint8Array, name: string, o: any) {
+  // Payload views own their whole buffer, so this hands it over without a copy.
+  const buffer =
+    bytes.byteOffset === 0 && bytes.byteLength === bytes.buffer.byteLength
+      ? bytes.buffer
+      : bytes.slice().buffer;
+  return NVImage.new(
+    buffer as ArrayBuffer,
+    name,
+    o.colormap ?? "",
+    o.opacity ?? 1,
+    null,
+    o.cal_min ?? NaN,
+    o.cal_max ?? NaN,
+    o.trustCalMinMax ?? true,
+    o.percentileFrac ?? 0.02,
+    o.ignoreZeroVoxels ?? false,
+    o.useQFormNotSForm ?? false,
+    o.colormapNegative ?? "",
+    o.frame4D ?? 0,
+    o.imageType ?? 0,
+    o.cal_minNeg ?? NaN,
+    o.cal_maxNeg ?? NaN,
+    o.colorbarVisible ?? true,
+    o.colormapLabel ?? null,
+  );
+}
 
 export function useFileLoading(
   nvRef: React.RefObject<Niivue | null>,
@@ -125,6 +167,43 @@ export function useFileLoading(
     [nvRef, setCurrentImageIndex, syncViewerOptionsFromNiivue, incrementVolumeVersion, updateSurfaceDetails],
   );
 
+  // Load a binary NVD (.nvdb): the scene is set up from the header, then each
+  // image is added as soon as its payload has been read.
+  const loadBinaryNvd = useCallback(
+    async (read: BinaryNvdReader) => {
+      if (!nvRef.current) return;
+      const nv = nvRef.current;
+      let imageOptions: any[] = [];
+
+      await read(
+        async (header) => {
+          const jsonData: any = { ...header };
+          delete jsonData.blobs;
+          imageOptions = jsonData.imageOptionsArray ?? [];
+          await loadNvdData(jsonData);
+        },
+        async (index, entry, bytes) => {
+          try {
+            const nvimage = await nvImageFromBytes(
+              bytes,
+              entry.name,
+              imageOptions[index] ?? {},
+            );
+            nv.addVolume(nvimage);
+            incrementVolumeVersion();
+            console.log(`Loaded binary NVD image ${index + 1}: ${entry.name}`);
+          } catch (error) {
+            console.error(`Failed to load binary NVD image ${index}:`, error);
+          }
+        },
+      );
+
+      syncViewerOptionsFromNiivue();
+      setCurrentImageIndex(0);
+    },
+    [nvRef, loadNvdData, incrementVolumeVersion, syncViewerOptionsFromNiivue, setCurrentImageIndex],
+  );
+
   // Add uploaded files to Niivue
   const handleFileUpload = useCallback(
     async (files: File[]) => {
@@ -151,12 +230,19 @@ export function useFileLoading(
       const nvdFiles = files.filter(
         (file) =>
           file.name.toLowerCase().endsWith(".nvd") ||
+          isBinaryNvdName(file.name) ||
           file.name.toLowerCase().endsWith(".json"),
       );
 
       if (nvdFiles.length > 0) {
         const nvdFile = nvdFiles[0];
         try {
+          if (isBinaryNvdName(nvdFile.name)) {
+            await loadBinaryNvd((onHeader, onImage) =>
+              readBinaryNvdBlob(nvdFile, onHeader, onImage),
+            );
+            return;
+          }
           const text = await nvdFile.text();
           const jsonData = JSON.parse(text);
           console.log("NVD data loaded from uploaded file:", jsonData);
@@ -184,7 +270,7 @@ export function useFileLoading(
         }
       }
     },
-    [nvRef, showUploader, currentImageIndex, loadNvdData, applyViewerOptions, incrementVolumeVersion, setShowUploader, setCurrentImageIndex],
+    [nvRef, showUploader, currentImageIndex, loadNvdData, loadBinaryNvd, applyViewerOptions, incrementVolumeVersion, setShowUploader, setCurrentImageIndex],
   );
 
   const handleImagingFileSelect = useCallback(
@@ -216,8 +302,23 @@ export function useFileLoading(
           name: basename,
         };
 
+        // With pyramid levels available, show the coarsest one right away and
+        // swap in the full-resolution volume once it has loaded.
+        const coarsest = file.levels?.length
+          ? file.levels[file.levels.length - 1]
+          : null;
+        const preview = coarsest
+          ? await nv.addVolumeFromUrl({ url: coarsest.url, name: basename })
+          : null;
+        if (preview) {
+          applyViewerOptions();
+          incrementVolumeVersion();
+          setCurrentImageIndex(nv.volumes.length - 1);
+        }
+
         console.log("Adding imaging file to scene:", volume);
         await nv.addVolumeFromUrl(volume);
+        if (preview) nv.removeVolume(preview);
 
         applyViewerOptions();
         incrementVolumeVersion();
@@ -244,9 +345,12 @@ export function useFileLoading(
         if (!response.ok) {
           throw new Error(`HTTP error! status: ${response.status}`);
         }
-        const jsonData = await response.json();
-        console.log("json data returned from server:");
-        console.log(jsonData);
+        const body = isBinaryNvdName(file.filename) ? response.body : null;
+        const jsonData = body ? null : await response.json();
+        if (jsonData) {
+          console.log("json data returned from server:");
+          console.log(jsonData);
+        }
 
         setShowUploader(false);
 
@@ -261,12 +365,18 @@ export function useFileLoading(
           throw new Error("Canvas failed to initialize after 2 seconds");
         }
 
-        await loadNvdData(jsonData);
+        if (body) {
+          await loadBinaryNvd((onHeader, onImage) =>
+            readBinaryNvdStream(body, onHeader, onImage),
+          );
+        } else {
+          await loadNvdData(jsonData);
+        }
       } catch (error) {
         console.error("Error loading NVD:", error);
       }
     },
-    [nvRef, loadNvdData, setShowUploader],
+    [nvRef, loadNvdData, loadBinaryNvd, setShowUploader],
   );
 
   const handleFileChange = useCallback(
@@ -1,6 +1,6 @@
 import { useCallback } from "react";
 import { useFreeBrowseStore } from "@/store";
-import { uint8ArrayToBase64 } from "@/lib/niivue-helpers";
+import { uploadVolume } from "@/lib/volume-upload";
 import { requestImagingUploadConfirmation } from "@/lib/confirmations";
 import type { Niivue } from "@niivue/niivue";
 
@@ -184,26 +184,10 @@ export function useSave(nvRef: React.RefObject<Niivue | null>) {
                 ? volumeState.url
                 : volumeState.url + ".gz";
               const uint8Array = await volume.saveToUint8Array(filename);
-              const base64Data = uint8ArrayToBase64(uint8Array);
-
-              const volumeResponse = await fetch("/data/nii", {
-                method: "POST",
-                headers: {
-                  "Content-Type": "application/json",
-                },
-                body: JSON.stringify({
-                  filename: volumeState.url,
-                  data: base64Data,
-                }),
-              });
-
-              if (!volumeResponse.ok) {
-                throw new Error(
-                  `Failed to save volume ${index}: ${volumeResponse.statusText}`,
-                );
-              }
-
-              const volumeResult = await volumeResponse.json();
+              const volumeResult = await uploadVolume(
+                volumeState.url,
+                uint8Array,
+              );
               console.log(`Volume ${index} saved successfully:`, volumeResult);
             } catch (error) {
               console.error(`Error saving volume ${index}:`, error);
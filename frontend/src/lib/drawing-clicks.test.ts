@@ -0,0 +1,32 @@
+import { describe, it, expect } from "vitest";
+
+import { drawingStrokes } from "./drawing-clicks";
+
+describe("drawingStrokes", () => {
+  const dims: [number, number, number] = [4, 3, 2];
+
+  it("sends every drawn voxel the first time", () => {
+    const current = new Uint8Array(24);
+    current[1] = 1;
+    current[4 + 12] = 2; // x 0, y 1, z 1
+    expect(drawingStrokes(current, null, dims)).toEqual([
+      { label: 1, points: [[1, 0, 0]] },
+      { label: 2, points: [[0, 1, 1]] },
+    ]);
+  });
+
+  it("sends only changes, including erasures", () => {
+    const previous = new Uint8Array(24);
+    previous[1] = 1;
+    previous[2] = 1;
+    const current = previous.slice();
+    current[2] = 0;
+    current[23] = 2;
+    current[5] = 7; // not a prompt label
+    expect(drawingStrokes(current, previous, dims)).toEqual([
+      { label: 0, points: [[2, 0, 0]] },
+      { label: 2, points: [[3, 2, 1]] },
+    ]);
+    expect(drawingStrokes(previous, previous, dims)).toEqual([]);
+  });
+});
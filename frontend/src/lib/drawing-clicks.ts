@@ -0,0 +1,37 @@
+/**
+ * Turn edits of the niivue drawing layer into click prompts for
+ * POST /ai/session/{id}/clicks (see backend/src/session_clicks.py).
+ *
+ * The drawing bitmap is indexed on the volume's RAS-reoriented grid with x
+ * fastest, which is the backend's "ras_voxel" space, so changed voxels can be
+ * sent as-is instead of uploading the whole layer as a NIfTI.
+ */
+
+export interface ClickStroke {
+  label: number;
+  points: [number, number, number][];
+}
+
+// 0 = erase, 1 = positive, 2 = negative; other pen values are not prompts.
+const PROMPT_LABELS = new Set([0, 1, 2]);
+
+/**
+ * Voxels whose value differs from `previous` (or from an empty layer),
+ * grouped into one stroke per new value.
+ */
+export function drawingStrokes(
+  current: Uint8Array,
+  previous: Uint8Array | null,
+  dims: [number, number, number],
+): ClickStroke[] {
+  const [nx, ny] = dims;
+  const byLabel = new Map<number, [number, number, number][]>();
+  for (let i = 0; i < current.length; i++) {
+    const value = current[i];
+    if (value === (previous ? previous[i] : 0) || !PROMPT_LABELS.has(value)) continue;
+    let points = byLabel.get(value);
+    if (!points) byLabel.set(value, (points = []));
+    points.push([i % nx, Math.floor(i / nx) % ny, Math.floor(i / (nx * ny))]);
+  }
+  return Array.from(byLabel, ([label, points]) => ({ label, points }));
+}
@@ -0,0 +1,62 @@
+import { describe, it, expect } from "vitest";
+
+import { decodeMask, maskToNifti } from "./mask-codec";
+
+// Mirrors backend/src/mask_codec.py for a 4 x 3 x 2 volume.
+function encode(encoding: number, payload: number[], label = 3): Uint8Array {
+  const out = new Uint8Array(88 + payload.length);
+  const view = new DataView(out.buffer);
+  out.set([0x46, 0x42, 0x4d, 0x4b], 0);
+  view.setUint8(4, 1);
+  view.setUint8(5, encoding);
+  view.setUint8(6, label);
+  [4, 3, 2].forEach((d, i) => view.setUint32(8 + 4 * i, d, true));
+  const affine = [2, 0, 0, -10, 0, 2, 0, -20, 0, 0, 3, -30, 0, 0, 0, 1];
+  affine.forEach((v, i) => view.setFloat32(20 + 4 * i, v, true));
+  view.setUint32(84, payload.length, true);
+  out.set(payload, 88);
+  return out;
+}
+
+// Voxels 1, 2 and 23 set.
+const expected = new Uint8Array(24);
+expected[1] = expected[2] = expected[23] = 3;
+
+describe("mask codec", () => {
+  it("decodes bit-packed masks", () => {
+    const mask = decodeMask(encode(0, [0b110, 0, 0b10000000]));
+    expect(mask.dims).toEqual([4, 3, 2]);
+    expect(mask.data).toEqual(expected);
+  });
+
+  it("decodes run-length encoded masks", () => {
+    // zeros 1, ones 2, zeros 20, ones 1
+    expect(decodeMask(encode(1, [1, 2, 20, 1])).data).toEqual(expected);
+  });
+
+  it("rejects runs that do not cover the volume", () => {
+    const big = encode(1, [0x80, 0x01]); // a single run of 128 zeros
+    expect(() => decodeMask(big)).toThrow(/cover/);
+  });
+
+  it("applies delta-encoded masks to their base", () => {
+    const base = decodeMask(encode(1, [1, 2, 20, 1]));
+    // unchanged 2, changed 2 (voxels 2 and 3), unchanged 20
+    const next = decodeMask(encode(2, [2, 2, 20]), base);
+    const want = new Uint8Array(24);
+    want[1] = want[3] = want[23] = 3;
+    expect(next.data).toEqual(want);
+    expect(() => decodeMask(encode(2, [2, 2, 20]))).toThrow(/base/);
+  });
+
+  it("wraps the mask in a NIfTI header with the affine as sform", () => {
+    const nii = maskToNifti(decodeMask(encode(1, [1, 2, 20, 1])));
+    const view = new DataView(nii.buffer);
+    expect(view.getInt32(0, true)).toBe(348);
+    expect(view.getInt16(42, true)).toBe(4);
+    expect(view.getFloat32(80, true)).toBe(2); // pixdim[1]
+    expect(view.getFloat32(88, true)).toBe(3); // pixdim[3]
+    expect(view.getFloat32(292, true)).toBe(-10); // srow_x[3]
+    expect(nii.subarray(352)).toEqual(expected);
+  });
+});
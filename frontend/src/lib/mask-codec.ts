@@ -0,0 +1,116 @@
+/**
+ * Decoder for inline inference masks (`application/x-freebrowse-mask`,
+ * see backend/src/mask_codec.py).
+ *
+ * Layout (little endian): "FBMK" magic, uint8 version, uint8 encoding
+ * (0 = bit-packed LSB first, 1 = RLE, 2 = delta), uint8 label, uint8 reserved,
+ * 3 x uint32 dims, 16 x float32 row-major voxel-to-RAS affine,
+ * uint32 payload length, payload. Voxels are in NIfTI order (x fastest).
+ * RLE payloads are LEB128 varints of alternating run lengths, zeros first.
+ * Delta payloads are runs of unchanged and changed voxels relative to the
+ * result named by the response's X-Result-Base header.
+ */
+
+export const MASK_MEDIA_TYPE = "application/x-freebrowse-mask";
+const MAGIC = [0x46, 0x42, 0x4d, 0x4b]; // "FBMK"
+const VERSION = 1;
+const HEADER_SIZE = 88;
+const ENCODING_BITS = 0;
+const ENCODING_RLE = 1;
+const ENCODING_DELTA = 2;
+
+export interface DecodedMask {
+  dims: [number, number, number];
+  affine: number[]; // 16 values, row-major
+  label: number;
+  data: Uint8Array; // 0 or `label` per voxel, NIfTI order
+}
+
+function forEachRun(
+  payload: Uint8Array,
+  count: number,
+  onSet: (start: number, end: number) => void,
+): void {
+  let pos = 0;
+  let on = false;
+  let value = 0;
+  let shift = 0;
+  for (let i = 0; i < payload.length; i++) {
+    const byte = payload[i];
+    value += (byte & 0x7f) * 2 ** shift;
+    shift += 7;
+    if (byte & 0x80) continue;
+    if (on) onSet(pos, pos + value);
+    pos += value;
+    on = !on;
+    value = 0;
+    shift = 0;
+  }
+  if (pos !== count) throw new Error("Mask runs do not cover the volume");
+}
+
+/** Decode a mask; delta-encoded masks need the result they are relative to. */
+export function decodeMask(bytes: Uint8Array, base?: DecodedMask): DecodedMask {
+  if (bytes.length < HEADER_SIZE || !MAGIC.every((b, i) => bytes[i] === b)) {
+    throw new Error("Not an encoded mask");
+  }
+  const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+  if (view.getUint8(4) !== VERSION) {
+    throw new Error(`Unsupported mask version: ${view.getUint8(4)}`);
+  }
+  const encoding = view.getUint8(5);
+  const label = view.getUint8(6);
+  const dims: [number, number, number] = [
+    view.getUint32(8, true),
+    view.getUint32(12, true),
+    view.getUint32(16, true),
+  ];
+  const affine = Array.from({ length: 16 }, (_, i) => view.getFloat32(20 + 4 * i, true));
+  const length = view.getUint32(84, true);
+  if (HEADER_SIZE + length > bytes.length) throw new Error("Truncated mask");
+  const payload = bytes.subarray(HEADER_SIZE, HEADER_SIZE + length);
+
+  const count = dims[0] * dims[1] * dims[2];
+  const data = new Uint8Array(count);
+  if (encoding === ENCODING_BITS) {
+    for (let i = 0; i < count; i++) {
+      if (payload[i >> 3] & (1 << (i & 7))) data[i] = label;
+    }
+  } else if (encoding === ENCODING_RLE) {
+    forEachRun(payload, count, (start, end) => data.fill(label, start, end));
+  } else if (encoding === ENCODING_DELTA) {
+    if (!base || base.data.length !== count) {
+      throw new Error("Delta-encoded mask needs its base result");
+    }
+    for (let i = 0; i < count; i++) if (base.data[i]) data[i] = label;
+    forEachRun(payload, count, (start, end) => {
+      for (let i = start; i < end; i++) data[i] = data[i] ? 0 : label;
+    });
+  } else {
+    throw new Error(`Unknown mask encoding: ${encoding}`);
+  }
+  return { dims, affine, label, data };
+}
+
+/** Wrap a decoded mask in an uncompressed single-file NIfTI-1 image. */
+export function maskToNifti(mask: DecodedMask): Uint8Array {
+  const voxOffset = 352;
+  const out = new Uint8Array(voxOffset + mask.data.length);
+  const view = new DataView(out.buffer);
+  const a = mask.affine;
+  view.setInt32(0, 348, true); // sizeof_hdr
+  [3, ...mask.dims, 1, 1, 1, 1].forEach((d, i) => view.setInt16(40 + 2 * i, d, true));
+  view.setInt16(70, 2, true); // datatype: uint8
+  view.setInt16(72, 8, true); // bitpix
+  const zooms = [0, 1, 2].map((c) => Math.hypot(a[c], a[4 + c], a[8 + c]));
+  [1, ...zooms, 1, 1, 1, 1].forEach((p, i) => view.setFloat32(76 + 4 * i, p, true));
+  view.setFloat32(108, voxOffset, true);
+  view.setFloat32(112, 1, true); // scl_slope
+  view.setUint8(123, 10); // xyzt_units: mm, s
+  view.setFloat32(124, mask.label, true); // cal_max
+  view.setInt16(254, 1, true); // sform_code: scanner
+  for (let i = 0; i < 12; i++) view.setFloat32(280 + 4 * i, a[i], true);
+  out.set([0x6e, 0x2b, 0x31, 0x00], 344); // "n+1\0"
+  out.set(mask.data, voxOffset);
+  return out;
+}
@@ -0,0 +1,108 @@
+import { describe, it, expect } from "vitest";
+
+import {
+  isBinaryNvd,
+  parseBinaryNvdHeader,
+  readBinaryNvdBlob,
+  readBinaryNvdStream,
+} from "./nvd-binary";
+
+// Mirrors scripts/nvd-binary.py: 16-byte preamble, JSON header, 64-byte aligned payloads.
+function buildNvdb(payloads: Uint8Array[]): Uint8Array {
+  const align = (n: number) => Math.ceil(n / 64) * 64;
+  const names = payloads.map((_, i) => `image${i}.nii`);
+  let dataStart = 64;
+  for (;;) {
+    let offset = dataStart;
+    const blobs = payloads.map((p, i) => {
+      const entry = { name: names[i], offset, length: p.length, encoding: "raw" };
+      offset = align(offset + p.length);
+      return entry;
+    });
+    const json = new TextEncoder().encode(
+      JSON.stringify({ imageOptionsArray: names.map((name) => ({ name })), blobs }),
+    );
+    if (align(16 + json.length) !== dataStart) {
+      dataStart = align(16 + json.length);
+      continue;
+    }
+    const out = new Uint8Array(offset);
+    out.set([0x4e, 0x56, 0x44, 0x42], 0);
+    const view = new DataView(out.buffer);
+    view.setUint32(4, 1, true);
+    view.setBigUint64(8, BigInt(json.length), true);
+    out.set(json, 16);
+    blobs.forEach((b, i) => out.set(payloads[i], b.offset));
+    return out;
+  }
+}
+
+function chunkedStream(bytes: Uint8Array, chunkSize: number): ReadableStream<Uint8Array> {
+  let offset = 0;
+  return new ReadableStream({
+    pull(controller) {
+      if (offset >= bytes.length) {
+        controller.close();
+        return;
+      }
+      controller.enqueue(bytes.slice(offset, offset + chunkSize));
+      offset += chunkSize;
+    },
+  });
+}
+
+const payloads = [
+  new Uint8Array(300).map((_, i) => i % 251),
+  new Uint8Array(0),
+  new Uint8Array(70).fill(7),
+];
+
+describe("binary NVD", () => {
+  it("detects the magic and parses the header", () => {
+    const file = buildNvdb(payloads);
+    expect(isBinaryNvd(file)).toBe(true);
+    expect(isBinaryNvd(new TextEncoder().encode("{}"))).toBe(false);
+    const header = parseBinaryNvdHeader(file);
+    expect(header.blobs.map((b) => b.length)).toEqual([300, 0, 70]);
+    expect(header.blobs.every((b) => b.offset % 64 === 0)).toBe(true);
+  });
+
+  it.each([1, 13, 64, 4096])("streams payloads in %i-byte chunks", async (size) => {
+    const file = buildNvdb(payloads);
+    const events: string[] = [];
+    const images: Uint8Array[] = [];
+    await readBinaryNvdStream(
+      chunkedStream(file, size),
+      () => {
+        events.push("header");
+      },
+      (index, _entry, bytes) => {
+        events.push(`image${index}`);
+        images[index] = bytes;
+      },
+    );
+    expect(events[0]).toBe("header");
+    expect(events.slice(1).sort()).toEqual(["image0", "image1", "image2"]);
+    payloads.forEach((p, i) => {
+      expect(images[i]).toEqual(p);
+      // Each payload owns its buffer, so it can be handed to NiiVue as-is.
+      expect(images[i].buffer.byteLength).toBe(p.length);
+    });
+  });
+
+  it("rejects a truncated stream", async () => {
+    const file = buildNvdb(payloads);
+    await expect(
+      readBinaryNvdStream(chunkedStream(file.slice(0, file.length - 80), 32), () => {}, () => {}),
+    ).rejects.toThrow(/Truncated/);
+  });
+
+  it("reads payloads from a Blob", async () => {
+    const file = buildNvdb(payloads);
+    const images: Uint8Array[] = [];
+    await readBinaryNvdBlob(new Blob([file]), () => {}, (i, _e, bytes) => {
+      images[i] = bytes;
+    });
+    payloads.forEach((p, i) => expect(images[i]).toEqual(p));
+  });
+});
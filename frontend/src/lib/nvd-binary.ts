@@ -0,0 +1,195 @@
+/**
+ * Reader for binary NiiVue documents (.nvdb, see scripts/nvd-binary.py).
+ *
+ * Layout: "NVDB" magic, uint32 version, uint64 header length (little endian),
+ * a UTF-8 JSON header (the NVD document without `encodedImageBlobs`, plus a
+ * `blobs` array of absolute payload offsets), then the image payloads.
+ *
+ * Documents are read in a single pass: each payload is copied from the
+ * incoming chunks straight into its own ArrayBuffer, which is handed to the
+ * caller as soon as it is complete, so no base64 decoding or whole-file
+ * buffering is involved and the first image can render before the last one
+ * has arrived.
+ */
+
+export const NVDB_MAGIC = [0x4e, 0x56, 0x44, 0x42]; // "NVDB"
+export const NVDB_VERSION = 1;
+const PREAMBLE_SIZE = 16;
+
+export interface NvdBlobEntry {
+  name: string;
+  offset: number;
+  length: number;
+  encoding: "gzip" | "raw";
+}
+
+export interface BinaryNvdHeader {
+  imageOptionsArray?: any[];
+  blobs: NvdBlobEntry[];
+  [key: string]: any;
+}
+
+export type OnNvdImage = (
+  index: number,
+  entry: NvdBlobEntry,
+  bytes: Uint8Array,
+) => void | Promise<void>;
+
+export function isBinaryNvd(bytes: Uint8Array): boolean {
+  return (
+    bytes.length >= NVDB_MAGIC.length &&
+    NVDB_MAGIC.every((b, i) => bytes[i] === b)
+  );
+}
+
+/** Total header size (preamble + JSON) once the first 16 bytes are known. */
+export function binaryNvdHeaderEnd(preamble: Uint8Array): number {
+  if (preamble.length < PREAMBLE_SIZE || !isBinaryNvd(preamble)) {
+    throw new Error("Not a binary NVD document");
+  }
+  const view = new DataView(
+    preamble.buffer,
+    preamble.byteOffset,
+    PREAMBLE_SIZE,
+  );
+  const version = view.getUint32(4, true);
+  if (version !== NVDB_VERSION) {
+    throw new Error(`Unsupported binary NVD version: ${version}`);
+  }
+  return PREAMBLE_SIZE + Number(view.getBigUint64(8, true));
+}
+
+/** Parse the JSON header from bytes that start at offset 0 of the file. */
+export function parseBinaryNvdHeader(bytes: Uint8Array): BinaryNvdHeader {
+  const end = binaryNvdHeaderEnd(bytes);
+  if (bytes.length < end) throw new Error("Truncated binary NVD header");
+  const header = JSON.parse(
+    new TextDecoder().decode(bytes.subarray(PREAMBLE_SIZE, end)),
+  );
+  if (!Array.isArray(header.blobs)) header.blobs = [];
+  return header;
+}
+
+function concat(a: Uint8Array, b: Uint8Array): Uint8Array {
+  const out = new Uint8Array(a.length + b.length);
+  out.set(a, 0);
+  out.set(b, a.length);
+  return out;
+}
+
+/**
+ * Stream a binary NVD document, calling `onHeader` once the header has been
+ * parsed and `onImage` for every payload, in file order, as it completes.
+ * Callbacks run sequentially; reading continues while they are pending.
+ */
+export async function readBinaryNvdStream(
+  stream: ReadableStream<Uint8Array>,
+  onHeader: (header: BinaryNvdHeader) => void | Promise<void>,
+  onImage: OnNvdImage,
+): Promise<BinaryNvdHeader> {
+  const reader = stream.getReader();
+  let head = new Uint8Array(0);
+  let header: BinaryNvdHeader | null = null;
+  let headerEnd = -1;
+  let position = 0; // file offset of the first byte of the next chunk
+  let callbacks: Promise<void> = Promise.resolve();
+  let blobs: { entry: NvdBlobEntry; index: number; bytes: Uint8Array; filled: number }[] = [];
+
+  const consume = (chunk: Uint8Array) => {
+    const start = position;
+    position += chunk.length;
+    for (const blob of blobs) {
+      const { entry } = blob;
+      if (blob.filled === entry.length) continue;
+      const from = Math.max(entry.offset, start);
+      const to = Math.min(entry.offset + entry.length, position);
+      if (from >= to) continue;
+      blob.bytes.set(chunk.subarray(from - start, to - start), from - entry.offset);
+      blob.filled += to - from;
+      if (blob.filled === entry.length) {
+        const done = blob;
+        callbacks = callbacks.then(() => onImage(done.index, done.entry, done.bytes));
+      }
+    }
+  };
+
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    if (header) {
+      consume(value);
+      continue;
+    }
+    head = concat(head, value);
+    if (headerEnd < 0 && head.length >= PREAMBLE_SIZE) {
+      headerEnd = binaryNvdHeaderEnd(head);
+    }
+    if (headerEnd < 0 || head.length < headerEnd) continue;
+
+    const parsed = parseBinaryNvdHeader(head);
+    header = parsed;
+    blobs = parsed.blobs
+      .map((entry, index) => ({
+        entry,
+        index,
+        bytes: new Uint8Array(entry.length),
+        filled: 0,
+      }))
+      .sort((a, b) => a.entry.offset - b.entry.offset);
+    callbacks = callbacks.then(() => onHeader(parsed));
+    for (const blob of blobs) {
+      if (blob.entry.length === 0) {
+        const done = blob;
+        callbacks = callbacks.then(() => onImage(done.index, done.entry, done.bytes));
+      }
+    }
+    const rest = head;
+    head = new Uint8Array(0);
+    consume(rest);
+  }
+
+  if (!header) throw new Error("Truncated binary NVD header");
+  const missing = blobs.find((b) => b.filled !== b.entry.length);
+  await callbacks;
+  if (missing) throw new Error(`Truncated payload for ${missing.entry.name}`);
+  return header;
+}
+
+/** Read a binary NVD document from a local File/Blob, one slice per payload. */
+export async function readBinaryNvdBlob(
+  blob: Blob,
+  onHeader: (header: BinaryNvdHeader) => void | Promise<void>,
+  onImage: OnNvdImage,
+): Promise<BinaryNvdHeader> {
+  const preamble = new Uint8Array(await blob.slice(0, PREAMBLE_SIZE).arrayBuffer());
+  const headerEnd = binaryNvdHeaderEnd(preamble);
+  const header = parseBinaryNvdHeader(
+    new Uint8Array(await blob.slice(0, headerEnd).arrayBuffer()),
+  );
+  await onHeader(header);
+  for (let i = 0; i < header.blobs.length; i++) {
+    const entry = header.blobs[i];
+    const bytes = new Uint8Array(
+      await blob.slice(entry.offset, entry.offset + entry.length).arrayBuffer(),
+    );
+    if (bytes.length !== entry.length) {
+      throw new Error(`Truncated payload for ${entry.name}`);
+    }
+    await onImage(i, entry, bytes);
+  }
+  return header;
+}
+
+/** Fetch a single payload of a served .nvdb with an HTTP Range request. */
+export async function fetchBinaryNvdImage(
+  url: string,
+  entry: NvdBlobEntry,
+): Promise<Uint8Array> {
+  const last = entry.offset + entry.length - 1;
+  const res = await fetch(url, { headers: { Range: `bytes=${entry.offset}-${last}` } });
+  if (!res.ok) throw new Error(`GET ${url} failed: ${res.status}`);
+  const buffer = await res.arrayBuffer();
+  if (res.status === 206) return new Uint8Array(buffer);
+  // Server ignored the Range header and sent the whole file.
+  return new Uint8Array(buffer, entry.offset, entry.length);
+}
@@ -0,0 +1,148 @@
+/**
+ * Upload NIfTI bytes to the backend.
+ *
+ * Small volumes go to PUT /data/nii as a raw request body, which the backend
+ * streams straight to disk. Large volumes use the resumable /data/upload
+ * session API: chunks are sent in parallel with per-chunk checksums, failed
+ * chunks are retried, and only the chunks the server reports missing are
+ * re-sent before committing.
+ *
+ * When the backend keeps a content-addressed blob store, the volume's sha256
+ * is computed first; if the server already has those bytes, the new path is
+ * linked to them and nothing is uploaded.
+ */
+
+const RESUMABLE_THRESHOLD = 64 * 1024 * 1024;
+const CHUNK_SIZE = 8 * 1024 * 1024;
+const PARALLEL_CHUNKS = 4;
+const MAX_ROUNDS = 5;
+
+async function sha256Hex(bytes: Uint8Array): Promise<string | null> {
+  // crypto.subtle is only available in secure contexts; checksums are optional.
+  if (!globalThis.crypto?.subtle) return null;
+  const digest = await crypto.subtle.digest("SHA-256", bytes);
+  return Array.from(new Uint8Array(digest), (b) =>
+    b.toString(16).padStart(2, "0"),
+  ).join("");
+}
+
+async function putChunk(
+  uploadId: string,
+  index: number,
+  chunk: Uint8Array,
+): Promise<void> {
+  const headers: Record<string, string> = {
+    "Content-Type": "application/octet-stream",
+  };
+  const checksum = await sha256Hex(chunk);
+  if (checksum) headers["X-Chunk-Sha256"] = checksum;
+  const res = await fetch(
+    `/data/upload/${uploadId}/chunk/${index}`,
+    { method: "PUT", headers, body: chunk },
+  );
+  if (!res.ok) throw new Error(`chunk ${index} failed: ${res.status}`);
+}
+
+// gzip headers carry a timestamp (bytes 4-7), so re-encoding the same volume
+// would otherwise never produce the same bytes twice.
+function clearGzipTimestamp(bytes: Uint8Array): void {
+  if (bytes.length >= 10 && bytes[0] === 0x1f && bytes[1] === 0x8b) {
+    bytes.fill(0, 4, 8);
+  }
+}
+
+async function linkExistingBlob(
+  filename: string,
+  digest: string,
+): Promise<any | null> {
+  const head = await fetch(`/data/blobs/${digest}`, { method: "HEAD" });
+  if (!head.ok) return null;
+  const res = await fetch(`/data/blobs/${digest}/link`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ filename }),
+  });
+  return res.ok ? res.json() : null;
+}
+
+async function fetchMissingChunks(uploadId: string): Promise<number[]> {
+  const res = await fetch(`/data/upload/${uploadId}`);
+  if (!res.ok) throw new Error(`GET /data/upload/${uploadId} failed: ${res.status}`);
+  const status = await res.json();
+  return status.missing;
+}
+
+export async function uploadVolumeResumable(
+  filename: string,
+  bytes: Uint8Array,
+  sha256: string | null = null,
+): Promise<any> {
+  const createRes = await fetch("/data/upload", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({
+      filename,
+      size: bytes.length,
+      chunk_size: CHUNK_SIZE,
+      sha256,
+    }),
+  });
+  if (!createRes.ok)
+    throw new Error(`Upload create failed: ${createRes.status} ${createRes.statusText}`);
+  const { upload_id, chunk_size, chunk_count } = await createRes.json();
+
+  let missing = Array.from({ length: chunk_count }, (_, i) => i);
+  for (let round = 0; missing.length > 0 && round < MAX_ROUNDS; round++) {
+    const queue = [...missing];
+    const worker = async () => {
+      for (let index = queue.shift(); index !== undefined; index = queue.shift()) {
+        const start = index * chunk_size;
+        try {
+          await putChunk(upload_id, index, bytes.subarray(start, start + chunk_size));
+        } catch (err) {
+          console.warn(`Upload ${upload_id}: ${err}`);
+        }
+      }
+    };
+    await Promise.all(Array.from({ length: PARALLEL_CHUNKS }, worker));
+    missing = await fetchMissingChunks(upload_id);
+  }
+  if (missing.length > 0)
+    throw new Error(`Upload incomplete: ${missing.length} chunk(s) failed`);
+
+  const commitRes = await fetch(`/data/upload/${upload_id}/commit`, {
+    method: "POST",
+  });
+  if (!commitRes.ok)
+    throw new Error(`Upload commit failed: ${commitRes.status} ${commitRes.statusText}`);
+  return commitRes.json();
+}
+
+/**
+ * Save `bytes` as `filename` under DATA_DIR. A gzip timestamp in `bytes` is
+ * zeroed in place so identical volumes hash identically.
+ */
+export async function uploadVolume(
+  filename: string,
+  bytes: Uint8Array,
+): Promise<any> {
+  clearGzipTimestamp(bytes);
+  const digest = await sha256Hex(bytes);
+  if (digest) {
+    const linked = await linkExistingBlob(filename, digest);
+    if (linked) return linked;
+  }
+  if (bytes.length >= RESUMABLE_THRESHOLD)
+    return uploadVolumeResumable(filename, bytes, digest);
+  const headers: Record<string, string> = {
+    "Content-Type": "application/octet-stream",
+  };
+  if (digest) headers["X-Content-Sha256"] = digest;
+  const res = await fetch(
+    `/data/nii?filename=${encodeURIComponent(filename)}`,
+    { method: "PUT", headers, body: bytes },
+  );
+  if (!res.ok)
+    throw new Error(`Volume upload failed: ${res.status} ${res.statusText}`);
+  return res.json();
+}
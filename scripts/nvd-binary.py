@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""Convert NiiVue documents between .nvd (JSON) and binary .nvdb containers.
+
+A .nvd file embeds every image as a base64 string in `encodedImageBlobs`,
+which inflates it by a third and forces readers to parse and decode the whole
+document before anything can be shown. A .nvdb file stores the same document
+as a small JSON header followed by the raw image payloads:
+
+    bytes 0-3     magic b"NVDB"
+    bytes 4-7     format version (uint32, little endian)
+    bytes 8-15    header length N (uint64, little endian)
+    bytes 16-16+N UTF-8 JSON header: the NVD document without
+                  `encodedImageBlobs`, plus a `blobs` array with one
+                  {"name", "offset", "length", "encoding"} entry per image
+    ...           payloads, each starting on a 64-byte boundary
+
+Offsets are absolute file positions, so a single image can be fetched with an
+HTTP Range request (`bytes=offset-(offset+length-1)`), and readers can wrap
+each payload in a typed-array view without copying. `encoding` is "gzip" when
+the payload is gzip-compressed (e.g. a .nii.gz file stored as-is) and "raw"
+otherwise.
+
+This script has no external dependencies (standard library only) and can be
+copied and distributed independently to pipeline developers.
+
+Example usage:
+    # .nvd -> .nvdb, storing payloads as they are
+    ./nvd-binary.py pack scene.nvd -o scene.nvdb
+
+    # Store uncompressed payloads (largest file, zero-copy loading)
+    ./nvd-binary.py pack --payloads raw scene.nvd -o scene.nvdb
+
+    # Build a .nvdb straight from image files
+    ./nvd-binary.py pack --title "Subject 001" -o scene.nvdb T1.nii.gz seg.nii.gz
+
+    # .nvdb -> .nvd
+    ./nvd-binary.py unpack scene.nvdb -o scene.nvd
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import struct
+import sys
+from pathlib import Path
+
+MAGIC = b"NVDB"
+VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct("<4sIQ")
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def _align(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def _default_image_options(i, name):
+    # First image: gray base layer, subsequent: hot overlay (as nvd-create.py)
+    if i == 0:
+        return {"name": name, "colormap": "gray", "opacity": 1, "url": ""}
+    return {"name": name, "colormap": "hot", "opacity": 0.5, "url": ""}
+
+
+def _transform_payload(data, payloads):
+    """Apply the --payloads policy to one image payload."""
+    is_gzip = data[:2] == _GZIP_MAGIC
+    if payloads == "raw" and is_gzip:
+        data = gzip.decompress(data)
+    elif payloads == "gzip" and not is_gzip:
+        data = gzip.compress(data, compresslevel=6)
+    return data
+
+
+def _payload_name(name, data):
+    """Keep the image name's .gz suffix in step with the payload encoding."""
+    is_gzip = data[:2] == _GZIP_MAGIC
+    if is_gzip and not name.endswith(".gz"):
+        return name + ".gz"
+    if not is_gzip and name.endswith(".gz"):
+        return name[:-3]
+    return name
+
+
+def build_header(nvd, payload_lengths, names, encodings):
+    """Return (header_bytes, data_start) with absolute payload offsets filled in.
+
+    Offsets depend on the header length, which depends on the offsets, so the
+    header is re-encoded until its length is stable (two passes in practice).
+    """
+    header = {k: v for k, v in nvd.items() if k != "encodedImageBlobs"}
+    data_start = _align(_PREAMBLE.size)
+    while True:
+        blobs = []
+        offset = data_start
+        for name, length, encoding in zip(names, payload_lengths, encodings):
+            blobs.append({
+                "name": name,
+                "offset": offset,
+                "length": length,
+                "encoding": encoding,
+            })
+            offset = _align(offset + length)
+        header["blobs"] = blobs
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        needed = _align(_PREAMBLE.size + len(header_bytes))
+        if needed == data_start:
+            return header_bytes, data_start
+        data_start = needed
+
+
+def write_nvdb(out, nvd, payloads):
+    """Write `nvd` (without encodedImageBlobs) and its payload bytes to `out`."""
+    options = nvd.setdefault("imageOptionsArray", [])
+    names, encodings = [], []
+    for i, data in enumerate(payloads):
+        if i >= len(options):
+            options.append(_default_image_options(i, f"image{i}.nii"))
+        name = _payload_name(options[i].get("name") or f"image{i}.nii", data)
+        options[i]["name"] = name
+        options[i]["url"] = ""
+        names.append(name)
+        encodings.append("gzip" if data[:2] == _GZIP_MAGIC else "raw")
+
+    header_bytes, data_start = build_header(
+        nvd, [len(p) for p in payloads], names, encodings,
+    )
+    out.write(_PREAMBLE.pack(MAGIC, VERSION, len(header_bytes)))
+    out.write(header_bytes)
+    position = _PREAMBLE.size + len(header_bytes)
+    out.write(b"\0" * (data_start - position))
+    position = data_start
+    for data in payloads:
+        out.write(data)
+        position += len(data)
+        padded = _align(position)
+        out.write(b"\0" * (padded - position))
+        position = padded
+    return position
+
+
+def read_header(f):
+    """Read and validate the preamble and JSON header of an open .nvdb file."""
+    preamble = f.read(_PREAMBLE.size)
+    if len(preamble) != _PREAMBLE.size:
+        raise ValueError("File is too short to be a binary NVD")
+    magic, version, header_length = _PREAMBLE.unpack(preamble)
+    if magic != MAGIC:
+        raise ValueError("Not a binary NVD file (bad magic)")
+    if version != VERSION:
+        raise ValueError(f"Unsupported binary NVD version: {version}")
+    return json.loads(f.read(header_length).decode("utf-8"))
+
+
+def pack(inputs, payloads="keep", template_path=None, title=None):
+    """Return (nvd, payload list) from an .nvd file or a list of image files."""
+    if len(inputs) == 1 and inputs[0].endswith(".nvd"):
+        with open(inputs[0]) as f:
+            nvd = json.load(f)
+        blobs = [base64.b64decode(b) for b in nvd.pop("encodedImageBlobs", [])]
+    else:
+        if template_path:
+            with open(template_path) as f:
+                nvd = json.load(f)
+            nvd.pop("encodedImageBlobs", None)
+        else:
+            nvd = {"imageOptionsArray": [], "opts": {}}
+        options = nvd.setdefault("imageOptionsArray", [])
+        blobs = []
+        for i, image_path in enumerate(inputs):
+            blobs.append(Path(image_path).read_bytes())
+            if i >= len(options):
+                options.append(_default_image_options(i, Path(image_path).name))
+    if title:
+        nvd["title"] = title
+    return nvd, [_transform_payload(b, payloads) for b in blobs]
+
+
+def unpack(path):
+    """Return the .nvd document stored in the .nvdb file at `path`."""
+    with open(path, "rb") as f:
+        header = read_header(f)
+        blobs = header.pop("blobs", [])
+        encoded = []
+        for blob in blobs:
+            f.seek(blob["offset"])
+            data = f.read(blob["length"])
+            if len(data) != blob["length"]:
+                raise ValueError(f"Truncated payload for {blob.get('name', 'image')}")
+            encoded.append(base64.b64encode(data).decode("ascii"))
+    header["encodedImageBlobs"] = encoded
+    return header
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert NiiVue documents between .nvd (JSON) and binary .nvdb.",
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_pack = sub.add_parser("pack", help="Create a .nvdb from a .nvd or from image files")
+    p_pack.add_argument("inputs", nargs="+", help="One .nvd file, or image files to embed")
+    p_pack.add_argument("-o", "--output", required=True, help="Output .nvdb file path")
+    p_pack.add_argument(
+        "--payloads", choices=["keep", "raw", "gzip"], default="keep",
+        help="Store payloads as given (default), decompressed, or gzip-compressed",
+    )
+    p_pack.add_argument("-t", "--template", help="Template .nvd for image-file input")
+    p_pack.add_argument("--title", help="Document title")
+    p_pack.add_argument("-v", "--verbose", action="store_true", help="Print info to stderr")
+
+    p_unpack = sub.add_parser("unpack", help="Convert a .nvdb back to a .nvd")
+    p_unpack.add_argument("input", help="Input .nvdb file")
+    p_unpack.add_argument("-o", "--output", help="Output .nvd file path (default: stdout)")
+    p_unpack.add_argument("-v", "--verbose", action="store_true", help="Print info to stderr")
+
+    args = parser.parse_args()
+
+    inputs = args.inputs if args.command == "pack" else [args.input]
+    if args.command == "pack" and args.template:
+        inputs = inputs + [args.template]
+    for path in inputs:
+        if not Path(path).exists():
+            print(f"Error: File not found: {path}", file=sys.stderr)
+            sys.exit(1)
+
+    try:
+        if args.command == "pack":
+            nvd, payloads = pack(args.inputs, args.payloads, args.template, args.title)
+            with open(args.output, "wb") as f:
+                size = write_nvdb(f, nvd, payloads)
+            if args.verbose:
+                print(f"Wrote {args.output} ({size:,} bytes, {len(payloads)} image(s))",
+                      file=sys.stderr)
+        else:
+            output_json = json.dumps(unpack(args.input), indent=2)
+            if args.output:
+                with open(args.output, "w") as f:
+                    f.write(output_json)
+                if args.verbose:
+                    print(f"Wrote {args.output} ({len(output_json):,} bytes)", file=sys.stderr)
+            else:
+                print(output_json)
+    except ValueError as exc:
+        print(f"Error: {exc}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
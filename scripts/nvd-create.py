@@ -16,22 +16,48 @@ Example usage:
 
     # Output to stdout for piping
     ./nvd-create.py image.nii.gz > output.nvd
+
+    # Reference images by hash from a freebrowse DATA_DIR instead of embedding
+    ./nvd-create.py --blob-store /data -o /data/subject001.nvd T1.nii.gz
 """
 
 import argparse
 import base64
+import hashlib
 import json
+import os
 import sys
+import tempfile
 from pathlib import Path
 
 
-def create_nvd(image_paths, template_path=None, title=None):
+def store_blob(data, blob_store):
+    """Write `data` into the content-addressed store of a freebrowse DATA_DIR.
+
+    Mirrors the backend's layout (DATA_DIR/.blobs/<sha256[:2]>/<sha256>,
+    read-only) and returns the sha256 digest.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    blob = Path(blob_store) / ".blobs" / digest[:2] / digest
+    if not blob.exists():
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=blob.parent, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, blob)
+    return digest
+
+
+def create_nvd(image_paths, template_path=None, title=None, blob_store=None):
     """Create an NVD document from image files.
 
     Args:
         image_paths: List of paths to image files to embed
         template_path: Optional path to template .nvd file to inherit settings from
         title: Optional document title
+        blob_store: Optional freebrowse DATA_DIR; images are written to its blob
+            store and referenced by hash instead of being embedded
 
     Returns:
         dict: NVD document structure ready for JSON serialization
@@ -47,16 +73,20 @@ def create_nvd(image_paths, template_path=None, title=None):
     nvd["encodedImageBlobs"] = []
 
     for i, image_path in enumerate(image_paths):
-        # Read and encode image
+        # Read and encode image (or store it and reference it by hash)
         with open(image_path, "rb") as f:
-            blob = base64.b64encode(f.read()).decode("ascii")
-        nvd["encodedImageBlobs"].append(blob)
+            data = f.read()
+        name = Path(image_path).name
+        if blob_store:
+            url = f"data/blobs/{store_blob(data, blob_store)}/{name}"
+        else:
+            url = ""
+            nvd["encodedImageBlobs"].append(base64.b64encode(data).decode("ascii"))
 
         # Add/update imageOptionsArray entry
-        name = Path(image_path).name
         if i < len(nvd.get("imageOptionsArray", [])):
-            # Template entry exists - keep settings but clear URL
-            nvd["imageOptionsArray"][i]["url"] = ""
+            # Template entry exists - keep settings but replace URL
+            nvd["imageOptionsArray"][i]["url"] = url
         else:
             # No template entry - use defaults
             # First image: gray base layer, subsequent: hot overlay
@@ -71,9 +101,12 @@ def create_nvd(image_paths, template_path=None, title=None):
                 "name": name,
                 "colormap": colormap,
                 "opacity": opacity,
-                "url": ""
+                "url": url
             })
 
+    if blob_store:
+        del nvd["encodedImageBlobs"]
+
     if title:
         nvd["title"] = title
 
@@ -102,6 +135,12 @@ def main():
         "--title",
         help="Document title"
     )
+    parser.add_argument(
+        "--blob-store",
+        metavar="DATA_DIR",
+        help="Store images in the blob store of this freebrowse DATA_DIR and "
+             "reference them by hash instead of embedding them"
+    )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
@@ -130,7 +169,7 @@ def main():
             print(f"Using template: {args.template}", file=sys.stderr)
 
     # Create the NVD document
-    nvd = create_nvd(args.images, args.template, args.title)
+    nvd = create_nvd(args.images, args.template, args.title, args.blob_store)
 
     # Output
     output_json = json.dumps(nvd, indent=2)